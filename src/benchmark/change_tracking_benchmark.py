@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Measures CPU time the validator spends per product to tell whether it changed, for a feed of
+# BENCHMARK_FEED_SIZE products that repeat on every poll and rarely change.
+#   python3 change_tracking_benchmark.py
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'validator'))
+import validator_custom
+from product_record import ProductRecord
+from product_state import ProductState, ProductStateCache, diffStates
+
+iterations = int(os.getenv('BENCHMARK_ITERATIONS', 200))
+feedSize = int(os.getenv('BENCHMARK_FEED_SIZE', 50))
+
+def feed():
+    return [ProductRecord(
+        id = 'thread-' + str(index),
+        startSellDate = '2020-01-17T15:00:00.000',
+        publishType = 'LAUNCH',
+        price = 170,
+        sizes = ['M ' + str(size) + ' / W ' + str(size + 1.5) for size in range(4, 16)]
+    ) for index in range(feedSize)]
+
+def main():
+    products = feed()
+    productStates = ProductStateCache(capacity = feedSize * 2)
+    for product in products:
+        productStates.remember(product.id, ProductState.fromProduct(product).digest)
+
+    # Every product is unchanged, so none should need the database
+    start = time.perf_counter()
+    for index in range(iterations):
+        candidates = validator_custom.findChangeCandidates(products, productStates)
+    unchangedTime = time.perf_counter() - start
+    assert len(candidates) == 0
+
+    # Diff of a restock, which only runs for products whose digest changed
+    old = ProductState.fromProduct(products[0])
+    restocked = ProductState(170, 'LAUNCH', '2020-01-17T15:00:00.000', products[0].sizes + ['M 16 / W 17.5'])
+    start = time.perf_counter()
+    for index in range(iterations * feedSize):
+        changes = diffStates(old, restocked)
+    diffTime = time.perf_counter() - start
+    assert changes == { 'sizesAdded': ['M 16 / W 17.5'] }
+
+    count = iterations * feedSize
+    print('unchanged check {:>6.2f} us/product'.format(unchangedTime / count * 1e6))
+    print('restock diff    {:>6.2f} us/product'.format(diffTime / count * 1e6))
+
+if __name__ == '__main__':
+    main()
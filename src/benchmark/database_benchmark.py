@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Compares per message latency of opening a database connection for every message, as the validator
+# and notifier used to, with borrowing one from the connection pool. Needs a running postgres database,
+# configured with the same DATABASE_* variables as the services.
+#   python3 database_benchmark.py
+import os
+import sys
+import time
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from database_pool import DatabasePool
+
+messageCount = int(os.getenv('BENCHMARK_MESSAGES', 1000))
+
+# Statement of the same shape as the validator's check of new ids, rolled back so the benchmark leaves the table untouched
+query = 'INSERT INTO "ID" SELECT DISTINCT unnest(%s) ON CONFLICT DO NOTHING RETURNING "ID"'
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv('DATABASE_HOST', 'localhost'),
+        database=os.getenv('DATABASE_NAME'),
+        user=os.getenv('DATABASE_USER', 'postgres'),
+        password=os.getenv('DATABASE_PASSWORD', 'postgres'),
+        port=os.getenv('DATABASE_PORT', '5432')
+    )
+
+def runQuery(connection, index):
+    cursor = connection.cursor()
+    cursor.execute(query, (['benchmark-' + str(index)],))
+    cursor.fetchall()
+    cursor.close()
+    connection.rollback()
+
+def connectPerMessage(index):
+    connection = connect()
+    runQuery(connection, index)
+    connection.close()
+
+def borrowFromPool(pool):
+    def handle(index):
+        connection = pool.getConnection()
+        runQuery(connection, index)
+        pool.putConnection(connection)
+    return handle
+
+def run(name, handle):
+    latencies = []
+
+    for index in range(messageCount):
+        start = time.perf_counter()
+        handle(index)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    print('{:<12} {:>6} messages  mean {:>7.2f} ms  p50 {:>7.2f} ms  p99 {:>7.2f} ms'.format(
+        name, messageCount, sum(latencies) / len(latencies) * 1000,
+        latencies[len(latencies) // 2] * 1000, latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000))
+
+def main():
+    run('connect', connectPerMessage)
+
+    pool = DatabasePool()
+    run('pool', borrowFromPool(pool))
+    pool.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+# Runs the real monitor, validator and notifier against a fake SNKRS feed and fake webhooks, and measures
+# products notified per second and the latency from a thread appearing in the feed to its post arriving.
+#
+# The feed starts with BENCHMARK_THREADS threads, which every sink has to notify as a burst, and then
+# adds BENCHMARK_CHURN new threads and restocks BENCHMARK_RESTOCKS older ones every BENCHMARK_CHURN_INTERVAL
+# seconds for BENCHMARK_DURATION seconds. Webhooks answer after BENCHMARK_WEBHOOK_LATENCY seconds, and
+# answer BENCHMARK_429_RATE of posts with a 429 that asks to wait BENCHMARK_RETRY_AFTER seconds.
+# Discord and Slack webhooks keep their real hosts and reach the fake server through HTTP_PROXY, so every
+# sink formats and paces its posts as it would in production.
+#
+# By default the services share this process, with the broker and database in stand_ins.py, and share
+# one environment, so settings such as CONSUMER_MAX_WORKERS apply to all of them. With
+# BENCHMARK_BACKEND=local every service runs as its own process against the broker and database
+# configured by PIPELINE_HOST and DATABASE_*, e.g. the ones started by backend/docker-compose.yml.
+# The database must have no webhooks of its own, or they would be notified too.
+#
+# Exits with status 1 if the burst is slower than BENCHMARK_MIN_RATE products per second or the p99
+# latency of new threads is above BENCHMARK_MAX_P99 seconds, for whichever of them are set.
+#   python3 end_to_end_benchmark.py
+#   BENCHMARK_BACKEND=local PIPELINE_HOST=localhost DATABASE_NAME=benchmark python3 end_to_end_benchmark.py
+import os
+import sys
+import json
+import time
+import random
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+benchmarkDirectory = os.path.dirname(os.path.abspath(__file__))
+serviceDirectories = { service: os.path.join(benchmarkDirectory, '..', service) for service in ('common', 'monitor', 'validator', 'notifier') }
+for directory in serviceDirectories.values():
+    sys.path.append(directory)
+import trace_metrics
+
+backend = os.getenv('BENCHMARK_BACKEND', 'stand-in')
+threadCount = int(os.getenv('BENCHMARK_THREADS', 200))
+pageSize = int(os.getenv('BENCHMARK_PAGE_SIZE', 50))
+churn = int(os.getenv('BENCHMARK_CHURN', 5))
+restocks = int(os.getenv('BENCHMARK_RESTOCKS', 2))
+churnInterval = float(os.getenv('BENCHMARK_CHURN_INTERVAL', 1))
+duration = float(os.getenv('BENCHMARK_DURATION', 30))
+drainTime = float(os.getenv('BENCHMARK_DRAIN', 15))
+webhookLatency = float(os.getenv('BENCHMARK_WEBHOOK_LATENCY', 0.05))
+rateLimitedShare = float(os.getenv('BENCHMARK_429_RATE', 0.02))
+retryAfter = float(os.getenv('BENCHMARK_RETRY_AFTER', 0.5))
+webhooksPerSink = int(os.getenv('BENCHMARK_WEBHOOKS', 1))
+sinkNames = [name.strip() for name in os.getenv('BENCHMARK_SINKS', 'discord,slack,http').split(',') if name.strip()]
+metricsPortBase = int(os.getenv('BENCHMARK_METRICS_PORT', 19100))
+verbose = os.getenv('BENCHMARK_VERBOSE', 'false').lower() == 'true'
+minRate = float(os.getenv('BENCHMARK_MIN_RATE', 0))
+maxP99 = float(os.getenv('BENCHMARK_MAX_P99', 0))
+
+# Ids are unique to the run, so products of earlier runs in a local database are not taken as known
+runId = str(int(time.time()))
+
+# SNKRS feed, newest thread first, that changes every churnInterval seconds.
+# Remembers when every version of every thread went live, by title
+class FakeFeed:
+    def __init__(self):
+        self.threads = []
+        self.versions = {}
+        self.revision = 0
+        self.created = 0
+        self.lock = threading.Lock()
+        self.baseUrl = None
+
+        for index in range(threadCount):
+            self.threads.append(self.createThread())
+
+    def createThread(self):
+        index = self.created
+        self.created += 1
+
+        return {
+            'id': 'benchmark-' + runId + '-' + str(index),
+            'seoTitle': 'Benchmark Sneaker ' + str(index),
+            'seoSlug': 'benchmark-sneaker-' + str(index),
+            'imageUrl': None,
+            'publishedDate': time.strftime('%Y-%m-%dT%H:%M:%S.000', time.gmtime()),
+            'product': {
+                'style': 'BM' + str(index // 1000).zfill(4),
+                'colorCode': str(index % 1000).zfill(3),
+                'startSellDate': '2020-01-17T15:00:00.000',
+                'publishType': 'LAUNCH',
+                'price': { 'currentRetailPrice': 170 },
+                'skus': [{ 'id': str(size), 'localizedSize': 'M ' + str(size) + ' / W ' + str(size + 1.5) } for size in range(7, 12)]
+            }
+        }
+
+    # Publishes the initial threads, e.g. once the services were started
+    def start(self, baseUrl):
+        now = time.time()
+        with self.lock:
+            self.baseUrl = baseUrl
+            for thread in self.threads:
+                thread['imageUrl'] = baseUrl + '/images/' + thread['id'] + '.png'
+                self.versions[thread['seoTitle']] = [(now, 'initial')]
+            self.revision += 1
+
+    # Adds new threads in front of the feed, dropping the oldest, and adds a size to some older threads.
+    # Threads are only restocked once their last version was posted to every webhook, so every post can be
+    # attributed to the version it was sent for
+    def change(self, isNotified):
+        now = time.time()
+        with self.lock:
+            for index in range(churn):
+                thread = self.createThread()
+                thread['imageUrl'] = self.baseUrl + '/images/' + thread['id'] + '.png'
+                self.threads.insert(0, thread)
+                self.versions[thread['seoTitle']] = [(now, 'new')]
+            del self.threads[threadCount:]
+
+            candidates = [thread for thread in self.threads if isNotified(thread['seoTitle'], len(self.versions[thread['seoTitle']]) - 1)]
+            for thread in random.sample(candidates, min(restocks, len(candidates))):
+                skus = thread['product']['skus']
+                size = int(skus[-1]['id']) + 1
+                skus.append({ 'id': str(size), 'localizedSize': 'M ' + str(size) + ' / W ' + str(size + 1.5) })
+                self.versions[thread['seoTitle']].append((now, 'restock'))
+
+            self.revision += 1
+
+    def getPage(self, offset):
+        with self.lock:
+            return self.revision, json.dumps({ 'pages': { 'next': '' }, 'threads': self.threads[offset:offset + pageSize] }).encode('utf-8')
+
+    # Returns (index, time it went live, kind) of the latest version of a thread, or None if it is not in the feed
+    def getVersion(self, title):
+        with self.lock:
+            versions = self.versions.get(title)
+            if versions is None:
+                return None
+            return (len(versions) - 1,) + versions[-1]
+
+    def countVersions(self):
+        with self.lock:
+            counts = {}
+            for versions in self.versions.values():
+                for liveAt, kind in versions:
+                    counts[kind] = counts.get(kind, 0) + 1
+            return counts
+
+feed = FakeFeed()
+
+# Latency of every version of every thread that was posted, and posts that could not be attributed, by sink
+class Results:
+    def __init__(self):
+        self.webhooks = []
+        self.latencies = {}
+        self.postedAt = {}
+        self.counters = {}
+        self.notified = {}
+        self.lock = threading.Lock()
+
+    # Attributes items of a post to the latest version of their threads. Items of a version that was already
+    # posted to the same webhook count as duplicates
+    def record(self, sink, webhook, titles, now):
+        versions = [(title, feed.getVersion(title)) for title in titles]
+
+        with self.lock:
+            self.count(sink, 'posts')
+
+            for title, version in versions:
+                if version is None:
+                    self.count(sink, 'unknown')
+                    continue
+
+                index, liveAt, kind = version
+                key = (webhook, title)
+                if self.notified.get(key, -1) >= index:
+                    self.count(sink, 'duplicates')
+                    continue
+
+                self.notified[key] = index
+                self.latencies.setdefault((sink, kind), []).append(now - liveAt)
+                self.postedAt.setdefault((sink, kind), []).append(now)
+
+    # Returns true if version of a thread was posted to every webhook
+    def isNotified(self, title, index):
+        with self.lock:
+            return all(self.notified.get((webhook, title), -1) >= index for webhook in self.webhooks)
+
+    def count(self, sink, counter):
+        counters = self.counters.setdefault(sink, {})
+        counters[counter] = counters.get(counter, 0) + 1
+
+    def countRateLimited(self, sink):
+        with self.lock:
+            self.count(sink, 'rateLimited')
+
+results = Results()
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    # Answers pages of the feed, with an ETag so unchanged pages are short-circuited, and product pages
+    # and images for the url checks of the notifier
+    def respond(self, withBody):
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path.startswith('/product_feed/'):
+            offset = int(dict(urllib.parse.parse_qsl(url.query)).get('offset', 0))
+            revision, body = feed.getPage(offset)
+            etag = '"' + str(revision) + '-' + str(offset) + '"'
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'application/json')
+        elif url.path.startswith('/images/'):
+            body = b''
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+        elif url.path.startswith('/launch/t/'):
+            body = b''
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+        else:
+            self.send_error(404)
+            return
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Answers posts of every sink. Discord and Slack posts arrive through the proxy, with their full url as path
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urllib.parse.urlsplit(self.path)
+        webhook = getWebhookKey(url.hostname or self.headers.get('Host', '').split(':')[0], url.path)
+        time.sleep(webhookLatency)
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = {}
+
+        if 'embeds' in data:
+            sink, items, titleKey = 'discord', data['embeds'], 'title'
+        elif 'attachments' in data:
+            sink, items, titleKey = 'slack', data['attachments'], 'title'
+        else:
+            sink, items, titleKey = 'http', data.get('products', []), 'title'
+
+        if random.random() < rateLimitedShare:
+            results.countRateLimited(sink)
+            self.reply(429, json.dumps({ 'message': 'You are being rate limited.', 'retry_after': retryAfter, 'global': False }).encode('utf-8'),
+                { 'Retry-After': str(retryAfter), 'Content-Type': 'application/json' })
+            return
+
+        results.record(sink, webhook, [item.get(titleKey) for item in items], time.time())
+        self.reply(204 if sink == 'discord' else 200, b'' if sink == 'discord' else b'ok')
+
+    def reply(self, status, body, headers = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+# Returns webhooks of every sink. Discord and Slack webhooks are matched to their sinks by host
+def getWebhooks(webhookPort):
+    webhooks = []
+    for index in range(webhooksPerSink):
+        if 'discord' in sinkNames:
+            webhooks.append('http://discord.com/api/webhooks/' + str(index) + '/benchmark')
+        if 'slack' in sinkNames:
+            webhooks.append('http://hooks.slack.com/services/benchmark/' + str(index))
+        if 'http' in sinkNames:
+            webhooks.append('http://127.0.0.1:' + str(webhookPort) + '/webhooks/' + str(index))
+    return webhooks
+
+def getWebhookKey(host, path):
+    return host + path
+
+# Returns environment every service shares, pointed at the fake feed and webhooks
+def getEnvironment(feedPort, webhookPort):
+    environment = {
+        'TARGET_URL': 'http://127.0.0.1:' + str(feedPort) + '/product_feed/threads/v2/?anchor=0&count=' + str(pageSize),
+        'PAGE_SIZE': str(pageSize),
+        'PAGE_DEPTH': str((threadCount + pageSize - 1) // pageSize),
+        'URL_BASE': 'http://127.0.0.1:' + str(feedPort) + '/launch/t/',
+        'REQUEST_FREQUENCY': os.getenv('REQUEST_FREQUENCY', '1'),
+        'REQUEST_FREQUENCY_MIN': os.getenv('REQUEST_FREQUENCY_MIN', '1'),
+        'REQUEST_FREQUENCY_MAX': os.getenv('REQUEST_FREQUENCY_MAX', '1'),
+        'NOTIFIER_SINKS': ','.join(sinkNames),
+        'HTTP_PROXY': 'http://127.0.0.1:' + str(webhookPort),
+        'NO_PROXY': '127.0.0.1,localhost',
+        'PYTHONUNBUFFERED': '1'
+    }
+    environment['http_proxy'] = environment['HTTP_PROXY']
+    environment['no_proxy'] = environment['NO_PROXY']
+    return environment
+
+# Queues of every service, which differ in a shared environment. Every core reads its queues into module globals
+# when it is imported, so the environment is switched to the next service's queues right after
+serviceQueues = {
+    'monitor': { 'OUTGOING_QUEUE': 'benchmarkCheckDatabase' },
+    'validator': { 'INCOMING_QUEUE': 'benchmarkCheckDatabase', 'OUTGOING_QUEUE': 'benchmarkNotifyWebhooks' },
+    'notifier': { 'INCOMING_QUEUE': 'benchmarkNotifyWebhooks', 'WEBHOOK_RETRY_QUEUE': 'benchmarkWebhookRetries' }
+}
+
+# Imports every service into this process on top of the stand-ins, each with its own queues, and runs them on threads.
+# Returns function that returns metrics snapshots of the services
+def startInProcess(environment, webhooks):
+    import stand_ins
+    stand_ins.install(webhooks)
+    os.environ.update(environment)
+
+    modules = []
+    for service in ('notifier', 'validator', 'monitor'):
+        for name in ('INCOMING_QUEUE', 'OUTGOING_QUEUE'):
+            os.environ.pop(name, None)
+        os.environ.update(serviceQueues[service])
+
+        module = __import__(service + '_core')
+        threading.Thread(target = module.main, name = service, daemon = True).start()
+        modules.append(module)
+
+    return lambda: [module.metrics.snapshot() for module in modules]
+
+# Starts every service as its own process against the local broker and database, with its webhooks in the database.
+# Returns function that returns metrics snapshots of the services, and the processes
+def startLocal(environment, webhooks):
+    import psycopg2
+    import database_pool
+
+    connection = psycopg2.connect(**database_pool.getConnectionParameters())
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM "WebHooks"')
+    if cursor.fetchone()[0] > 0:
+        connection.close()
+        raise SystemExit('Database already has webhooks, which would be notified too. Use an empty database')
+
+    for webhook in webhooks:
+        cursor.execute('INSERT INTO "WebHooks" VALUES (%(webhook)s)', { 'webhook': webhook })
+    connection.commit()
+    connection.close()
+
+    processes = []
+    targets = []
+    for index, service in enumerate(('notifier', 'validator', 'monitor')):
+        port = metricsPortBase + index + 1
+        serviceEnvironment = dict(os.environ, **environment)
+        serviceEnvironment.update(serviceQueues[service])
+        serviceEnvironment['METRICS_PORT'] = str(port)
+        serviceEnvironment['PYTHONPATH'] = serviceDirectories['common']
+
+        processes.append(subprocess.Popen([sys.executable, service + '_core.py'], cwd = serviceDirectories[service], env = serviceEnvironment,
+            stdout = None if verbose else subprocess.DEVNULL, stderr = None if verbose else subprocess.DEVNULL))
+        targets.append('http://127.0.0.1:' + str(port))
+
+    return lambda: [snapshot for snapshot in (readMetrics(target) for target in targets) if snapshot is not None], processes
+
+# Removes webhooks and products of the run from the local database
+def cleanLocal(webhooks):
+    import psycopg2
+    import database_pool
+
+    connection = psycopg2.connect(**database_pool.getConnectionParameters())
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM "WebHooks" WHERE "Discord" = ANY(%(webhooks)s)', { 'webhooks': webhooks })
+    cursor.execute('DELETE FROM "ID" WHERE "ID" LIKE %(prefix)s', { 'prefix': 'benchmark-' + runId + '-%' })
+    cursor.execute('DELETE FROM "ProductState" WHERE "ID" LIKE %(prefix)s', { 'prefix': 'benchmark-' + runId + '-%' })
+    connection.commit()
+    connection.close()
+
+def readMetrics(target):
+    try:
+        with urllib.request.urlopen(target + '/metrics.json', timeout = 2) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+# Returns value at quantile of sorted values
+def getPercentile(values, quantile):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+def formatSeconds(seconds):
+    return '{:>8.2f}s'.format(seconds) if seconds is not None else '        -'
+
+def report(console, startedAt, versions, snapshots):
+    print('{} threads, {} new and {} restocked over {:.0f}s, {} backend'.format(
+        versions.get('initial', 0), versions.get('new', 0), versions.get('restock', 0), duration, backend), file = console)
+    print('{:<8} {:<8} {:>7} {:>8} {:>12} {:>9} {:>9} {:>9}'.format('sink', 'kind', 'posted', 'missed', 'products/s', 'p50', 'p99', 'max'), file = console)
+
+    failures = []
+    with results.lock:
+        for sink in sinkNames:
+            for kind in ('initial', 'new', 'restock'):
+                latencies = sorted(results.latencies.get((sink, kind), []))
+
+                # Rate of the burst is taken over the time until its last post, the others arrive at the pace of the feed
+                rate = None
+                if kind == 'initial' and latencies:
+                    rate = len(latencies) / max(0.001, max(results.postedAt[(sink, kind)]) - startedAt)
+
+                expected = versions.get(kind, 0) * webhooksPerSink
+                print('{:<8} {:<8} {:>7} {:>8} {:>12} {} {} {}'.format(sink, kind, len(latencies), max(0, expected - len(latencies)),
+                    '{:.1f}'.format(rate) if rate is not None else '-',
+                    formatSeconds(getPercentile(latencies, 0.5)), formatSeconds(getPercentile(latencies, 0.99)), formatSeconds(latencies[-1] if latencies else None)), file = console)
+
+                if kind == 'initial' and minRate > 0 and (rate or 0) < minRate:
+                    failures.append('{} burst at {:.1f} products/s is below {:.1f}'.format(sink, rate or 0, minRate))
+                if kind == 'new' and maxP99 > 0 and latencies and getPercentile(latencies, 0.99) > maxP99:
+                    failures.append('{} p99 of new threads at {:.2f}s is above {:.2f}s'.format(sink, getPercentile(latencies, 0.99), maxP99))
+
+            counters = results.counters.get(sink, {})
+            print('{:<8} {} posts, {} rate limited, {} duplicate and {} unknown items'.format(
+                '', counters.get('posts', 0), counters.get('rateLimited', 0), counters.get('duplicates', 0), counters.get('unknown', 0)), file = console)
+
+    # Stages of the trace, as the services measured them
+    merged = trace_metrics.mergeSnapshots(snapshots)
+    if merged['histograms']:
+        print('{:<10} {:<28} {:<16} {:>7} {:>9} {:>9}'.format('service', 'stage', 'labels', 'count', 'p50', 'p99'), file = console)
+        for (service, name, labels), histogram in sorted(merged['histograms'].items()):
+            print('{:<10} {:<28} {:<16} {:>7} {} {}'.format(service, name, ','.join(str(value) for key, value in labels), histogram[2],
+                formatSeconds(trace_metrics.getQuantile(histogram[0], 0.5)), formatSeconds(trace_metrics.getQuantile(histogram[0], 0.99))), file = console)
+
+    return failures
+
+def main():
+    feedServer = serve(FeedHandler)
+    webhookServer = serve(WebhookHandler)
+    environment = getEnvironment(feedServer.server_port, webhookServer.server_port)
+    webhooks = getWebhooks(webhookServer.server_port)
+    results.webhooks = [getWebhookKey(urllib.parse.urlsplit(webhook).hostname, urllib.parse.urlsplit(webhook).path) for webhook in webhooks]
+
+    # Services print a line for every product, which would be measured as well. They keep running
+    # until the benchmark exits, so their output stays discarded and the report is printed to the console
+    console = sys.stdout
+    if not verbose:
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    processes = []
+    try:
+        if backend == 'local':
+            getSnapshots, processes = startLocal(environment, webhooks)
+        else:
+            getSnapshots = startInProcess(environment, webhooks)
+
+        startedAt = time.time()
+        feed.start('http://127.0.0.1:' + str(feedServer.server_port))
+
+        while time.time() - startedAt < duration:
+            time.sleep(churnInterval)
+            feed.change(results.isNotified)
+
+        # Feed stops changing, so products still in flight can arrive
+        time.sleep(drainTime)
+        snapshots = getSnapshots()
+    finally:
+        for process in processes:
+            process.terminate()
+        if backend == 'local':
+            cleanLocal(webhooks)
+
+    failures = report(console, startedAt, feed.countVersions(), snapshots)
+    for failure in failures:
+        print('FAILED: ' + failure, file = console)
+
+    console.flush()
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
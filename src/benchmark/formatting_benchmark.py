@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Measures notifications formatted per second for a feed of BENCHMARK_FEED_SIZE products:
+#   cold      every size string parsed again and every product formatted from scratch
+#   memoized  size strings remembered from earlier products, every product formatted again
+#   cached    products notified again unchanged, answered by the render cache
+# Products have no url or image, so no url is checked over the network.
+#   python3 formatting_benchmark.py
+import os
+import sys
+import time
+
+os.environ.setdefault('URL_BASE', 'https://nike.com/launch/t/')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notifier'))
+import formatNotification
+import notifier_custom
+from product_record import ProductRecord
+
+iterations = int(os.getenv('BENCHMARK_ITERATIONS', 200))
+feedSize = int(os.getenv('BENCHMARK_FEED_SIZE', 50))
+
+def feed():
+    return [ProductRecord(
+        id = 'thread-' + str(index),
+        title = 'Air Jordan ' + str(index),
+        styleCode = 'CD0461-' + str(100 + index),
+        startSellDate = '2020-01-17T15:00:00.000',
+        publishType = 'LAUNCH',
+        price = 170,
+        sizes = ['M ' + str(size) + ' / W ' + str(size + 1.5) for size in range(4, 16)]
+    ) for index in range(feedSize)]
+
+# Returns notifications formatted per second and microseconds per notification
+def run(sink, products, parseSizes, clearRenders):
+    config = formatNotification.storeConfigs[formatNotification.Store.Nike]
+
+    # Products of the feed share their size strings, so the cold case bypasses the size cache entirely
+    # rather than clearing it, which would only make the first product of every iteration parse its sizes
+    memoizedParseSize = config.parseSize
+    if parseSizes:
+        config.parseSize = config.parseSizeUncached
+
+    try:
+        start = time.perf_counter()
+        for index in range(iterations):
+            if clearRenders:
+                sink.renderCache.clear()
+
+            for product in products:
+                sink.render([product])
+        elapsed = time.perf_counter() - start
+    finally:
+        config.parseSize = memoizedParseSize
+
+    count = iterations * len(products)
+    return count / elapsed, elapsed / count * 1000000
+
+def main():
+    products = feed()
+    sink = notifier_custom.DiscordSink()
+    results = []
+
+    # Formatting prints a line per product, which would be measured as well
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for name, parseSizes, clearRenders in (('cold', True, True), ('memoized', False, True), ('cached', False, False)):
+            results.append((name,) + run(sink, products, parseSizes, clearRenders))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for name, rate, micros in results:
+        print('{:<10} {:>10.0f} notifications/s  {:>8.1f} us per notification'.format(name, rate, micros))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Compares peak memory and time-to-first-product of decoding the whole feed with response.json() and
+# formatProductData, against formatProductStream which parses threads while the body is still arriving.
+# Pass recorded feeds as arguments, or a synthetic feed is generated:
+#   python3 parsing_benchmark.py [feed.json ...]
+# Download speed is simulated with BENCHMARK_BANDWIDTH bytes per second (default 5 MB/s).
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+import monitor_custom
+
+chunkSize = 16384
+bandwidth = float(os.getenv('BENCHMARK_BANDWIDTH', 5 * 1024 * 1024))
+syntheticThreads = int(os.getenv('BENCHMARK_THREADS', 2000))
+
+# Writes a feed shaped like the SNKRS content API with the specified number of threads
+def generateFeed(path, threadCount):
+    threads = []
+    for index in range(threadCount):
+        threads.append({
+            'id': 'thread-' + str(index),
+            'seoTitle': 'Air Jordan 1 High OG ' + str(index),
+            'seoSlug': 'air-jordan-1-high-og-' + str(index),
+            'imageUrl': 'https://secure-images.nike.com/is/image/DotCom/555088_' + str(index),
+            'publishedDate': '2020-01-17T15:00:00.000',
+            'description': 'Lorem ipsum dolor sit amet ' * 40,
+            'product': {
+                'style': '555088',
+                'colorCode': str(index % 1000).zfill(3),
+                'startSellDate': '2020-01-17T15:00:00.000',
+                'publishType': 'LAUNCH',
+                'price': { 'currentRetailPrice': 170 },
+                'skus': [{ 'id': str(size), 'localizedSize': 'M ' + str(size) + ' / W ' + str(size + 1.5) } for size in range(4, 16)]
+            }
+        })
+
+    with open(path, 'w') as file:
+        json.dump({ 'pages': { 'next': '' }, 'threads': threads }, file)
+
+# Reads file in chunks at the simulated bandwidth, like response.iter_content would
+def readChunks(path):
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunkSize)
+            if not chunk:
+                return
+            time.sleep(len(chunk) / bandwidth)
+            yield chunk
+
+# Current path: download everything, decode it, then format every thread
+def bufferedPath(path):
+    start = time.perf_counter()
+    body = b''.join(readChunks(path))
+    products = monitor_custom.formatProductData(json.loads(body))
+    return time.perf_counter() - start, time.perf_counter() - start, len(products)
+
+# Streaming path: format each thread as soon as it has been received
+def streamingPath(path):
+    start = time.perf_counter()
+    firstProduct = None
+    count = 0
+
+    for product in monitor_custom.formatProductStream(readChunks(path)):
+        if firstProduct is None:
+            firstProduct = time.perf_counter() - start
+        count += 1
+
+    return firstProduct, time.perf_counter() - start, count
+
+def run(name, function, path):
+    tracemalloc.start()
+    firstProduct, total, count = function(path)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{:<10} {:>6} products  first {:>8.1f} ms  total {:>8.1f} ms  peak {:>8.2f} MB'.format(
+        name, count, firstProduct * 1000, total * 1000, peak / (1024 * 1024)))
+
+def main():
+    paths = sys.argv[1:]
+    temporaryPath = None
+
+    if len(paths) == 0:
+        temporaryPath = os.path.join(tempfile.gettempdir(), 'synthetic_feed.json')
+        generateFeed(temporaryPath, syntheticThreads)
+        paths = [temporaryPath]
+
+    for path in paths:
+        print(path + ' (' + '{:.2f}'.format(os.path.getsize(path) / (1024 * 1024)) + ' MB)')
+        run('buffered', bufferedPath, path)
+        run('streaming', streamingPath, path)
+
+    if temporaryPath is not None:
+        os.remove(temporaryPath)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Compares messages/sec of the old connect-per-publish path against the shared PipelineClient.
+# Requires a running pipeline, e.g. the one started by backend/docker-compose.yml:
+#   PIPELINE_HOST=localhost python3 pipeline_benchmark.py
+import os
+import sys
+import json
+import time
+import pika
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_client import PipelineClient
+
+queue = os.getenv('BENCHMARK_QUEUE', 'pipelineBenchmark')
+messageCount = int(os.getenv('BENCHMARK_MESSAGES', 1000))
+host = os.getenv('PIPELINE_HOST', 'localhost')
+
+# Product shaped like the ones produced by monitor_custom.formatProductData
+sampleProduct = {
+    'id': '6c8b9f43-1f6b-4b0e-9b56-2a1f0d1e6e3c',
+    'title': 'air-jordan-1-high-og-royal-toe',
+    'image': 'https://secure-images.nike.com/is/image/DotCom/555088_041_A_PREM',
+    'url': 'air-jordan-1-high-og-royal-toe',
+    'styleCode': '555088-041',
+    'startSellDate': '2020-01-17T15:00:00.000',
+    'publishType': 'LAUNCH',
+    'price': 170,
+    'sizes': ['M 7 / W 8.5', 'M 7.5 / W 9', 'M 8 / W 9.5', 'M 8.5 / W 10', 'M 9 / W 10.5']
+}
+
+# Old path: open a connection, declare the queue, publish, and close for every message
+def connectPerPublish(bodies):
+    for body in bodies:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host = host))
+        channel = connection.channel()
+        channel.queue_declare(queue = queue, durable = True)
+        channel.basic_publish(
+            exchange = '',
+            routing_key = queue,
+            body = body,
+            properties = pika.BasicProperties(delivery_mode = 2)
+        )
+        connection.close()
+
+# New path, one confirmed message at a time (what the validator does)
+def persistentSingle(bodies):
+    client = PipelineClient(host = host)
+    for body in bodies:
+        client.publish(queue, body)
+    client.close()
+
+# New path, confirmed in batches (what the monitor does)
+def persistentBatch(bodies):
+    client = PipelineClient(host = host)
+    client.publishBatch(queue, bodies)
+    client.close()
+
+def purge():
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host = host))
+    channel = connection.channel()
+    channel.queue_declare(queue = queue, durable = True)
+    channel.queue_purge(queue = queue)
+    connection.close()
+
+def run(name, function, bodies):
+    purge()
+    start = time.perf_counter()
+    function(bodies)
+    elapsed = time.perf_counter() - start
+    print('{:<20} {:>8} messages {:>8.2f} s {:>10.1f} msg/s'.format(name, len(bodies), elapsed, len(bodies) / elapsed))
+
+def main():
+    bodies = [json.dumps(sampleProduct)] * messageCount
+
+    run('connect-per-publish', connectPerPublish, bodies)
+    run('persistent-single', persistentSingle, bodies)
+    run('persistent-batch', persistentBatch, bodies)
+
+    purge()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Counts database queries the validator makes per 10k messages, with and without the seen id cache.
+# Messages repeat the products of a feed of BENCHMARK_FEED_SIZE threads, with a new thread replacing
+# the oldest one every BENCHMARK_CHURN messages, like a monitor without delta publishing would send.
+#   python3 seen_cache_benchmark.py
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'validator'))
+import validator_custom
+from seen_cache import SeenCache
+from product_record import ProductRecord
+
+messageCount = int(os.getenv('BENCHMARK_MESSAGES', 10000))
+feedSize = int(os.getenv('BENCHMARK_FEED_SIZE', 50))
+churn = int(os.getenv('BENCHMARK_CHURN', 200))
+cacheSize = int(os.getenv('SEEN_CACHE_SIZE', 10000))
+
+# In-memory stand-in for the "ID" table that counts the statements it runs
+class CountingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = None
+
+    def execute(self, query, parameters = None):
+        self.connection.queries += 1
+        ids = self.connection.ids
+
+        if not query.startswith('INSERT INTO "ID"'):
+            raise ValueError("Unexpected query " + query)
+
+        self.result = [(id,) for id in set(parameters['ids']) if id not in ids]
+        ids.update(parameters['ids'])
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+class CountingConnection:
+    def __init__(self):
+        self.ids = set()
+        self.queries = 0
+
+    def cursor(self):
+        return CountingCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+# Yields the product of every message
+def messages():
+    feed = deque(ProductRecord(id = 'thread-' + str(index)) for index in range(feedSize))
+    nextId = feedSize
+
+    for index in range(messageCount):
+        if index > 0 and index % churn == 0:
+            feed.popleft()
+            feed.append(ProductRecord(id = 'thread-' + str(nextId)))
+            nextId += 1
+
+        yield feed[index % len(feed)]
+
+def run(name, seenIds):
+    connection = CountingConnection()
+    notifications = 0
+
+    start = time.perf_counter()
+    for product in messages():
+        if validator_custom.shouldNotify(product, connection, seenIds):
+            notifications += 1
+    elapsed = time.perf_counter() - start
+
+    print('{:<10} {:>6} messages {:>6} notifications {:>7} queries ({:.0f} per 10k) {:>8.1f} ms'.format(
+        name, messageCount, notifications, connection.queries, connection.queries * 10000 / messageCount, elapsed * 1000))
+
+    if seenIds is not None:
+        seenIds.printCounters()
+
+def main():
+    run('no cache', None)
+    run('cache', SeenCache(capacity = cacheSize))
+
+if __name__ == '__main__':
+    main()
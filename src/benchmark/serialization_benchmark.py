@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Compares CPU time and message size of the JSON and packed product encodings.
+#   python3 serialization_benchmark.py
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import product_record
+from product_record import ProductRecord
+
+iterations = int(os.getenv('BENCHMARK_ITERATIONS', 20000))
+
+# Message properties as they arrive in a consumer callback
+class Properties:
+    def __init__(self, contentType):
+        self.content_type = contentType
+        self.headers = product_record.getHeaders()
+
+# Returns a release and a non-release product, as produced by monitor_custom.formatThread
+def sampleProducts():
+    release = ProductRecord(
+        id = '6c8b9f43-1f6b-4b0e-9b56-2a1f0d1e6e3c',
+        title = 'air-jordan-1-high-og-royal-toe',
+        image = 'https://secure-images.nike.com/is/image/DotCom/555088_041_A_PREM',
+        url = 'air-jordan-1-high-og-royal-toe',
+        styleCode = '555088-041',
+        startSellDate = '2020-01-17T15:00:00.000',
+        publishType = 'LAUNCH',
+        price = 170,
+        sizes = ['M ' + str(size) + ' / W ' + str(size + 1.5) for size in range(4, 16)]
+    )
+    story = ProductRecord(
+        id = '0b0f8b2e-4c1e-4a53-8a59-5d1f0a4f7c11',
+        title = 'behind-the-design-air-max',
+        image = 'https://secure-images.nike.com/is/image/DotCom/story',
+        url = 'behind-the-design-air-max',
+        styleCode = '999999-999'
+    )
+    return [release, story]
+
+def run(name, contentType, products):
+    properties = Properties(contentType)
+    bodies = [product_record.encodeProduct(product, contentType) for product in products]
+    size = sum(len(body) for body in bodies) / len(bodies)
+
+    start = time.perf_counter()
+    for index in range(iterations):
+        for product in products:
+            product_record.encodeProduct(product, contentType)
+    encodeTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(iterations):
+        for body in bodies:
+            product_record.decodeProduct(body, properties)
+    decodeTime = time.perf_counter() - start
+
+    count = iterations * len(products)
+    print('{:<8} {:>7.1f} bytes/msg  encode {:>6.2f} us/msg  decode {:>6.2f} us/msg'.format(
+        name, size, encodeTime / count * 1e6, decodeTime / count * 1e6))
+
+def main():
+    products = sampleProducts()
+
+    # Encodings must round trip before they are worth timing
+    for contentType in (product_record.JSON_CONTENT_TYPE, product_record.PACKED_CONTENT_TYPE):
+        for product in products:
+            decoded = product_record.decodeProduct(product_record.encodeProduct(product, contentType), Properties(contentType))
+            assert decoded == product, contentType
+
+    run('json', product_record.JSON_CONTENT_TYPE, products)
+    run('packed', product_record.PACKED_CONTENT_TYPE, products)
+
+if __name__ == '__main__':
+    main()
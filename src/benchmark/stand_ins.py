@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+# In-process stand-ins for RabbitMQ and Postgres, so the real services can be benchmarked without either.
+# The broker stands in for pika's BlockingConnection underneath the real PipelineClient and ConsumerPool,
+# including prefetch, acks, transactions and delay queues that dead-letter once their TTL expired.
+# The database answers exactly the statements the validator and the notifier send, and fails on any other.
+# Call install() before importing a service, so its module level clients are created from the stand-ins.
+import os
+import sys
+import time
+import heapq
+import threading
+import collections
+import pika
+import psycopg2
+import psycopg2.extensions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import pipeline_client
+import database_pool
+
+# Queues and delay queues of every client in the process
+class StandInBroker:
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.queueArguments = {}
+
+        # (expiresAt, sequence, queue, body, properties) of messages waiting in a queue with a message TTL
+        self.delayed = []
+        self.sequence = 0
+
+        # Every channel waits on the same condition, which is notified by every publish, ack and callback
+        self.condition = threading.Condition()
+
+    def declare(self, queue, arguments = None):
+        with self.condition:
+            self.queues[queue]
+            if arguments:
+                self.queueArguments[queue] = arguments
+
+    # Adds messages to a queue, or to the delay heap if the queue has a message TTL. Properties are encoded
+    # and decoded as they would be on the wire, so the consumer gets a copy and unencodable headers fail here
+    def publish(self, messages):
+        with self.condition:
+            for queue, body, properties in messages:
+                properties = copyProperties(properties)
+                arguments = self.queueArguments.get(queue) or {}
+
+                if 'x-message-ttl' in arguments and 'x-dead-letter-routing-key' in arguments:
+                    self.sequence += 1
+                    heapq.heappush(self.delayed, (time.time() + arguments['x-message-ttl'] / 1000.0, self.sequence,
+                        arguments['x-dead-letter-routing-key'], body, properties))
+                else:
+                    self.queues[queue].append((body, properties, False))
+
+            self.condition.notify_all()
+
+    # Moves expired messages of delay queues into their dead letter queues.
+    # Returns seconds until the next one expires, or None if none is waiting. Called with the condition held
+    def expire(self):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            expiresAt, sequence, queue, body, properties = heapq.heappop(self.delayed)
+            self.queues[queue].append((body, properties, False))
+
+        return self.delayed[0][0] - now if self.delayed else None
+
+    # Puts unacknowledged messages back at the front of their queues, marked as redelivered
+    def requeue(self, deliveries):
+        with self.condition:
+            for queue, body, properties in reversed(deliveries):
+                self.queues[queue].appendleft((body, properties, True))
+            self.condition.notify_all()
+
+    def messageCount(self, queue):
+        with self.condition:
+            return len(self.queues[queue])
+
+# Stands in for pika.BlockingConnection. Callbacks added from other threads are run by the thread
+# that consumes on one of its channels, as in pika
+class StandInConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.callbacks = collections.deque()
+        self.channelCount = 0
+
+    def channel(self):
+        self.channelCount += 1
+        return StandInChannel(self, self.channelCount)
+
+    def add_callback_threadsafe(self, callback):
+        with self.broker.condition:
+            self.callbacks.append(callback)
+            self.broker.condition.notify_all()
+
+    def process_data_events(self, time_limit = 0):
+        self.runCallbacks()
+        time.sleep(time_limit)
+
+    def runCallbacks(self):
+        while True:
+            with self.broker.condition:
+                if not self.callbacks:
+                    return
+                callback = self.callbacks.popleft()
+            callback()
+
+    def sleep(self, seconds):
+        deadline = time.time() + seconds
+        while True:
+            self.runCallbacks()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            with self.broker.condition:
+                self.broker.condition.wait(min(remaining, 0.1))
+
+    def close(self):
+        self.is_open = False
+
+# Stands in for a pika channel of a BlockingConnection
+class StandInChannel:
+    def __init__(self, connection, channelNumber):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channelNumber
+        self.is_open = True
+
+        self.transaction = None
+        self.prefetchCount = 0
+
+        # Queue and callback by consumer tag, and (queue, body, properties) of unacknowledged messages by delivery tag
+        self.consumers = collections.OrderedDict()
+        self.unacked = collections.OrderedDict()
+        self.deliveryTag = 0
+
+    @property
+    def consumer_tags(self):
+        return list(self.consumers.keys())
+
+    def tx_select(self):
+        self.transaction = []
+
+    def tx_commit(self):
+        messages, self.transaction = self.transaction, []
+        self.broker.publish(messages)
+
+    def queue_declare(self, queue, durable = False, arguments = None, passive = False):
+        if not passive:
+            self.broker.declare(queue, arguments)
+
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeclareOk(queue, self.broker.messageCount(queue), len(self.consumers)))
+
+    def exchange_declare(self, exchange, exchange_type = None, durable = False):
+        raise NotImplementedError("Exchanges are not supported by the stand-in broker, unset SHARD_EXCHANGE")
+
+    # Every published message is routed to a queue, so none is ever returned
+    def add_on_return_callback(self, callback):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties = None, mandatory = False):
+        if exchange != '':
+            raise NotImplementedError("Exchanges are not supported by the stand-in broker, unset SHARD_EXCHANGE")
+
+        message = (routing_key, body, properties or pika.BasicProperties())
+        if self.transaction is not None:
+            self.transaction.append(message)
+        else:
+            self.broker.publish([message])
+
+    def basic_qos(self, prefetch_count = 0):
+        self.prefetchCount = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.broker.declare(queue)
+        consumerTag = 'ctag' + str(self.channel_number) + '.' + str(len(self.consumers) + 1)
+        self.consumers[consumerTag] = (queue, on_message_callback)
+        return consumerTag
+
+    def basic_cancel(self, consumer_tag):
+        self.consumers.pop(consumer_tag, None)
+
+    def basic_ack(self, delivery_tag, multiple = False):
+        self.settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag, multiple = False, requeue = True):
+        deliveries = self.settle(delivery_tag, multiple)
+        if requeue:
+            self.broker.requeue(deliveries)
+
+    # Forgets acknowledged messages, and returns them
+    def settle(self, deliveryTag, multiple):
+        tags = [tag for tag in self.unacked if tag <= deliveryTag] if multiple else [deliveryTag]
+        deliveries = [self.unacked.pop(tag) for tag in tags if tag in self.unacked]
+
+        with self.broker.condition:
+            self.broker.condition.notify_all()
+
+        return deliveries
+
+    # Delivers messages to consumers of this channel, at most prefetchCount unacknowledged at once,
+    # and runs callbacks of the connection in between, until every consumer was cancelled or channel closed
+    def start_consuming(self):
+        while self.is_open and self.consumers:
+            self.connection.runCallbacks()
+
+            delivery = None
+            with self.broker.condition:
+                nextExpiry = self.broker.expire()
+
+                if self.prefetchCount <= 0 or len(self.unacked) < self.prefetchCount:
+                    for consumerTag, (queue, callback) in list(self.consumers.items()):
+                        if self.broker.queues[queue]:
+                            body, properties, redelivered = self.broker.queues[queue].popleft()
+                            self.deliveryTag += 1
+                            self.unacked[self.deliveryTag] = (queue, body, properties)
+                            method = pika.spec.Basic.Deliver(consumerTag, self.deliveryTag, redelivered, '', queue)
+                            delivery = (callback, method, properties, body)
+                            break
+
+                if delivery is None and not self.connection.callbacks:
+                    self.broker.condition.wait(min(nextExpiry, 0.1) if nextExpiry is not None else 0.1)
+
+            if delivery is not None:
+                callback, method, properties, body = delivery
+                callback(self, method, properties, body)
+
+    def close(self):
+        self.is_open = False
+        self.broker.requeue(list(self.unacked.values()))
+        self.unacked.clear()
+        self.consumers.clear()
+
+# PipelineClient that connects to the stand-in broker instead of RabbitMQ
+class StandInPipelineClient(pipeline_client.PipelineClient):
+    broker = None
+
+    def connect(self):
+        if self.connection is not None and self.connection.is_open:
+            return self.connection
+
+        self.connection = StandInConnection(self.broker)
+        self.channel = None
+        self.declaredQueues = set()
+        self.declaredExchanges = set()
+
+        return self.connection
+
+# Tables of the stand-in database
+class StandInDatabase:
+    def __init__(self, webhooks = None):
+        self.ids = set()
+        self.productStates = {}
+        self.webhooks = list(webhooks or [])
+
+        # Held from a SELECT ... FOR UPDATE until the transaction ends, standing in for the row locks
+        self.rowLock = threading.Lock()
+        self.lock = threading.Lock()
+
+# Stands in for a psycopg2 connection
+class StandInDatabaseConnection:
+    encoding = 'UTF8'
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.notifies = []
+        self.holdsRows = False
+
+        # Only opened for connections that listen, so select() can wait on them
+        self.readFd = None
+        self.writeFd = None
+
+    def cursor(self, name = None):
+        return StandInCursor(self)
+
+    def commit(self):
+        self.releaseRows()
+
+    def rollback(self):
+        self.releaseRows()
+
+    def releaseRows(self):
+        if self.holdsRows:
+            self.holdsRows = False
+            self.database.rowLock.release()
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_INTRANS if self.holdsRows else psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def set_isolation_level(self, level):
+        pass
+
+    # Listening connections are never notified, the webhooks of the benchmark do not change
+    def fileno(self):
+        if self.readFd is None:
+            self.readFd, self.writeFd = os.pipe()
+        return self.readFd
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.releaseRows()
+        self.closed = 1
+        if self.readFd is not None:
+            os.close(self.readFd)
+            os.close(self.writeFd)
+            self.readFd = None
+
+# Stands in for a psycopg2 cursor, answering the statements of validator_custom, seen_cache, product_state
+# and webhook_registry. Rows given to psycopg2.extras.execute_values are collected through mogrify
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.database = connection.database
+        self.rows = []
+        self.values = []
+        self.itersize = 2000
+
+    def mogrify(self, template, values):
+        self.values.append(tuple(values))
+        return b''
+
+    def execute(self, statement, parameters = None):
+        if isinstance(statement, bytes):
+            statement = statement.decode('utf-8')
+
+        database = self.database
+        self.rows = []
+
+        if statement.startswith(('SELECT 1', 'CREATE ', 'LISTEN ')):
+            return
+
+        if statement.startswith('SELECT "ID", "Digest", "Price"') and 'FOR UPDATE' in statement:
+            if not self.connection.holdsRows:
+                database.rowLock.acquire()
+                self.connection.holdsRows = True
+            with database.lock:
+                self.rows = [(id,) + database.productStates[id] for id in parameters['ids'] if id in database.productStates]
+        elif statement.startswith('INSERT INTO "ID"'):
+            with database.lock:
+                ids = [id for id in dict.fromkeys(parameters['ids']) if id not in database.ids]
+                database.ids.update(ids)
+            self.rows = [(id,) for id in ids]
+        elif statement.startswith('INSERT INTO "ProductState"'):
+            values, self.values = self.values, []
+            with database.lock:
+                for row in values:
+                    database.productStates[row[0]] = tuple(row[1:])
+        elif statement.startswith('SELECT "ID", "Digest" FROM "ProductState"'):
+            with database.lock:
+                self.rows = [(id, state[0]) for id, state in database.productStates.items()]
+        elif statement.startswith('SELECT "ID" FROM "ID"'):
+            with database.lock:
+                self.rows = [(id,) for id in database.ids]
+        elif statement.startswith('SELECT "Discord" FROM "WebHooks"'):
+            with database.lock:
+                self.rows = [(webhook,) for webhook in database.webhooks]
+        else:
+            raise psycopg2.ProgrammingError("Statement is not supported by the stand-in database: " + statement[:80])
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+# DatabasePool that hands out connections to the stand-in database instead of Postgres
+class StandInDatabasePool:
+    database = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getConnection(self):
+        return StandInDatabaseConnection(self.database)
+
+    def putConnection(self, connection):
+        if connection is not None:
+            connection.releaseRows()
+
+    def connect(self):
+        return StandInDatabaseConnection(self.database)
+
+    def close(self):
+        pass
+
+# Returns copy of message properties, encoded and decoded as the broker would
+def copyProperties(properties):
+    copy = pika.BasicProperties()
+    copy.decode(b''.join(properties.encode()))
+    return copy
+
+# Replaces the pipeline and database clients every service creates with the stand-ins.
+# Returns (broker, database) the stand-ins share
+def install(webhooks = None):
+    StandInPipelineClient.broker = StandInBroker()
+    StandInDatabasePool.database = StandInDatabase(webhooks)
+
+    pipeline_client.PipelineClient = StandInPipelineClient
+    database_pool.DatabasePool = StandInDatabasePool
+
+    return StandInPipelineClient.broker, StandInDatabasePool.database
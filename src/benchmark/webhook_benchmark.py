@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Compares how long BENCHMARK_WEBHOOKS webhooks wait for a notification when posting one after another
+# with a new connection each, and when posting concurrently over kept-alive sessions.
+# Webhooks are served locally and answer after BENCHMARK_LATENCY seconds, standing in for Discord.
+# Local connections have no TLS handshake, so the gain from reusing connections is understated.
+#   python3 webhook_benchmark.py
+import os
+import sys
+import time
+import json
+import threading
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notifier'))
+from webhook_delivery import WebhookDelivery
+
+webhookCount = int(os.getenv('BENCHMARK_WEBHOOKS', 200))
+latency = float(os.getenv('BENCHMARK_LATENCY', 0.02))
+
+# Time every webhook received its post, by path
+receivedAt = {}
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(latency)
+        receivedAt[self.path] = time.time()
+
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def run(name, post, webhookUrls, data):
+    receivedAt.clear()
+
+    start = time.time()
+    post(webhookUrls, data)
+
+    times = sorted(receivedAt.values())
+    print('{:<10} {:>4} webhooks  first after {:>7.1f} ms  last after {:>7.1f} ms'.format(
+        name, len(times), (times[0] - start) * 1000, (times[-1] - start) * 1000))
+
+def postSerially(webhookUrls, data):
+    for webhookUrl in webhookUrls:
+        requests.post(webhookUrl, data = data, headers = { 'Content-Type': 'application/json' })
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    webhookUrls = ['http://127.0.0.1:{}/api/webhooks/{}'.format(server.server_port, index) for index in range(webhookCount)]
+    data = json.dumps({ 'embeds': [{ 'title': 'benchmark' }] })
+
+    delivery = WebhookDelivery()
+
+    # Open connections once, as they would be after the first notification
+    delivery.deliver(webhookUrls, data)
+
+    run('serial', postSerially, webhookUrls, data)
+    run('pooled', delivery.deliver, webhookUrls, data)
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
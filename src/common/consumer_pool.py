@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import os
+import math
+import time
+import queue
+import socket
+import threading
+import functools
+from concurrent.futures import Future
+from collections import OrderedDict
+from pika.exceptions import AMQPError
+
+# Outcomes of handling a message
+ACK = 'ack'
+REQUEUE = 'requeue'
+REJECT = 'reject'
+
+# Handles messages of a queue on a pool of worker threads, so one slow message does not hold up the ones behind it.
+# A pika connection must only be used by the thread that owns it, so the consuming thread receives messages and
+# workers only run the handler. Finished messages are handed back with add_callback_threadsafe, and their outgoing
+# messages are published and the message acknowledged in delivery order, never ahead of messages that arrived earlier.
+# Workers are added when the backlog grows and leave again after sitting idle.
+#
+# Handler is called with the properties and body of a message, and returns a list of
+# (queue, body, headers, contentType) tuples to publish once the message is handled, or None.
+# A handler that finishes the message later on another thread, e.g. once it was posted together with others,
+# returns a Future of that list instead, and the message stays unacknowledged until the future is done.
+# A message whose handler raises gets a second chance and is dropped if it fails again, unless the error is one of
+# retryErrors, which mean the message could not be handled right now, e.g. the database is down, and always requeue it
+class ConsumerPool:
+    def __init__(self, pipeline, handler, prefetchCount = None, minWorkers = None, maxWorkers = None, backlogPerWorker = None, idleTimeout = None, reportInterval = None, retryErrors = ()):
+        self.pipeline = pipeline
+        self.handler = handler
+        self.retryErrors = tuple(retryErrors)
+        self.prefetchCount = int(prefetchCount) if prefetchCount is not None else int(os.getenv('CONSUMER_PREFETCH', 20))
+        self.minWorkers = max(1, int(minWorkers) if minWorkers is not None else int(os.getenv('CONSUMER_MIN_WORKERS', 1)))
+        self.maxWorkers = max(self.minWorkers, int(maxWorkers) if maxWorkers is not None else int(os.getenv('CONSUMER_MAX_WORKERS', 4)))
+        self.backlogPerWorker = max(1, int(backlogPerWorker) if backlogPerWorker is not None else int(os.getenv('CONSUMER_BACKLOG_PER_WORKER', 5)))
+        self.idleTimeout = float(idleTimeout) if idleTimeout is not None else float(os.getenv('CONSUMER_IDLE_TIMEOUT', 30))
+        self.reportInterval = float(reportInterval) if reportInterval is not None else float(os.getenv('CONSUMER_REPORT_INTERVAL', 60))
+
+        self.queue = None
+        self.work = queue.Queue()
+        self.lock = threading.Lock()
+        self.workerCount = 0
+
+        # Channel messages are currently received on, and outcome of every unacknowledged message on it by delivery tag.
+        # Only used by the consuming thread
+        self.channel = None
+        self.pending = OrderedDict()
+
+        # Messages waiting in the broker, checked every few seconds
+        self.brokerBacklog = 0
+        self.backlogCheckedAt = 0
+
+        self.replica = socket.gethostname()
+        self.resetCounters()
+
+    # Starts workers and handles messages of the specified queue, forever.
+    # If given, setup is called with every new consuming channel, as in PipelineClient.consume
+    def consume(self, queueName, setup = None):
+        self.queue = queueName
+
+        for index in range(self.minWorkers):
+            self.addWorker()
+
+        self.pipeline.consume(queueName, self.onMessage, self.prefetchCount, setup)
+
+    # Stops receiving messages and gives workers up to drainTimeout seconds to finish the ones they have,
+    # then closes consuming channel, so the broker puts every message that is still unacknowledged back into the queue.
+    # Must be called on the consuming thread after consume returned
+    def cancel(self, drainTimeout = None):
+        drainTimeout = float(drainTimeout) if drainTimeout is not None else float(os.getenv('CONSUMER_DRAIN_TIMEOUT', 5))
+        channel = self.channel
+
+        try:
+            if channel is not None and channel.is_open:
+                for consumerTag in list(channel.consumer_tags):
+                    channel.basic_cancel(consumerTag)
+
+                deadline = time.time() + drainTimeout
+                while len(self.pending) > 0 and time.time() < deadline:
+                    channel.connection.process_data_events(time_limit = 0.1)
+
+                channel.close()
+        except AMQPError as error:
+            print("Failed to close consuming channel with error:")
+            print(repr(error))
+
+        if len(self.pending) > 0:
+            print(str(len(self.pending)) + " messages were not finished and go back into the queue")
+
+        self.channel = None
+        self.pending = OrderedDict()
+
+    # Runs on the consuming thread for every message, and passes message on to the workers
+    def onMessage(self, channel, method, properties, body):
+        # Deliveries of a closed channel are sent again by the broker, so they are never acknowledged
+        if channel is not self.channel:
+            self.channel = channel
+            self.pending = OrderedDict()
+
+        self.pending[method.delivery_tag] = None
+        self.work.put((channel, method, properties, body))
+
+        with self.lock:
+            self.counters['received'] += 1
+
+        self.scaleWorkers(channel)
+
+    # Adds workers until there is one for every backlogPerWorker messages waiting, locally or in the broker
+    def scaleWorkers(self, channel):
+        now = time.time()
+        if now - self.backlogCheckedAt > 5:
+            self.backlogCheckedAt = now
+            try:
+                self.brokerBacklog = channel.queue_declare(queue = self.queue, passive = True).method.message_count
+            except AMQPError as error:
+                print("Failed to check backlog of " + self.queue + " queue with error:")
+                print(repr(error))
+
+        backlog = self.work.qsize() + self.brokerBacklog
+        target = min(self.maxWorkers, max(self.minWorkers, math.ceil(backlog / self.backlogPerWorker)))
+
+        while self.workerCount < target:
+            self.addWorker()
+
+    def addWorker(self):
+        with self.lock:
+            self.workerCount += 1
+            self.counters['peakWorkers'] = max(self.counters['peakWorkers'], self.workerCount)
+
+        threading.Thread(target = self.runWorker, daemon = True).start()
+
+    # Handles messages until there was nothing to do for idleTimeout seconds, unless this is one of the minimum workers
+    def runWorker(self):
+        while True:
+            try:
+                channel, method, properties, body = self.work.get(timeout = self.idleTimeout)
+            except queue.Empty:
+                with self.lock:
+                    if self.workerCount > self.minWorkers:
+                        self.workerCount -= 1
+                        return
+                continue
+
+            # Channel closed while message was waiting, broker sends it again on the new channel
+            if not channel.is_open:
+                continue
+
+            start = time.time()
+            outgoing = None
+
+            try:
+                outgoing = self.handler(properties, body)
+                outcome = ACK
+            except Exception as error:
+                outcome = self.getFailedOutcome(method, error)
+
+            with self.lock:
+                self.counters['handlingTime'] += time.time() - start
+
+            if isinstance(outgoing, Future):
+                outgoing.add_done_callback(functools.partial(self.finishDeferred, channel, method))
+                continue
+
+            self.handOver(channel, method.delivery_tag, outcome, outgoing)
+
+    # Runs on the thread that completed the future of a deferred message, or on the worker if it was done already
+    def finishDeferred(self, channel, method, future):
+        outgoing = None
+
+        try:
+            outgoing = future.result()
+            outcome = ACK
+        except Exception as error:
+            outcome = self.getFailedOutcome(method, error)
+
+        self.handOver(channel, method.delivery_tag, outcome, outgoing)
+
+    # Gives message a second chance, but drops it if it already failed once, unless it could only not be handled yet
+    def getFailedOutcome(self, method, error):
+        print("Failed to handle message with error:")
+        print(repr(error))
+
+        if isinstance(error, self.retryErrors):
+            return REQUEUE
+
+        return REJECT if method.redelivered else REQUEUE
+
+    # Passes finished message back to the consuming thread, which owns the channel
+    def handOver(self, channel, deliveryTag, outcome, outgoing):
+        try:
+            channel.connection.add_callback_threadsafe(functools.partial(self.finish, channel, deliveryTag, outcome, outgoing))
+        except AMQPError:
+            # Connection closed while message was handled, broker sends it again
+            pass
+
+    # Runs on the consuming thread when a worker finished a message. Publishes outgoing messages and acknowledges
+    # every message that is finished and has no unfinished message ahead of it
+    def finish(self, channel, deliveryTag, outcome, outgoing):
+        if channel is not self.channel or deliveryTag not in self.pending:
+            return
+
+        self.pending[deliveryTag] = (outcome, outgoing)
+
+        ready = []
+        while len(self.pending) > 0:
+            tag, result = next(iter(self.pending.items()))
+            if result is None:
+                break
+
+            self.pending.popitem(last = False)
+            ready.append((tag, result[0], result[1]))
+
+        acked = 0
+        failed = 0
+
+        try:
+            lastAck = None
+
+            for tag, outcome, outgoing in ready:
+                if outcome == ACK and not self.publish(outgoing):
+                    outcome = REQUEUE
+
+                if outcome == ACK:
+                    acked += 1
+                    lastAck = tag
+                    continue
+
+                failed += 1
+
+                # Acknowledge every message before this one at once, then reject this one on its own
+                if lastAck is not None:
+                    channel.basic_ack(delivery_tag = lastAck, multiple = True)
+                    lastAck = None
+                channel.basic_nack(delivery_tag = tag, requeue = outcome == REQUEUE)
+
+            if lastAck is not None:
+                channel.basic_ack(delivery_tag = lastAck, multiple = True)
+        except AMQPError as error:
+            print("Failed to acknowledge messages with error:")
+            print(repr(error))
+            return
+
+        with self.lock:
+            self.counters['acked'] += acked
+            self.counters['failed'] += failed
+
+        self.printThroughput()
+
+    # Publishes outgoing messages of a handled message, returning false if broker did not confirm all of them
+    def publish(self, outgoing):
+        if not outgoing:
+            return True
+
+        for queueName, body, headers, contentType in outgoing:
+            if self.pipeline.publish(queueName, body, headers, contentType) < 1:
+                return False
+
+            print("Published message to " + queueName + " queue")
+
+        return True
+
+    def resetCounters(self):
+        self.counters = { 'received': 0, 'acked': 0, 'failed': 0, 'handlingTime': 0.0, 'peakWorkers': self.workerCount }
+        self.countersStartedAt = time.time()
+
+    # Prints throughput of this replica every reportInterval seconds, and starts counting again
+    def printThroughput(self):
+        elapsed = time.time() - self.countersStartedAt
+        if elapsed < self.reportInterval:
+            return
+
+        with self.lock:
+            counters = self.counters
+            finished = counters['acked'] + counters['failed']
+
+            print('Consumer {} on {}: {} messages in {:.0f}s ({:.1f}/s), {} failed, {:.0f} ms mean handling time, {} workers (peak {}), backlog {}'.format(
+                self.queue, self.replica, finished, elapsed, finished / elapsed, counters['failed'],
+                counters['handlingTime'] / finished * 1000 if finished > 0 else 0,
+                self.workerCount, counters['peakWorkers'], self.work.qsize() + self.brokerBacklog))
+
+            self.resetCounters()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+
+# Pool of connections to the postgres database, shared by the validator, the notifier and the management api.
+# Connections are opened once and handed out again for every message or request. Connections that sat idle
+# for a while are checked before they are handed out, and broken ones are replaced with new ones.
+class DatabasePool:
+    def __init__(self, minConnections = None, maxConnections = None, healthCheckInterval = None, waitTimeout = None):
+        self.minConnections = int(minConnections) if minConnections is not None else int(os.getenv('DATABASE_POOL_MIN', 1))
+        self.maxConnections = int(maxConnections) if maxConnections is not None else int(os.getenv('DATABASE_POOL_MAX', 5))
+        self.healthCheckInterval = float(healthCheckInterval) if healthCheckInterval is not None else float(os.getenv('DATABASE_HEALTH_CHECK_INTERVAL', 30))
+        self.waitTimeout = float(waitTimeout) if waitTimeout is not None else float(os.getenv('DATABASE_POOL_TIMEOUT', 10))
+
+        self.pool = None
+        self.lock = threading.Lock()
+
+        # Bounds connections handed out, so callers wait for a free one instead of failing when pool is exhausted
+        self.available = threading.BoundedSemaphore(self.maxConnections)
+
+        # Time each idle connection was returned to the pool, by connection id
+        self.returnedAt = {}
+
+    # Creates pool on first use, or after the database was unreachable
+    def getPool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(self.minConnections, self.maxConnections, **getConnectionParameters())
+                print("Connected to database with pool of up to " + str(self.maxConnections) + " connections")
+
+            return self.pool
+
+    # Returns healthy connection from the pool, or None if database could not be reached.
+    # Every connection must be given back with putConnection
+    def getConnection(self):
+        if not self.available.acquire(timeout = self.waitTimeout):
+            print("Timed out waiting for a free database connection")
+            return None
+
+        # Second attempt gets a fresh connection if the first one turned out to be broken
+        for attempt in range(2):
+            try:
+                pool = self.getPool()
+                connection = pool.getconn()
+
+                if self.isHealthy(connection):
+                    return connection
+
+                pool.putconn(connection, close = True)
+            except (Exception, psycopg2.OperationalError) as error:
+                print("Failed to connect to database with error:")
+                print(error)
+
+        self.available.release()
+        return None
+
+    # Opens a connection outside the pool, for sessions that hold on to it, e.g. to LISTEN for notifications.
+    # Returns None if database could not be reached. Caller closes it
+    def connect(self):
+        try:
+            return psycopg2.connect(**getConnectionParameters())
+        except (Exception, psycopg2.OperationalError) as error:
+            print("Failed to connect to database with error:")
+            print(error)
+            return None
+
+    # Returns connection to the pool, closing it if it broke while it was used
+    def putConnection(self, connection):
+        if connection is None:
+            return
+
+        try:
+            broken = connection.closed != 0
+
+            # Leave no transaction open, in case a failed statement was not rolled back
+            if not broken and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+
+            self.returnedAt[id(connection)] = time.time()
+
+            with self.lock:
+                if self.pool is not None:
+                    self.pool.putconn(connection, close = broken)
+                else:
+                    connection.close()
+        except (Exception, psycopg2.Error) as error:
+            print("Failed to return connection to pool with error:")
+            print(error)
+        finally:
+            self.available.release()
+
+    # Returns true if connection is open, checking it with a round trip if it has been idle for a while
+    def isHealthy(self, connection):
+        if connection.closed != 0:
+            return False
+
+        returnedAt = self.returnedAt.get(id(connection))
+        if returnedAt is not None and time.time() - returnedAt < self.healthCheckInterval:
+            return True
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            connection.rollback()
+            return True
+        except (Exception, psycopg2.Error) as error:
+            print("Dropping broken database connection with error:")
+            print(error)
+            return False
+
+    # Closes every connection, so the pool is created again on next use
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                try:
+                    self.pool.closeall()
+                except psycopg2.pool.PoolError:
+                    pass
+            self.pool = None
+            self.returnedAt = {}
+
+# Returns parameters of database connections from environment variables
+def getConnectionParameters():
+    return {
+        'host': os.getenv('DATABASE_HOST', 'localhost'),
+        'database': os.getenv('DATABASE_NAME'),
+        'user': os.getenv('DATABASE_USER', 'postgres'),
+        'password': os.getenv('DATABASE_PASSWORD', 'postgres'),
+        'port': os.getenv('DATABASE_PORT', '5432')
+    }
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import pika
+from pika.exceptions import AMQPError
+
+# Type of exchange that spreads messages over the queues bound to it by hashing their routing key.
+# Needs the rabbitmq_consistent_hash_exchange plugin
+HASH_EXCHANGE_TYPE = 'x-consistent-hash'
+
+# Long-lived connection to the pipeline, shared by the monitor, validator and notifier.
+# Keeps one connection and one publishing channel open between messages, reconnects when the broker
+# drops them, remembers which queues were already declared, and publishes in batches that the broker
+# confirms as a whole.
+class PipelineClient:
+    def __init__(self, host = None, batchSize = None, retryDelay = None):
+        self.host = host if host is not None else os.getenv('PIPELINE_HOST', 'localhost')
+        self.batchSize = int(batchSize) if batchSize is not None else int(os.getenv('PIPELINE_BATCH_SIZE', 100))
+        self.retryDelay = float(retryDelay) if retryDelay is not None else float(os.getenv('PIPELINE_RETRY_DELAY', 5))
+
+        self.connection = None
+        self.channel = None
+        self.declaredQueues = set()
+        self.declaredExchanges = set()
+
+        # Messages the broker returned because no queue was bound to receive them
+        self.returned = 0
+
+        # Arguments of queues that are not plain persistent queues, e.g. delay queues with a message TTL, by queue name
+        self.queueArguments = {}
+
+    # Opens connection to pipeline if it is not already open
+    def connect(self):
+        if self.connection is not None and self.connection.is_open:
+            return self.connection
+
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host = self.host))
+        self.channel = None
+        self.declaredQueues = set()
+        self.declaredExchanges = set()
+
+        print("Connected to pipeline at " + self.host)
+
+        return self.connection
+
+    # Returns publishing channel, reopening connection and channel if either was closed.
+    # Channel is put into transaction mode, so every batch is confirmed by the broker with a single commit
+    def getChannel(self):
+        self.connect()
+
+        if self.channel is None or not self.channel.is_open:
+            self.channel = self.connection.channel()
+            self.channel.tx_select()
+            self.channel.add_on_return_callback(self.onReturned)
+            self.declaredQueues = set()
+            self.declaredExchanges = set()
+
+        return self.channel
+
+    # Creates a persistent queue, but only once per channel. If it already exists, this will not create another one
+    def declareQueue(self, queue, channel = None):
+        if channel is None:
+            channel = self.getChannel()
+
+        key = (channel.channel_number, queue)
+        if key not in self.declaredQueues:
+            channel.queue_declare(queue = queue, durable = True, arguments = self.queueArguments.get(queue))
+            self.declaredQueues.add(key)
+
+    # Sets arguments a queue is declared with, e.g. x-message-ttl. Must be the same wherever the queue is declared
+    def setQueueArguments(self, queue, arguments):
+        self.queueArguments[queue] = arguments
+
+    # Creates a persistent exchange, but only once per channel
+    def declareExchange(self, exchange, exchangeType = HASH_EXCHANGE_TYPE, channel = None):
+        if channel is None:
+            channel = self.getChannel()
+
+        key = (channel.channel_number, exchange)
+        if key not in self.declaredExchanges:
+            channel.exchange_declare(exchange = exchange, exchange_type = exchangeType, durable = True)
+            self.declaredExchanges.add(key)
+
+    # Publishes a single serialized message into the specified queue
+    def publish(self, queue, body, headers = None, contentType = None):
+        return self.publishBatch(queue, [body], headers, contentType)
+
+    # Publishes serialized messages into the specified queue, committing every batchSize messages.
+    # If the connection is lost, reconnects and resends the batch that was not confirmed.
+    # Returns number of messages confirmed by the broker.
+    def publishBatch(self, queue, bodies, headers = None, contentType = None):
+        if queue is None or bodies is None:
+            return 0
+
+        return self.publishMessages('', [(queue, body) for body in bodies], headers, contentType)
+
+    # Publishes serialized messages into the specified hash exchange, each routed by its own key.
+    # Messages are (routingKey, body) tuples. Returns number of messages confirmed by the broker.
+    # A batch counts as failed if the broker could not route it, e.g. while no queue is bound to the exchange yet
+    def publishToExchange(self, exchange, messages, headers = None, contentType = None):
+        if exchange is None or messages is None:
+            return 0
+
+        return self.publishMessages(exchange, list(messages), headers, contentType)
+
+    # Publishes (routingKey, body) tuples into an exchange, or into the queue named by the routing key
+    # if exchange is empty, committing every batchSize messages
+    def publishMessages(self, exchange, messages, headers, contentType):
+        confirmed = 0
+
+        for start in range(0, len(messages), self.batchSize):
+            batch = messages[start:start + self.batchSize]
+
+            if not self.commitBatch(exchange, batch, headers, contentType):
+                print("Failed to publish " + str(len(messages) - confirmed) + " messages to " + (exchange or batch[0][0]))
+                return confirmed
+
+            confirmed += len(batch)
+
+        return confirmed
+
+    # Sends one batch inside a transaction, retrying once on a fresh connection if the first attempt fails.
+    # Messages to an exchange are mandatory, so the broker returns them instead of dropping them if no queue is bound
+    def commitBatch(self, exchange, batch, headers, contentType):
+        for attempt in range(2):
+            try:
+                channel = self.getChannel()
+                returnedBefore = self.returned
+
+                for routingKey, body in batch:
+                    if exchange == '':
+                        self.declareQueue(routingKey, channel)
+                    else:
+                        self.declareExchange(exchange, channel = channel)
+
+                    channel.basic_publish(
+                        exchange = exchange,
+                        routing_key = routingKey,
+                        body = body,
+                        properties = pika.BasicProperties(
+                            delivery_mode = 2,  # make message persistent
+                            content_type = contentType,
+                            headers = headers
+                        ),
+                        mandatory = exchange != ''
+                    )
+
+                channel.tx_commit()
+
+                # Broker returns unroutable messages before it confirms the commit, and they are counted here
+                if exchange != '':
+                    self.connection.process_data_events(time_limit = 0)
+                    if self.returned > returnedBefore:
+                        print(str(self.returned - returnedBefore) + " messages were not routed to any queue bound to " + exchange)
+                        return False
+
+                return True
+            except AMQPError as error:
+                print("Lost connection to pipeline with error:")
+                print(repr(error))
+                self.reset()
+
+                if attempt == 0:
+                    time.sleep(self.retryDelay)
+
+        return False
+
+    def onReturned(self, channel, method, properties, body):
+        self.returned += 1
+
+    # Reads messages from the specified queue and passes them to callback, forever.
+    # Reconnects with a delay whenever the connection to the pipeline is lost.
+    # If given, setup is called with every new consuming channel before messages are read from it
+    def consume(self, queue, callback, prefetchCount = 1, setup = None):
+        while True:
+            try:
+                self.connect()
+
+                # Consuming channel is separate from publishing channel, so acks are not part of a transaction
+                channel = self.connection.channel()
+                self.declareQueue(queue, channel)
+
+                # Limit number of unacknowledged messages held at once
+                channel.basic_qos(prefetch_count = prefetchCount)
+
+                if setup is not None:
+                    setup(channel)
+                channel.basic_consume(queue = queue, on_message_callback = callback)
+
+                print("Connected to pipeline and " + queue + " queue, waiting for data...")
+
+                # Enter never ending loop, waiting for messages
+                channel.start_consuming()
+            except AMQPError as error:
+                print("Lost connection to pipeline with error:")
+                print(repr(error))
+                self.reset()
+                time.sleep(self.retryDelay)
+
+    # Waits for the specified number of seconds while keeping the connection alive with heartbeats
+    def sleep(self, seconds):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.sleep(seconds)
+                return
+            except AMQPError:
+                self.reset()
+
+        time.sleep(seconds)
+
+    # Drops the current connection, so next call reconnects
+    def reset(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            pass
+
+        self.connection = None
+        self.channel = None
+        self.declaredQueues = set()
+        self.declaredExchanges = set()
+
+    def close(self):
+        self.reset()
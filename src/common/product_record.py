@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import json
+import struct
+
+# Version of the product schema below. Consumers refuse messages with a newer version than they know.
+# Records are only marked with version 2 when they carry changes, so consumers that only know version 1
+# keep reading every other message
+SCHEMA_VERSION = 2
+BASE_SCHEMA_VERSION = 1
+
+# Content types producers can choose with PIPELINE_ENCODING, sent in the content_type property of every message
+JSON_CONTENT_TYPE = 'application/json'
+PACKED_CONTENT_TYPE = 'application/x-snkrs-product'
+
+contentTypes = { 'json': JSON_CONTENT_TYPE, 'packed': PACKED_CONTENT_TYPE }
+
+# Product as it travels through the pipeline. Attributes that the API did not provide are None,
+# e.g. everything after styleCode for threads that are not an actual product release.
+# Changes are set by the validator when an already known product changed, e.g. { 'sizesAdded': ['M 10'], 'price': [170, 150] }
+class ProductRecord:
+    __slots__ = ('id', 'title', 'image', 'url', 'styleCode', 'startSellDate', 'publishType', 'price', 'sizes', 'changes')
+
+    def __init__(self, id = None, title = None, image = None, url = None, styleCode = None, startSellDate = None, publishType = None, price = None, sizes = None, changes = None):
+        self.id = id
+        self.title = title
+        self.image = image
+        self.url = url
+        self.styleCode = styleCode
+        self.startSellDate = startSellDate
+        self.publishType = publishType
+        self.price = price
+        self.sizes = sizes
+        self.changes = changes
+
+    # Creates record from the dictionary format used in JSON messages, ignoring unknown keys
+    @classmethod
+    def fromDict(cls, data):
+        record = cls()
+        for field in cls.__slots__:
+            setattr(record, field, data.get(field))
+        return record
+
+    # Returns dictionary with only the attributes that are set, the same shape as JSON messages
+    def toDict(self):
+        return { field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None }
+
+    # Returns tuple of every attribute, usable as a hashable key
+    def toTuple(self):
+        return (self.id, self.title, self.image, self.url, self.styleCode, self.startSellDate, self.publishType, self.price,
+            tuple(self.sizes) if self.sizes is not None else None, json.dumps(self.changes, sort_keys = True) if self.changes is not None else None)
+
+    def __eq__(self, other):
+        return isinstance(other, ProductRecord) and self.toTuple() == other.toTuple()
+
+    def __repr__(self):
+        return 'ProductRecord(' + ', '.join(field + '=' + repr(getattr(self, field)) for field in self.__slots__ if getattr(self, field) is not None) + ')'
+
+# Packed layout of a record, all integers little endian:
+#   uint8 schema version, uint16 mask of present fields, uint16 number of strings, float64 price if present,
+#   then every present string field in __slots__ order, the changes as JSON if present, and the sizes,
+#   as one utf-8 block with the strings separated by the ASCII unit separator.
+#   JSON escapes control characters, so the changes never contain a separator.
+# Strings are encoded, decoded and split in one call each, which is what makes this faster than JSON.
+headerStruct = struct.Struct('<BHH')
+priceStruct = struct.Struct('<d')
+batchStruct = struct.Struct('<I')
+
+separator = '\x1f'
+
+stringFields = ('id', 'title', 'image', 'url', 'styleCode', 'startSellDate', 'publishType')
+allStringsMask = (1 << len(stringFields)) - 1
+priceBit = 1 << 7
+sizesBit = 1 << 8
+changesBit = 1 << 9
+
+# Set when price was an integer, so it is not turned into a float on the way
+integerPriceBit = 1 << 15
+
+# Returns record packed into bytes. Unit separators inside strings are replaced by spaces
+def packRecord(record):
+    mask = 0
+    strings = []
+
+    for bit, field in enumerate(stringFields):
+        value = getattr(record, field)
+        if value is not None:
+            mask |= 1 << bit
+            strings.append(str(value))
+
+    price = b''
+    if record.price is not None:
+        mask |= priceBit
+        if isinstance(record.price, int):
+            mask |= integerPriceBit
+        price = priceStruct.pack(record.price)
+
+    version = BASE_SCHEMA_VERSION
+    if record.changes is not None:
+        mask |= changesBit
+        version = SCHEMA_VERSION
+        strings.append(json.dumps(record.changes))
+
+    if record.sizes is not None:
+        mask |= sizesBit
+        strings.extend(record.sizes)
+
+    text = separator.join(strings)
+    if text.count(separator) != max(0, len(strings) - 1):
+        text = separator.join([string.replace(separator, ' ') for string in strings])
+
+    return headerStruct.pack(version, mask, len(strings)) + price + text.encode('utf-8')
+
+# Returns record unpacked from bytes
+def unpackRecord(data):
+    version, mask, count = headerStruct.unpack_from(data, 0)
+    if version > SCHEMA_VERSION:
+        raise ValueError("Unsupported product schema version " + str(version))
+
+    offset = headerStruct.size
+
+    price = None
+    if mask & priceBit:
+        price, = priceStruct.unpack_from(data, offset)
+        offset += priceStruct.size
+        if mask & integerPriceBit:
+            price = int(price)
+
+    strings = data[offset:].decode('utf-8').split(separator) if count > 0 else []
+    if len(strings) != count:
+        raise ValueError("Product has " + str(len(strings)) + " strings instead of " + str(count))
+
+    # Releases have every string field, so they can be built directly
+    if mask & allStringsMask == allStringsMask and not mask & changesBit:
+        sizes = strings[len(stringFields):] if mask & sizesBit else None
+        return ProductRecord(*strings[:len(stringFields)], price, sizes)
+
+    record = ProductRecord(price = price)
+
+    index = 0
+    for bit, field in enumerate(stringFields):
+        if mask & (1 << bit):
+            setattr(record, field, strings[index])
+            index += 1
+
+    if mask & changesBit:
+        record.changes = json.loads(strings[index])
+        index += 1
+
+    if mask & sizesBit:
+        record.sizes = strings[index:]
+
+    return record
+
+# Returns content type for the encoding name in PIPELINE_ENCODING ('json' or 'packed'), defaulting to JSON
+def getContentType(encoding):
+    if encoding not in contentTypes:
+        print("Unknown pipeline encoding " + str(encoding) + ", using json")
+        return JSON_CONTENT_TYPE
+
+    return contentTypes[encoding]
+
+# Returns message body of a single record in the specified content type
+def encodeProduct(record, contentType = JSON_CONTENT_TYPE):
+    if contentType == PACKED_CONTENT_TYPE:
+        return packRecord(record)
+
+    return json.dumps(record.toDict())
+
+# Returns message body carrying a batch of records in the specified content type.
+# Packed batches are a uint32 count followed by every packed record prefixed with its uint32 length
+def encodeProducts(records, contentType = JSON_CONTENT_TYPE):
+    if contentType == PACKED_CONTENT_TYPE:
+        parts = [batchStruct.pack(len(records))]
+        for record in records:
+            packed = packRecord(record)
+            parts.append(batchStruct.pack(len(packed)))
+            parts.append(packed)
+        return b''.join(parts)
+
+    return json.dumps([record.toDict() for record in records])
+
+# Returns headers that describe a message, so consumers know how to decode it.
+# Batch messages also carry the number of records in them.
+# Messages are only marked with the newest schema version if one of the given records carries changes
+def getHeaders(batchSize = None, records = None):
+    version = BASE_SCHEMA_VERSION
+    if records is not None and any(record.changes is not None for record in records):
+        version = SCHEMA_VERSION
+
+    headers = { 'schema-version': version }
+    if batchSize is not None:
+        headers['batch-size'] = batchSize
+    return headers
+
+# Returns true if message carries a batch of records rather than a single one
+def isBatch(properties):
+    headers = getattr(properties, 'headers', None) or {}
+    return 'batch-size' in headers
+
+# Returns record decoded from a message body, using the content type in the message properties.
+# Messages without content type are JSON, as sent before the packed encoding existed.
+# Returns None if the body is not a product, and raises ValueError if it cannot be decoded.
+def decodeProduct(body, properties = None):
+    contentType = getContentTypeOf(properties)
+
+    if contentType == PACKED_CONTENT_TYPE:
+        try:
+            return unpackRecord(body)
+        except struct.error as error:
+            raise ValueError("Truncated product: " + str(error))
+
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        return None
+
+    return ProductRecord.fromDict(data)
+
+# Returns list of records decoded from a message body, which may carry a single record or a batch.
+# Raises ValueError if the body cannot be decoded
+def decodeProducts(body, properties = None):
+    if not isBatch(properties):
+        record = decodeProduct(body, properties)
+        return [record] if record is not None else []
+
+    if getContentTypeOf(properties) == PACKED_CONTENT_TYPE:
+        try:
+            count, = batchStruct.unpack_from(body, 0)
+            offset = batchStruct.size
+            records = []
+
+            for index in range(count):
+                length, = batchStruct.unpack_from(body, offset)
+                offset += batchStruct.size
+                records.append(unpackRecord(body[offset:offset + length]))
+                offset += length
+
+            return records
+        except struct.error as error:
+            raise ValueError("Truncated product batch: " + str(error))
+
+    data = json.loads(body)
+    if not isinstance(data, list):
+        raise ValueError("Product batch is not a list")
+
+    return [ProductRecord.fromDict(item) for item in data if isinstance(item, dict)]
+
+# Returns content type of a message after checking that it can be decoded
+def getContentTypeOf(properties):
+    contentType = getattr(properties, 'content_type', None) or JSON_CONTENT_TYPE
+    if contentType not in contentTypes.values():
+        raise ValueError("Unsupported content type " + str(contentType))
+
+    headers = getattr(properties, 'headers', None) or {}
+    if headers.get('schema-version', SCHEMA_VERSION) > SCHEMA_VERSION:
+        raise ValueError("Unsupported product schema version " + str(headers['schema-version']))
+
+    return contentType
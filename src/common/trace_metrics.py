@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Header of product messages holding the time each stage handled the product, in milliseconds since the epoch,
+# e.g. { 'polled': 1579273200100, 'fetched': 1579273200400, 'published': 1579273200500, 'validated': 1579273200600 }.
+# AMQP tables can not hold floats, so times are integers
+TRACE_HEADER = 'trace'
+
+# Upper bounds of histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Returns current time as stamped into traces
+def getTimestamp():
+    return int(time.time() * 1000)
+
+# Returns trace of a message, or an empty dict if it has none
+def getTrace(properties):
+    headers = getattr(properties, 'headers', None) or {}
+    trace = headers.get(TRACE_HEADER)
+    return trace if isinstance(trace, dict) else {}
+
+# Counts events and observes latencies of the stages of a service, by name and optional labels,
+# and serves them on a scrape endpoint: Prometheus text on /metrics and raw buckets on /metrics.json,
+# which the management api reads to aggregate every service
+class Metrics:
+    def __init__(self, service, port = None):
+        self.service = service
+        self.port = int(port) if port is not None else int(os.getenv('METRICS_PORT', 0))
+
+        # (name, labels) -> count, and (name, labels) -> [bucket counts, sum, count]
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, name, amount = 1, labels = None):
+        key = (name, getLabelKey(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels = None):
+        if seconds is None or seconds < 0:
+            return
+
+        key = (name, getLabelKey(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # Observes seconds between two stages of a trace, or from a stage until now, if they were stamped
+    def observeTrace(self, name, trace, fromStage, toStage = None, labels = None):
+        start = trace.get(fromStage)
+        end = trace.get(toStage) if toStage is not None else getTimestamp()
+        if start is None or end is None:
+            return
+
+        self.observe(name, (end - start) / 1000.0, labels)
+
+    # Returns every counter and histogram as a dict that can be serialized to JSON
+    def snapshot(self):
+        with self.lock:
+            return {
+                'service': self.service,
+                'buckets': list(LATENCY_BUCKETS),
+                'counters': [{ 'name': name, 'labels': dict(labels), 'value': value } for (name, labels), value in self.counters.items()],
+                'histograms': [{ 'name': name, 'labels': dict(labels), 'buckets': list(histogram[0]), 'sum': histogram[1], 'count': histogram[2] }
+                    for (name, labels), histogram in self.histograms.items()]
+            }
+
+    # Returns metrics in the Prometheus text format
+    def render(self):
+        lines = []
+        snapshot = self.snapshot()
+
+        for counter in snapshot['counters']:
+            lines.append('{}_total{} {}'.format(counter['name'], formatLabels(counter['labels'], self.service), counter['value']))
+
+        for histogram in snapshot['histograms']:
+            cumulative = 0
+            for bound, bucketCount in zip(list(LATENCY_BUCKETS) + ['+Inf'], histogram['buckets']):
+                cumulative += bucketCount
+                labels = dict(histogram['labels'], le = str(bound))
+                lines.append('{}_bucket{} {}'.format(histogram['name'], formatLabels(labels, self.service), cumulative))
+            lines.append('{}_sum{} {}'.format(histogram['name'], formatLabels(histogram['labels'], self.service), histogram['sum']))
+            lines.append('{}_count{} {}'.format(histogram['name'], formatLabels(histogram['labels'], self.service), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    # Serves metrics on METRICS_PORT from a background thread, unless no port is configured
+    def serve(self):
+        if self.port <= 0 or self.server is not None:
+            return
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.render().encode('utf-8')
+                    contentType = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    contentType = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(('0.0.0.0', self.port), MetricsHandler)
+        except OSError as error:
+            print("Failed to serve metrics on port " + str(self.port) + " with error:")
+            print(error)
+            return
+
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, name = 'metrics', daemon = True).start()
+        print("Serving metrics of " + self.service + " on port " + str(self.port))
+
+# Adds snapshots of several services together, by metric name and labels.
+# Returns dict with the summed counters and histograms, e.g. to compute latencies across every replica
+def mergeSnapshots(snapshots):
+    counters = {}
+    histograms = {}
+
+    for snapshot in snapshots:
+        service = snapshot.get('service')
+
+        for counter in snapshot.get('counters', []):
+            key = (service, counter['name'], getLabelKey(counter['labels']))
+            counters[key] = counters.get(key, 0) + counter['value']
+
+        for histogram in snapshot.get('histograms', []):
+            key = (service, histogram['name'], getLabelKey(histogram['labels']))
+            merged = histograms.get(key)
+            if merged is None:
+                merged = histograms[key] = [[0] * len(histogram['buckets']), 0.0, 0]
+
+            merged[0] = [total + bucketCount for total, bucketCount in zip(merged[0], histogram['buckets'])]
+            merged[1] += histogram['sum']
+            merged[2] += histogram['count']
+
+    return { 'counters': counters, 'histograms': histograms }
+
+# Returns estimate of the quantile, e.g. 0.95, of a histogram from its bucket counts.
+# Observations are assumed to be spread evenly within a bucket, and the last bucket is reported at its lower bound
+def getQuantile(bucketCounts, quantile):
+    total = sum(bucketCounts)
+    if total == 0:
+        return None
+
+    rank = quantile * total
+    seen = 0
+    for index, bucketCount in enumerate(bucketCounts):
+        if bucketCount > 0 and seen + bucketCount >= rank:
+            lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            if index >= len(LATENCY_BUCKETS):
+                return lower
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / bucketCount
+        seen += bucketCount
+
+    return LATENCY_BUCKETS[-1]
+
+# Returns hashable key of labels
+def getLabelKey(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def formatLabels(labels, service):
+    labels = dict(labels, service = service)
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in sorted(labels.items())) + '}'
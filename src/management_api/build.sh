@@ -3,4 +3,4 @@ NAME=management_api:latest
 
 # build local docker image
 docker rmi $NAME
-docker build -t $NAME .
+docker build -t $NAME -f Dockerfile ..
@@ -3,11 +3,24 @@ from flask import Flask, request
 from flask_restful import Resource, Api, reqparse
 import psycopg2
 import json
+import urllib.request
 from datetime import datetime
+from database_pool import DatabasePool
+import trace_metrics
 
 app = Flask(__name__)
 api = Api(app)
 
+# Connections to database are opened once and reused for every request
+database = DatabasePool()
+
+# Channel notifiers listen on to reload their webhooks
+webhookChannel = os.getenv('WEBHOOK_CHANNEL', 'webhooks_changed')
+
+# Metrics endpoints of every service, which the latency view adds together
+metricsTargets = [target.strip() for target in os.getenv('METRICS_TARGETS', 'http://monitor:9100,http://validator:9100,http://notifier:9100').split(',') if target.strip()]
+metricsTimeout = float(os.getenv('METRICS_TIMEOUT', 2))
+
 # Accepts data from weather station and inserts it into database
 class WebhookManagement(Resource):
     # Adds specified webhooks to database
@@ -20,19 +33,20 @@ class WebhookManagement(Resource):
             return "Request must contain 'webhooks' array in body.", 400 # Bad Request
 
         # Connect to database
-        databaseConnection = connectToDatabase()
+        databaseConnection = database.getConnection()
         if databaseConnection is None:
             return "Unable to connect to database.", 500 # Internal server error
 
-        # Delete all webhooks from database
+        # Insert webhooks that are not in database yet
         for webhook in webhooks:
             if not checkIfWebhookExists(webhook, databaseConnection):
                 insertWebhook(webhook, databaseConnection)
 
-        # Close database connection
-        if databaseConnection is not None:
-            databaseConnection.close()
-            print("Database connection closed")
+        # Tell notifiers to reload their webhooks
+        notifyWebhooksChanged(databaseConnection)
+
+        # Return database connection to pool
+        database.putConnection(databaseConnection)
 
         return 200
 
@@ -51,7 +65,7 @@ class WebhookManagement(Resource):
             return "Request must contain 'webhooks' array in url.", 400 # Bad Request
 
         # Connect to database
-        databaseConnection = connectToDatabase()
+        databaseConnection = database.getConnection()
         if databaseConnection is None:
             return "Unable to connect to database.", 500 # Internal server error
 
@@ -59,10 +73,11 @@ class WebhookManagement(Resource):
         for webhook in webhooks:
             removeWebhook(webhook, databaseConnection)
 
-        # Close database connection
-        if databaseConnection is not None:
-            databaseConnection.close()
-            print("Database connection closed")
+        # Tell notifiers to reload their webhooks
+        notifyWebhooksChanged(databaseConnection)
+
+        # Return database connection to pool
+        database.putConnection(databaseConnection)
 
         return 200
 
@@ -74,15 +89,57 @@ class Ping(Resource):
 # Test method to make sure services are running
 class Help(Resource):
     def get(self):
-        databaseConnection = connectToDatabase()
+        databaseConnection = database.getConnection()
         if databaseConnection is None:
             return "Unable to connect to database.", 500 # Internal server error
         else:
-            databaseConnection.close()
-            print("Database connection closed")
+            database.putConnection(databaseConnection)
 
         return 200
 
+# Latency of every stage from polling to posting, added up across all services and replicas.
+# GET http://host:port/latency returns count, mean and percentiles in seconds of every stage
+class Latency(Resource):
+    def get(self):
+        snapshots = []
+        targets = {}
+
+        for target in metricsTargets:
+            snapshot = readMetrics(target)
+            targets[target] = 'ok' if snapshot is not None else 'unreachable'
+            if snapshot is not None:
+                snapshots.append(snapshot)
+
+        merged = trace_metrics.mergeSnapshots(snapshots)
+
+        stages = []
+        for (service, name, labels), (bucketCounts, total, count) in sorted(merged['histograms'].items()):
+            stages.append({
+                'service': service,
+                'stage': name,
+                'labels': dict(labels),
+                'count': count,
+                'mean': total / count if count > 0 else None,
+                'p50': trace_metrics.getQuantile(bucketCounts, 0.5),
+                'p95': trace_metrics.getQuantile(bucketCounts, 0.95),
+                'p99': trace_metrics.getQuantile(bucketCounts, 0.99)
+            })
+
+        counters = [{ 'service': service, 'name': name, 'labels': dict(labels), 'value': value }
+            for (service, name, labels), value in sorted(merged['counters'].items())]
+
+        return { 'targets': targets, 'stages': stages, 'counters': counters }, 200
+
+# Returns metrics snapshot served by a service, or None if it could not be read
+def readMetrics(target):
+    try:
+        with urllib.request.urlopen(target.rstrip('/') + '/metrics.json', timeout = metricsTimeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError) as error:
+        print("Failed to read metrics from " + target + " with error:")
+        print(error)
+        return None
+
 # Validates request attributes and types
 def parseWebhookList(rawWebhooks):
     # Check if request contains webhooks attribute
@@ -154,33 +211,24 @@ def removeWebhook(webhook, databaseConnection):
             print("Failed to remove webhook")
             print(error)
 
-# Connects to postgres database and returns connection object
-def connectToDatabase():
-    connection = None
-
+# Notifies every notifier listening on the webhook channel that webhooks were added or removed
+def notifyWebhooksChanged(databaseConnection):
     try:
-        connection = psycopg2.connect(
-            host=os.getenv('DATABASE_HOST', 'localhost'), 
-            database=os.getenv('DATABASE_NAME'), 
-            user=os.getenv('DATABASE_USER', 'postgres'), 
-            password=os.getenv('DATABASE_PASSWORD', 'postgres'), 
-            port=os.getenv('DATABASE_PORT', '5432')
-        )
-
-        # Print database properties
-        if connection is not None:
-            print("Connected to database")
-
-    except (Exception, psycopg2.OperationalError) as error:
-        print("Failed to connect to database with error:")
-        print(error)
+        cursor = databaseConnection.cursor()
+        cursor.execute('SELECT pg_notify(%(channel)s, %(payload)s)', { 'channel': webhookChannel, 'payload': '' })
 
-    return connection
+        databaseConnection.commit()
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Failed to notify notifiers of changed webhooks, they reload them once their list expires")
+        print(error)
+        databaseConnection.rollback()
 
 # Specify urls for API endpoints
 api.add_resource(WebhookManagement, '/webhooks')
 api.add_resource(Ping, '/ping')
 api.add_resource(Help, '/help')
+api.add_resource(Latency, '/latency')
 
 if __name__ == '__main__':
     app.run(host=os.getenv('HOST', '0.0.0.0'), port=os.getenv('PORT', '80'))
\ No newline at end of file
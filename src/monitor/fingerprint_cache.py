@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from collections import OrderedDict
+from product_record import packRecord
+
+# Bounded table of the last fingerprint seen for each product id.
+# Used by the monitor to publish only products that are new or changed since the previous poll.
+# When full, the product that has gone the longest without appearing in a poll is forgotten first.
+class FingerprintCache:
+    def __init__(self, capacity = 5000):
+        self.capacity = max(1, int(capacity))
+        self.fingerprints = OrderedDict()
+
+    # Returns stable digest of every attribute of the product record
+    @staticmethod
+    def fingerprint(product):
+        return hashlib.blake2b(packRecord(product), digest_size = 16).digest()
+
+    # Returns list of (product, fingerprint) pairs for products whose fingerprint differs from the stored one.
+    # Does not update the table, so products are only remembered once they were actually published
+    def changed(self, products):
+        result = []
+
+        for product in products:
+            id = product.id
+            fingerprint = self.fingerprint(product)
+
+            if id is None or self.fingerprints.get(id) != fingerprint:
+                result.append((product, fingerprint))
+            else:
+                # Product is still in the feed, so keep it from being evicted
+                self.fingerprints.move_to_end(id)
+
+        return result
+
+    # Stores fingerprint of a published product
+    def remember(self, product, fingerprint):
+        id = product.id
+        if id is None:
+            return
+
+        self.fingerprints[id] = fingerprint
+        self.fingerprints.move_to_end(id)
+
+        while len(self.fingerprints) > self.capacity:
+            self.fingerprints.popitem(last = False)
+
+    def __len__(self):
+        return len(self.fingerprints)
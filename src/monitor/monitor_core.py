@@ -1,64 +1,167 @@
 # -*- coding: utf-8 -*-
 import os
-import json
-import pika
 import monitor_custom
-import time
+import product_record
+import trace_metrics
+from pipeline_client import PipelineClient
+from fingerprint_cache import FingerprintCache
+from poll_scheduler import PollScheduler
+
+# Connection to pipeline is opened once and reused for every poll
+pipeline = PipelineClient()
+
+# Encoding of outgoing messages, 'json' or 'packed'
+contentType = product_record.getContentType(os.getenv('PIPELINE_ENCODING', 'json'))
+
+# If true, all products of a poll are sent as one message instead of one message each
+batchMode = os.getenv('PIPELINE_BATCH_MODE', 'false').lower() == 'true'
+
+# Queue products are published to
+outgoingQueue = os.getenv('OUTGOING_QUEUE')
+
+# If set, products are published to this consistent-hash exchange keyed on product id instead of OUTGOING_QUEUE,
+# so every validator replica owns a shard of the ids. Products are always sent one message each in this mode
+shardExchange = os.getenv('SHARD_EXCHANGE') or None
+if shardExchange is not None and batchMode:
+    print("Batch mode is ignored while publishing to shard exchange " + shardExchange)
+
+# Fingerprints of products that were already published, so unchanged products are not sent again
+publishedProducts = FingerprintCache(os.getenv('FINGERPRINT_CACHE_SIZE', 5000))
+
+# Decides how long to wait between polls, based on upcoming releases and API failures
+scheduler = PollScheduler(
+    baseInterval = os.getenv('REQUEST_FREQUENCY', 5),
+    minInterval = os.getenv('REQUEST_FREQUENCY_MIN', 1),
+    maxInterval = os.getenv('REQUEST_FREQUENCY_MAX', 30),
+    releaseWindow = os.getenv('RELEASE_WINDOW', 600),
+    releaseTail = os.getenv('RELEASE_TAIL', 120),
+    maxBackoff = os.getenv('MAX_BACKOFF', 300)
+)
+
+# Number of products sent to the pipeline, and products that could not be sent
+publishCounters = { 'published': 0, 'failed': 0 }
+
+# Latency of polls and publishes, served on METRICS_PORT
+metrics = trace_metrics.Metrics('monitor')
 
 def main():
+    metrics.serve()
+
     while True:
         print('Started monitoring...')
+        polledAt = trace_metrics.getTimestamp()
+
+        pagesRead = 0
+        changedProducts = 0
+        countersBefore = dict(monitor_custom.shortCircuitCounters)
+        failedBefore = publishCounters['failed']
 
-        # Retrieve product data from API
-        products = monitor_custom.getProductData()
+        # Retrieve product data from API one page at a time, and send each page into pipeline
+        # to database checking module as soon as it arrives
+        for products in monitor_custom.getProductPages():
+            if products is None:
+                print("Failed to format product data")
+                continue
 
-        # Send product data into pipeline to database checking module
-        if products is None:
-            print("Failed to format product data")
-        elif len(products) == 0:
-            print("No products found")
+            pagesRead += 1
+
+            # Products of a page are traced from the time the poll started and the time the page arrived
+            trace = { 'polled': polledAt, 'fetched': trace_metrics.getTimestamp() }
+            metrics.observeTrace('monitor_fetch_seconds', trace, 'polled', 'fetched')
+
+            if len(products) == 0:
+                print("No products found")
+            else:
+                scheduler.observe(products)
+                changedProducts += sendToPipeline(products, trace)
+
+        # Pages are only skipped on later polls once their products were published, so a failed publish is retried
+        if publishCounters['failed'] == failedBefore:
+            monitor_custom.commitValidators()
+        else:
+            print("Failed to publish " + str(publishCounters['failed'] - failedBefore) + " products, pages of this poll are read again")
+            monitor_custom.discardValidators()
+
+        # Pages that were skipped because they had not changed count as successfully read
+        unchangedPages = printShortCircuitCounters(countersBefore)
+        if monitor_custom.responseLog is not None:
+            monitor_custom.responseLog.printCounters()
+
+        if pagesRead + unchangedPages == 0 or monitor_custom.wasRateLimited():
+            scheduler.recordFailure(monitor_custom.wasRateLimited())
         else:
-            sendToPipeline(products)
+            scheduler.recordSuccess(changedProducts > 0)
 
         print('Finished monitoring...')
 
-        # Wait a specified amount of seconds (5 seconds by default)
-        time.sleep(int(os.getenv('REQUEST_FREQUENCY', 5)))
+        # Wait until next poll, which is REQUEST_FREQUENCY seconds (5 by default) unless a release is near,
+        # the feed has been quiet, or the API is failing
+        interval = scheduler.nextInterval()
+        print('Next poll in {:.1f} seconds ({})'.format(interval, scheduler.reason))
+        pipeline.sleep(interval)
 
-# Connects to pipeline and sends each product into outgoing message queue
-def sendToPipeline(products):
+# Prints how many page requests were short-circuited during the last poll and since startup.
+# Returns number of pages short-circuited during the last poll
+def printShortCircuitCounters(countersBefore):
+    counters = monitor_custom.shortCircuitCounters
+    notModified = counters['notModified'] - countersBefore['notModified']
+    identicalBody = counters['identicalBody'] - countersBefore['identicalBody']
+
+    print('Short-circuited {} of {} pages ({} not modified, {} identical). Since startup: {} of {} ({} not modified, {} identical)'.format(
+        notModified + identicalBody, counters['requests'] - countersBefore['requests'], notModified, identicalBody,
+        counters['notModified'] + counters['identicalBody'], counters['requests'], counters['notModified'], counters['identicalBody']))
+
+    return notModified + identicalBody
+
+# Serializes each new or changed product and sends them to outgoing message queue as a single batch.
+# Trace holds the times products were polled and fetched, and is sent along in the headers of every message.
+# Returns number of products that were published
+def sendToPipeline(products, trace = None):
     if products is None:
-        return
+        return 0
 
-    queue = os.getenv('OUTGOING_QUEUE')
+    # Skip products that have not changed since they were last published
+    changedProducts = publishedProducts.changed(products)
+    if len(changedProducts) == 0:
+        print("No new or changed products out of " + str(len(products)))
+        return 0
+
+    queue = shardExchange or outgoingQueue
     if queue is None:
         print("Must specify outgoing queue as environment variable OUTGOING_QUEUE")
-        return
+        publishCounters['failed'] += len(changedProducts)
+        return 0
+
+    # Time of publishing is the last stamp the monitor adds
+    headers = { trace_metrics.TRACE_HEADER: dict(trace or {}, published = trace_metrics.getTimestamp()) }
 
-    # Connect to pipeline
-    pipelineConnection = pika.BlockingConnection(pika.ConnectionParameters(host = os.getenv('PIPELINE_HOST', 'localhost')))
-    channel = pipelineConnection.channel()
+    if shardExchange is not None:
+        # Send each product into pipeline, routed to the validator that owns its id
+        counter = pipeline.publishToExchange(shardExchange, [(str(product.id), product_record.encodeProduct(product, contentType)) for product, fingerprint in changedProducts],
+            dict(product_record.getHeaders(), **headers), contentType)
+    elif batchMode:
+        # Send all products into pipeline as a single message
+        records = [product for product, fingerprint in changedProducts]
+        published = pipeline.publish(queue, product_record.encodeProducts(records, contentType), dict(product_record.getHeaders(len(records)), **headers), contentType)
+        counter = len(records) if published > 0 else 0
+    else:
+        # Send each product into pipeline
+        counter = pipeline.publishBatch(queue, [product_record.encodeProduct(product, contentType) for product, fingerprint in changedProducts],
+            dict(product_record.getHeaders(), **headers), contentType)
 
-    # Create a persistent queue. If it already exists, this will not create another one
-    channel.queue_declare(queue = queue, durable = True)
+    metrics.observeTrace('monitor_publish_seconds', headers[trace_metrics.TRACE_HEADER], 'fetched', 'published')
+    metrics.count('monitor_products_published', counter)
 
-    print("Connected to pipeline and " + queue + " queue, publishing data...")
+    # Batches are confirmed in order, so the first counter products were published
+    for product, fingerprint in changedProducts[:counter]:
+        publishedProducts.remember(product, fingerprint)
 
-    # Send each product into pipeline
-    counter = 0
-    for product in products:
-        counter += 1
-        channel.basic_publish(
-            exchange = '',
-            routing_key = queue,
-            body = json.dumps(product),
-            properties = pika.BasicProperties(
-                delivery_mode = 2,  # make message persistent
-            )
-        )
+    publishCounters['published'] += counter
+    publishCounters['failed'] += len(changedProducts) - counter
 
-    print("Added " + str(counter) + " products to message queue. Closing connection...")
+    print("Added " + str(counter) + " new or changed products out of " + str(len(products)) + " to " + queue)
 
-    pipelineConnection.close()
+    return counter
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -3,75 +3,392 @@ import requests
 import os
 import json
 import time
+import queue
+import hashlib
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from proxy_pool import ProxyPool
+from thread_stream import ThreadStream
+from response_log import ResponseLog
+from product_record import ProductRecord
 
-# Reads API at specified URL and through specified Proxy (if applicable) and returns json.
-# If API endpoint could not be read, returns None.
-def getProductData():
+headers = {
+    'accept': '*/*',
+    'content-type': 'application/json',
+    'accept-encoding': 'gzip, deflate, br',
+    'user-agent': 'SNKRS/3.14.1 (iPhone; iOS 13.1.2; Scale/3.00)',
+    'accept-language': 'en-US;q=1, en-US;q=0.9',
+    'Connection': 'keep-alive',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache'
+}
+
+# Keep-alive connections to the API, shared by the threads fetching each page
+session = requests.Session()
+
+# Pool of proxies used when MONITOR_MODE is 'fanout', created on first poll
+proxyPool = None
+
+# Status codes returned by the API during the current poll, through the session or any proxy
+pollStatusCodes = set()
+
+# Validators and digest of the last response for each page, used to skip pages that have not changed.
+# Validators of the current poll are pending until the monitor published its products and commits them,
+# so a page whose products could not be published is read and published again on the next poll
+pageValidators = {}
+pendingValidators = {}
+
+# If RESPONSE_LOG_DIRECTORY is set, raw responses of pages that changed are recorded there, to be replayed by response_replay.py.
+# Digest of the last body recorded for each page, so every mode records a page again only once its body changed
+responseLogDirectory = os.getenv('RESPONSE_LOG_DIRECTORY') or None
+responseLog = ResponseLog(responseLogDirectory) if responseLogDirectory is not None else None
+recordedDigests = {}
+
+# Returned instead of the decoded body for a page that has not changed since the last poll
+UNCHANGED = object()
+
+# Number of page requests, and how many of them were short-circuited because the page had not changed
+shortCircuitCounters = { 'requests': 0, 'notModified': 0, 'identicalBody': 0 }
+countersLock = threading.Lock()
+
+# Reads PAGE_DEPTH pages of the API concurrently and yields list of formatted products for each page
+# as soon as that page arrives, so the first page can be published while the rest are still downloading.
+# Yields None for every page that could not be read.
+def getProductPages():
     # Url defaults to None if it is not specified in environment
     url = os.getenv('TARGET_URL')
     if url is None:
         print("Please specify target url as environment variable TARGET_URL")
-        return None
+        yield None
+        return
 
-    headers = {
-        'accept': '*/*',
-        'content-type': 'application/json',
-        'accept-encoding': 'gzip, deflate, br',
-        'user-agent': 'SNKRS/3.14.1 (iPhone; iOS 13.1.2; Scale/3.00)',
-        'accept-language': 'en-US;q=1, en-US;q=0.9',
-        'Connection': 'keep-alive',
-        'Cache-Control': 'no-cache',
-        'Pragma': 'no-cache'
-    }
+    pollStatusCodes.clear()
+    pendingValidators.clear()
 
     url += '&i={:1}'.format(int(time.time()))
-    print("Making GET request to: " + url)
+    urls = getPageUrls(url, int(os.getenv('PAGE_DEPTH', 1)), int(os.getenv('PAGE_SIZE', 50)))
+
+    for pageUrl in urls:
+        print("Making GET request to: " + pageUrl)
+
+    if os.getenv('MONITOR_MODE', 'single') == 'fanout':
+        for pageUrl, response in getRawPagesThroughProxies(urls):
+            if response is None:
+                yield None
+                continue
+
+            rawAPIData, content = response
+            recordResponse(pageUrl, content)
+            yield formatProductData(rawAPIData)
+        return
+
+    # Streaming hands off products in small batches while each page is still downloading
+    if os.getenv('STREAM_PARSING', 'false').lower() == 'true':
+        for products in getStreamedPages(urls, int(os.getenv('STREAM_BATCH_SIZE', 10))):
+            yield products
+        return
+
+    for rawAPIData in getRawPages(urls):
+        # Unchanged pages are not parsed, formatted or published
+        if rawAPIData is not UNCHANGED:
+            yield formatProductData(rawAPIData)
+
+# Returns true if the API banned or rate limited any request of the last poll
+def wasRateLimited():
+    return 403 in pollStatusCodes or 429 in pollStatusCodes
+
+# Returns urls of the first depth pages of the feed, replacing offset parameter of the specified url
+def getPageUrls(url, depth, pageSize):
+    parsedUrl = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parsedUrl.query, keep_blank_values = True)
+    firstOffset = int(dict(query).get('offset', 0))
+
+    urls = []
+    for page in range(max(1, depth)):
+        pageQuery = [(key, value) for key, value in query if key != 'offset']
+        pageQuery.append(('offset', str(firstOffset + page * pageSize)))
+        urls.append(urllib.parse.urlunsplit(parsedUrl._replace(query = urllib.parse.urlencode(pageQuery))))
+
+    return urls
+
+# Requests all urls concurrently and yields decoded json of each one in order of arrival
+def getRawPages(urls):
+    if len(urls) == 1:
+        yield getRawData(urls[0])
+        return
+
+    with ThreadPoolExecutor(max_workers = len(urls)) as executor:
+        futures = [executor.submit(getRawData, url) for url in urls]
+
+        for future in as_completed(futures):
+            yield future.result()
+
+# Makes GET request to API and returns decoded json, UNCHANGED if the page is the same as on the last poll,
+# or None if it was unsuccessful.
+# Proxy is automatically read from HTTP_PROXY and HTTPS_PROXY environment variables if specified
+def getRawData(url):
+    key = getPageKey(url)
 
-    # Make GET request to API and return None if it was unsuccessful.
-    # Proxy is automatically read from HTTP_PROXY and HTTPS_PROXY environment variables if specified
     try:
-        response = requests.get(url = url, headers = headers)
+        response = session.get(url = url, headers = getConditionalHeaders(key))
+        pollStatusCodes.add(response.status_code)
+        countShortCircuit('requests')
+
+        if response.status_code == 304:
+            countShortCircuit('notModified')
+            return UNCHANGED
 
         if response.status_code != 200:
             return None
-    except HttpError as error:
+
+        # Skip decoding when the body is byte for byte the same as last time
+        digest = hashlib.blake2b(response.content, digest_size = 16).digest()
+        previous = pageValidators.get(key)
+
+        if previous is not None and previous['digest'] == digest:
+            storeValidators(key, response, digest)
+            countShortCircuit('identicalBody')
+            return UNCHANGED
+
+        # Validators are only kept for bodies that could be decoded, so a broken response is fetched again
+        rawAPIData = response.json()
+        storeValidators(key, response, digest)
+        recordResponse(url, response.content)
+
+        return rawAPIData
+    except (requests.exceptions.RequestException, ValueError) as error:
         print("Failed to make request to API with error:")
         print(error)
 
-    return formatProductData(response.json())
+    return None
+
+# Requests all urls concurrently and yields lists of at most batchSize formatted products as they are parsed
+# from each response stream. Yields None for every page that could not be read
+def getStreamedPages(urls, batchSize):
+    if len(urls) == 1:
+        for products in streamProductData(urls[0], batchSize):
+            yield products
+        return
+
+    batches = queue.Queue()
+    pageFinished = object()
+
+    # Each page is parsed on its own thread and hands its batches over to this generator
+    def streamPage(url):
+        try:
+            for products in streamProductData(url, batchSize):
+                batches.put(products)
+        finally:
+            batches.put(pageFinished)
+
+    with ThreadPoolExecutor(max_workers = len(urls)) as executor:
+        for url in urls:
+            executor.submit(streamPage, url)
+
+        finishedPages = 0
+        while finishedPages < len(urls):
+            products = batches.get()
+            if products is pageFinished:
+                finishedPages += 1
+            else:
+                yield products
+
+# Makes streaming GET request to API and yields lists of at most batchSize formatted products as soon as
+# they are parsed from the response. Yields None if the request failed before any product was parsed
+def streamProductData(url, batchSize):
+    key = getPageKey(url)
+    products = []
+    parsedAny = False
+
+    try:
+        with session.get(url = url, headers = getConditionalHeaders(key), stream = True) as response:
+            pollStatusCodes.add(response.status_code)
+            countShortCircuit('requests')
+
+            # Body has to be parsed before it is complete, so only the server can tell that it has not changed
+            if response.status_code == 304:
+                countShortCircuit('notModified')
+                return
+
+            if response.status_code != 200:
+                yield None
+                return
+
+            chunks = response.iter_content(chunk_size = 16384)
+            recordedChunks = []
+            if responseLog is not None:
+                chunks = recordChunks(chunks, recordedChunks)
+
+            for product in formatProductStream(chunks):
+                products.append(product)
+
+                if len(products) >= batchSize:
+                    parsedAny = True
+                    yield products
+                    products = []
+
+            # Validators are only kept once the whole body was parsed, so a broken response is fetched again
+            storeValidators(key, response, None)
+            recordResponse(url, b''.join(recordedChunks))
+    except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+        print("Failed to stream products from API with error:")
+        print(error)
+
+        if not parsedAny and len(products) == 0:
+            yield None
+            return
+
+    if len(products) > 0:
+        yield products
+
+# Returns url of page without the cache busting parameter, so the same page has the same key on every poll
+def getPageKey(url):
+    parsedUrl = urllib.parse.urlsplit(url)
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parsedUrl.query, keep_blank_values = True) if key != 'i']
+    return urllib.parse.urlunsplit(parsedUrl._replace(query = urllib.parse.urlencode(query)))
+
+# Returns request headers, with ETag and Last-Modified validators of the last response for the page if it had any
+def getConditionalHeaders(key):
+    previous = pageValidators.get(key)
+    if previous is None:
+        return headers
+
+    conditionalHeaders = dict(headers)
+    if previous['etag'] is not None:
+        conditionalHeaders['If-None-Match'] = previous['etag']
+    if previous['lastModified'] is not None:
+        conditionalHeaders['If-Modified-Since'] = previous['lastModified']
+
+    return conditionalHeaders
+
+def storeValidators(key, response, digest):
+    pendingValidators[key] = {
+        'etag': response.headers.get('ETag'),
+        'lastModified': response.headers.get('Last-Modified'),
+        'digest': digest
+    }
+
+# Queues raw response body to be recorded, if responses are recorded and the body of the page changed since it was last recorded.
+# Only bodies that could be decoded are passed in, by every mode
+def recordResponse(url, body):
+    if responseLog is None:
+        return
+
+    key = getPageKey(url)
+    digest = hashlib.blake2b(body, digest_size = 16).digest()
+    if recordedDigests.get(key) == digest:
+        return
+
+    recordedDigests[key] = digest
+    responseLog.append(url, body)
+
+# Yields chunks of a streamed response, keeping them so the whole body can be recorded
+def recordChunks(chunks, recordedChunks):
+    for chunk in chunks:
+        recordedChunks.append(chunk)
+        yield chunk
+
+# Keeps validators of the pages read during the last poll, once every product of the poll was published
+def commitValidators():
+    pageValidators.update(pendingValidators)
+    pendingValidators.clear()
+
+# Forgets validators of the pages read during the last poll, so they are not short-circuited next time
+def discardValidators():
+    pendingValidators.clear()
+
+def countShortCircuit(counter):
+    with countersLock:
+        shortCircuitCounters[counter] += 1
+
+# Returns pool of proxies in PROXY_LIST, creating it on first use
+def getProxyPool():
+    global proxyPool
+
+    if proxyPool is None:
+        proxies = [proxy.strip() for proxy in os.getenv('PROXY_LIST', '').split(',') if proxy.strip()]
+        if len(proxies) == 0:
+            print("Please specify comma separated proxies as environment variable PROXY_LIST")
+            return None
+
+        proxyPool = ProxyPool(
+            proxies,
+            width = os.getenv('FANOUT_WIDTH', 3),
+            stagger = os.getenv('FANOUT_STAGGER', 0.05),
+            grace = os.getenv('FANOUT_GRACE', 0.05),
+            timeout = os.getenv('FANOUT_TIMEOUT', 5),
+            cooldown = os.getenv('PROXY_COOLDOWN', 30),
+            onStatus = pollStatusCodes.add
+        )
+
+    return proxyPool
+
+# Makes GET request for every url through the proxies in PROXY_LIST from a single process and yields
+# url and (decoded json, raw body) of the freshest response for each url in order of arrival,
+# or url and None if all proxies failed
+def getRawPagesThroughProxies(urls):
+    pool = getProxyPool()
+    if pool is None:
+        for url in urls:
+            yield url, None
+        return
+
+    for url, response in pool.fetchAll(urls, headers, getFeedFreshness):
+        yield url, response
+
+    pool.printHealth()
+
+# Returns most recent publish time of any thread in the feed, used to pick the freshest proxy response
+def getFeedFreshness(rawAPIData):
+    if rawAPIData is None or 'threads' not in rawAPIData:
+        return ''
+
+    return max([thread.get('lastFetchTime') or thread.get('publishedDate') or '' for thread in rawAPIData['threads']] or [''])
 
 # Accepts raw data from API endpoint in the form of a JSON and extracts the necessary product information.
-# Returns ordered dictionary of products or None if JSON that was passed in was None.
+# Returns list of product records or None if JSON that was passed in was None.
 def formatProductData(rawAPIData):
     if rawAPIData is None or 'threads' not in rawAPIData:
         return None
-    
-    products = []
 
-    for thread in rawAPIData['threads']:
-        product = {}
+    return [formatThread(thread) for thread in rawAPIData['threads']]
+
+# Accepts raw response body from API endpoint as an iterable of byte chunks and yields each formatted product
+# as soon as its thread has been received, without decoding the whole body first.
+# Raises ValueError if the body is not valid JSON or does not contain a list of threads.
+def formatProductStream(chunks):
+    threads = ThreadStream(chunks)
+
+    for thread in threads:
+        yield formatThread(thread)
+
+    if not threads.found:
+        raise ValueError("Response does not contain threads")
 
-        product['id'] = thread['id']
-        product['title'] = thread['seoTitle']
-        product['image'] = thread['imageUrl']
-        product['url'] = thread['seoSlug']
+# Extracts the necessary product information from a single thread of the API response
+def formatThread(thread):
+    product = ProductRecord()
 
-        styleCode = thread['product']['style'] + '-' + thread['product']['colorCode']
-        product['styleCode'] = styleCode
+    product.id = thread['id']
+    product.title = thread['seoTitle']
+    product.image = thread['imageUrl']
+    product.url = thread['seoSlug']
 
-        # If style code represents an actual product release
-        if styleCode != '999999-999':
-            product['startSellDate'] = thread['product']['startSellDate']
-            product['publishType'] = thread['product']['publishType']
-            product['price'] = thread['product']['price']['currentRetailPrice']
-            product['sizes'] = []
+    styleCode = thread['product']['style'] + '-' + thread['product']['colorCode']
+    product.styleCode = styleCode
 
-            # Append all available sizes for current product into an array
-            parsedSizeList = thread['product']['skus']
-            for size in parsedSizeList:
-                localizedSize = size['localizedSize']
-                product['sizes'].append(localizedSize)
+    # If style code represents an actual product release
+    if styleCode != '999999-999':
+        product.startSellDate = thread['product']['startSellDate']
+        product.publishType = thread['product']['publishType']
+        product.price = thread['product']['price']['currentRetailPrice']
+        product.sizes = []
 
-        products.append(product)
+        # Append all available sizes for current product into an array
+        parsedSizeList = thread['product']['skus']
+        for size in parsedSizeList:
+            localizedSize = size['localizedSize']
+            product.sizes.append(localizedSize)
 
-    return products
\ No newline at end of file
+    return product
\ No newline at end of file
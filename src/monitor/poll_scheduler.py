@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+from datetime import datetime, timezone
+
+# Decides how long the monitor waits between polls.
+# Polls tighten from the base interval down to the minimum as the nearest known release approaches,
+# relax towards the maximum while nothing changes and no release is near, and back off exponentially
+# with jitter when the API fails or rate limits.
+class PollScheduler:
+    def __init__(self, baseInterval = 5, minInterval = 1, maxInterval = 30, releaseWindow = 600, releaseTail = 120, maxBackoff = 300):
+        self.baseInterval = float(baseInterval)
+        self.minInterval = min(float(minInterval), self.baseInterval)
+        self.maxInterval = max(float(maxInterval), self.baseInterval)
+        self.releaseWindow = float(releaseWindow)
+        self.releaseTail = float(releaseTail)
+        self.maxBackoff = float(maxBackoff)
+
+        # Known release times in seconds since epoch, by product id
+        self.releases = {}
+
+        self.quietPolls = 0
+        self.failures = 0
+
+        # Current cadence, exposed for logging and metrics
+        self.interval = self.baseInterval
+        self.reason = 'base'
+
+    # Remembers release times of product records
+    def observe(self, products):
+        for product in products:
+            releaseTime = parseSellDate(product.startSellDate)
+            if releaseTime is not None and product.id is not None:
+                self.releases[product.id] = releaseTime
+
+    # Records a poll that returned data. Changed is true if any new or changed product was found
+    def recordSuccess(self, changed):
+        self.failures = 0
+        self.quietPolls = 0 if changed else self.quietPolls + 1
+
+    # Records a poll that failed. Rate limiting or bans back off harder than other failures
+    def recordFailure(self, rateLimited = False):
+        self.failures += 2 if rateLimited else 1
+
+    # Returns seconds until the nearest release that has not ended yet, or None if none is known.
+    # Releases that ended more than releaseTail seconds ago are forgotten
+    def secondsToNextRelease(self, now = None):
+        now = time.time() if now is None else now
+
+        nearest = None
+        for id, releaseTime in list(self.releases.items()):
+            if releaseTime < now - self.releaseTail:
+                del self.releases[id]
+                continue
+
+            remaining = max(0.0, releaseTime - now)
+            if nearest is None or remaining < nearest:
+                nearest = remaining
+
+        return nearest
+
+    # Computes and returns number of seconds to wait before the next poll
+    def nextInterval(self, now = None):
+        if self.failures > 0:
+            # Full jitter, so replicas that were rate limited together do not retry together
+            ceiling = min(self.maxBackoff, self.baseInterval * (2 ** min(self.failures, 16)))
+            self.interval = random.uniform(self.baseInterval, max(self.baseInterval, ceiling))
+            self.reason = 'backoff'
+            return self.interval
+
+        remaining = self.secondsToNextRelease(now)
+
+        if remaining is not None and remaining <= self.releaseWindow:
+            # Interpolate linearly from base interval at the edge of the window down to minimum at release time
+            progress = remaining / self.releaseWindow if self.releaseWindow > 0 else 0.0
+            self.interval = self.minInterval + (self.baseInterval - self.minInterval) * progress
+            self.reason = 'release in ' + str(int(remaining)) + 's'
+        elif self.quietPolls > 0:
+            # Relax gradually while the feed stays the same
+            self.interval = min(self.maxInterval, self.baseInterval * (1.25 ** self.quietPolls))
+            self.reason = 'quiet for ' + str(self.quietPolls) + ' polls'
+        else:
+            self.interval = self.baseInterval
+            self.reason = 'base'
+
+        return self.interval
+
+# Returns start sell date of a product in seconds since epoch, or None if it is missing or malformed.
+# Dates without a timezone are in UTC
+def parseSellDate(sellDate):
+    if not sellDate:
+        return None
+
+    for dateFormat in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            parsed = datetime.strptime(sellDate.rstrip('Z'), dateFormat)
+            return parsed.replace(tzinfo = timezone.utc).timestamp()
+        except ValueError:
+            continue
+
+    return None
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import random
+import asyncio
+import aiohttp
+
+# Health of a single proxy, tracked as moving averages of latency and error rate.
+# Proxies that get banned or rate limited are put on cooldown for an increasing amount of time
+class ProxyHealth:
+    # Weight of the newest sample in the moving averages
+    smoothing = 0.3
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.errorRate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.bans = 0
+        self.cooldownUntil = 0.0
+
+    # Lower is better. Proxies that were never tried score best, so each one gets measured
+    def score(self):
+        if self.latency is None:
+            return 0.0
+
+        return self.latency * (1.0 + 4.0 * self.errorRate)
+
+    def isAvailable(self, now):
+        return now >= self.cooldownUntil
+
+    def recordSuccess(self, latency):
+        self.requests += 1
+        self.bans = 0
+        self.latency = latency if self.latency is None else self.smoothing * latency + (1 - self.smoothing) * self.latency
+        self.errorRate = (1 - self.smoothing) * self.errorRate
+
+    def recordFailure(self, banned, baseCooldown):
+        self.requests += 1
+        self.failures += 1
+        self.errorRate = self.smoothing + (1 - self.smoothing) * self.errorRate
+
+        # Back off exponentially from proxies that the API refuses to serve
+        if banned:
+            self.bans += 1
+            self.cooldownUntil = time.time() + baseCooldown * (2 ** min(self.bans - 1, 6))
+
+# Polls one url through many proxies from a single asyncio event loop.
+# Requests are started a few milliseconds apart on the healthiest proxies, the first successful
+# response wins, and responses arriving within a short grace period replace it if they are fresher.
+# If given, onStatus is called with the status code of every response, e.g. to notice rate limiting.
+class ProxyPool:
+    def __init__(self, proxies, width = 3, stagger = 0.05, grace = 0.05, timeout = 5.0, cooldown = 30.0, onStatus = None):
+        self.proxies = [ProxyHealth(proxy) for proxy in proxies]
+        self.width = max(1, int(width))
+        self.stagger = float(stagger)
+        self.grace = float(grace)
+        self.timeout = float(timeout)
+        self.cooldown = float(cooldown)
+        self.onStatus = onStatus
+
+        # Event loop and session live as long as the pool, so connections to every proxy are kept alive
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+
+    # Returns healthiest proxies that are not on cooldown, trying unmeasured proxies first
+    def selectProxies(self):
+        now = time.time()
+        available = [proxy for proxy in self.proxies if proxy.isAvailable(now)]
+
+        # If every proxy is on cooldown, try the one that will recover first rather than skipping the poll
+        if len(available) == 0:
+            return [min(self.proxies, key = lambda proxy: proxy.cooldownUntil)]
+
+        # Shuffle first, so proxies with equal scores take turns
+        random.shuffle(available)
+        available.sort(key = lambda proxy: proxy.score())
+
+        return available[:self.width]
+
+    # Fetches every url concurrently, each one through its own set of proxies, and yields the url and
+    # (decoded body, raw body) of the freshest response for each url as soon as it is decided, or the url and None
+    # if every request for it failed. Freshness is decided by the specified key function on the decoded body
+    def fetchAll(self, urls, headers, freshness = None):
+        tasks = { self.loop.create_task(self.fetchAsync(url, headers, freshness)): url for url in urls }
+        pending = set(tasks)
+
+        try:
+            while len(pending) > 0:
+                done, pending = self.loop.run_until_complete(asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED))
+
+                for task in done:
+                    yield tasks[task], task.result()
+        finally:
+            # Stop downloading remaining pages if caller stopped reading
+            for task in pending:
+                task.cancel()
+            if len(pending) > 0:
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions = True))
+
+    async def fetchAsync(self, url, headers, freshness):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout = aiohttp.ClientTimeout(total = self.timeout))
+
+        proxies = self.selectProxies()
+        tasks = [asyncio.ensure_future(self.fetchThroughProxy(proxy, url, headers, index * self.stagger)) for index, proxy in enumerate(proxies)]
+
+        best = None
+        deadline = None
+
+        try:
+            pending = set(tasks)
+            while len(pending) > 0:
+                timeout = None if deadline is None else max(0.0, deadline - self.loop.time())
+                done, pending = await asyncio.wait(pending, timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    result = task.result()
+                    if result is None:
+                        continue
+
+                    if best is None or freshness is not None and freshness(result[0]) > freshness(best[0]):
+                        best = result
+
+                # First successful response starts the grace period for fresher ones
+                if best is not None:
+                    if deadline is None:
+                        deadline = self.loop.time() + self.grace
+                    if self.loop.time() >= deadline:
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+
+        return best
+
+    # Returns parsed JSON body and raw body of response through a single proxy, or None if request failed
+    async def fetchThroughProxy(self, proxy, url, headers, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        start = time.perf_counter()
+
+        try:
+            async with self.session.get(url, headers = headers, proxy = proxy.url) as response:
+                if self.onStatus is not None:
+                    self.onStatus(response.status)
+
+                if response.status != 200:
+                    print("Proxy " + proxy.url + " returned status " + str(response.status))
+                    proxy.recordFailure(response.status in (403, 429), self.cooldown)
+                    return None
+
+                content = await response.read()
+                body = json.loads(content)
+        except asyncio.CancelledError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            print("Proxy " + proxy.url + " failed with error: " + repr(error))
+            proxy.recordFailure(False, self.cooldown)
+            return None
+
+        proxy.recordSuccess(time.perf_counter() - start)
+
+        return body, content
+
+    # Prints health of every proxy, best first
+    def printHealth(self):
+        for proxy in sorted(self.proxies, key = lambda proxy: proxy.score()):
+            latency = 'n/a' if proxy.latency is None else '{:.0f}ms'.format(proxy.latency * 1000)
+            print('{} latency={} errors={:.0%} requests={} cooldown={}'.format(
+                proxy.url, latency, proxy.errorRate, proxy.requests, not proxy.isAvailable(time.time())))
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import zlib
+import queue
+import struct
+import threading
+
+# Start of every segment file, followed by records of
+# (seconds since the epoch, length of url, length of compressed body), url, zlib compressed body
+SEGMENT_MAGIC = b'SNKRSLOG1\n'
+RECORD_HEADER = struct.Struct('>dII')
+SEGMENT_PREFIX = 'responses-'
+SEGMENT_SUFFIX = '.log'
+
+# Appends raw API responses, timestamped and compressed, to a rolling log of segment files in directory,
+# so a launch day can be replayed later with response_replay.py. Responses are compressed and written on a
+# thread of their own, so polling never waits for the disk. A new segment is started once the current one
+# holds segmentBytes, and the oldest segments are removed while the log holds more than maxBytes.
+# If the writer falls behind by queueSize responses, new ones are dropped rather than held in memory
+class ResponseLog:
+    def __init__(self, directory, segmentBytes = None, maxBytes = None, compression = None, queueSize = None):
+        self.directory = directory
+        self.segmentBytes = int(segmentBytes) if segmentBytes is not None else int(os.getenv('RESPONSE_LOG_SEGMENT_BYTES', 64 * 1024 * 1024))
+        self.maxBytes = int(maxBytes) if maxBytes is not None else int(os.getenv('RESPONSE_LOG_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+        self.compression = int(compression) if compression is not None else int(os.getenv('RESPONSE_LOG_COMPRESSION', 6))
+
+        self.responses = queue.Queue(int(queueSize) if queueSize is not None else int(os.getenv('RESPONSE_LOG_QUEUE_SIZE', 100)))
+        self.file = None
+        self.counters = { 'written': 0, 'dropped': 0, 'failed': 0 }
+        self.lock = threading.Lock()
+        self.writer = None
+
+    # Queues raw response body of url to be written, stamped with the time it arrived
+    def append(self, url, body, receivedAt = None):
+        if self.writer is None:
+            self.start()
+
+        try:
+            self.responses.put_nowait((receivedAt if receivedAt is not None else time.time(), url, body))
+        except queue.Full:
+            self.count('dropped')
+
+    def start(self):
+        with self.lock:
+            if self.writer is None:
+                os.makedirs(self.directory, exist_ok = True)
+                self.writer = threading.Thread(target = self.write, name = 'response-log', daemon = True)
+                self.writer.start()
+                print("Recording API responses to " + self.directory)
+
+    # Writes queued responses on the writer thread, forever
+    def write(self):
+        while True:
+            receivedAt, url, body = self.responses.get()
+
+            try:
+                encodedUrl = url.encode('utf-8')
+                compressed = zlib.compress(body, self.compression)
+
+                if self.file is None or self.file.tell() >= self.segmentBytes:
+                    self.rotate(receivedAt)
+
+                self.file.write(RECORD_HEADER.pack(receivedAt, len(encodedUrl), len(compressed)))
+                self.file.write(encodedUrl)
+                self.file.write(compressed)
+
+                # Records are complete on disk once written, so a replay can follow the segment being written
+                if self.responses.empty():
+                    self.file.flush()
+
+                self.count('written')
+            except (OSError, zlib.error) as error:
+                print("Failed to record API response with error:")
+                print(error)
+                self.count('failed')
+
+                # Next response starts a new segment, in case the current one is broken
+                self.closeSegment()
+
+    # Starts a new segment named after the time of its first response, and removes the oldest ones beyond maxBytes
+    def rotate(self, startedAt):
+        self.closeSegment()
+
+        name = SEGMENT_PREFIX + time.strftime('%Y%m%d-%H%M%S', time.gmtime(startedAt)) + '-{:03d}'.format(int(startedAt * 1000) % 1000) + SEGMENT_SUFFIX
+        self.file = open(os.path.join(self.directory, name), 'ab')
+        if self.file.tell() == 0:
+            self.file.write(SEGMENT_MAGIC)
+
+        segments = getSegments(self.directory)
+        total = sum(os.path.getsize(segment) for segment in segments)
+        for segment in segments[:-1]:
+            if total <= self.maxBytes:
+                break
+
+            total -= os.path.getsize(segment)
+            os.remove(segment)
+            print("Removed oldest response log segment " + segment)
+
+    def closeSegment(self):
+        if self.file is None:
+            return
+
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def printCounters(self):
+        with self.lock:
+            counters = dict(self.counters)
+
+        print('Response log: {} written, {} dropped, {} failed, {} waiting'.format(
+            counters['written'], counters['dropped'], counters['failed'], self.responses.qsize()))
+
+# Returns paths of every segment in directory, oldest first
+def getSegments(directory):
+    names = sorted(name for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+# Yields (time received, url, raw body) of every response in the segments, oldest first, received between
+# fromTime and untilTime if they are given. Paths are segment files or directories of them.
+# Records are read one at a time, and records outside the range are skipped without being decompressed,
+# so captures of any size are replayed in constant memory. A record cut short at the end of a segment,
+# e.g. by a crash while it was written, ends that segment
+def readResponses(paths, fromTime = None, untilTime = None):
+    segments = []
+    for path in paths:
+        segments.extend(getSegments(path) if os.path.isdir(path) else [path])
+
+    for segment in segments:
+        with open(segment, 'rb') as file:
+            if file.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                print("Skipping " + segment + ", which is not a response log")
+                continue
+
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+
+                receivedAt, urlLength, bodyLength = RECORD_HEADER.unpack(header)
+                if untilTime is not None and receivedAt > untilTime:
+                    return
+
+                url = file.read(urlLength)
+                if fromTime is not None and receivedAt < fromTime:
+                    file.seek(bodyLength, os.SEEK_CUR)
+                    continue
+
+                compressed = file.read(bodyLength)
+                if len(url) < urlLength or len(compressed) < bodyLength:
+                    print("Response log " + segment + " ends with an incomplete record")
+                    break
+
+                yield receivedAt, url.decode('utf-8'), zlib.decompress(compressed)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Replays API responses the monitor recorded with RESPONSE_LOG_DIRECTORY as if they arrived again, at
+# REPLAY_SPEED times the pace they were recorded at, e.g. 1 to 100, or 0 for as fast as possible.
+# Every response is formatted with formatProductData and published with the monitor's sendToPipeline,
+# fingerprint cache included, so the validator and notifier see the load of the recorded day.
+# The pipeline is configured with the same variables as the monitor:
+#   PIPELINE_HOST=localhost OUTGOING_QUEUE=checkDatabase REPLAY_SPEED=10 python3 response_replay.py /responses
+# Pass segment files or directories of them, or RESPONSE_LOG_DIRECTORY is read.
+# REPLAY_FROM and REPLAY_UNTIL limit the replay to part of the capture, as UTC times like 2020-01-17T14:00:00.
+# REPLAY_PUBLISH=false only formats the responses, to measure parsing on its own.
+# Products of a capture are in the database after it was replayed once, so REPLAY_ID_SUFFIX can be appended
+# to every id to replay it again as new products.
+import os
+import sys
+import json
+import time
+import calendar
+import monitor_custom
+import trace_metrics
+from response_log import readResponses
+
+speed = float(os.getenv('REPLAY_SPEED', 1))
+publishing = os.getenv('REPLAY_PUBLISH', 'true').lower() == 'true'
+idSuffix = os.getenv('REPLAY_ID_SUFFIX', '')
+reportInterval = float(os.getenv('REPLAY_REPORT_INTERVAL', 10))
+
+def main():
+    paths = sys.argv[1:] or [path for path in [os.getenv('RESPONSE_LOG_DIRECTORY')] if path]
+    if len(paths) == 0:
+        print("Please pass recorded segments or directories, or specify RESPONSE_LOG_DIRECTORY")
+        return
+
+    # Monitor is only imported when publishing, since it connects to the pipeline
+    monitor_core = None
+    if publishing:
+        import monitor_core
+
+    fromTime = parseTime(os.getenv('REPLAY_FROM'))
+    untilTime = parseTime(os.getenv('REPLAY_UNTIL'))
+
+    counters = { 'responses': 0, 'invalid': 0, 'products': 0, 'published': 0 }
+    recordedStart = None
+    replayStart = None
+    reportedAt = time.time()
+    behind = 0.0
+
+    for receivedAt, url, body in readResponses(paths, fromTime, untilTime):
+        if recordedStart is None:
+            recordedStart = receivedAt
+            replayStart = time.time()
+            print("Replaying responses recorded from " + formatTime(receivedAt) + " at " + (str(speed) + "x speed" if speed > 0 else "full speed"))
+
+        # Wait until the response is due at the replay speed, or remember how far the replay fell behind
+        if speed > 0:
+            wait = replayStart + (receivedAt - recordedStart) / speed - time.time()
+            if wait > 0:
+                if monitor_core is not None:
+                    monitor_core.pipeline.sleep(wait)
+                else:
+                    time.sleep(wait)
+            behind = max(0.0, -wait)
+
+        counters['responses'] += 1
+        fetchedAt = trace_metrics.getTimestamp()
+
+        try:
+            products = monitor_custom.formatProductData(json.loads(body))
+        except (ValueError, KeyError, TypeError) as error:
+            print("Failed to format recorded response of " + url + " with error:")
+            print(error)
+            products = None
+
+        if products is None:
+            counters['invalid'] += 1
+            continue
+
+        if idSuffix:
+            for product in products:
+                product.id = str(product.id) + idSuffix
+
+        counters['products'] += len(products)
+        if monitor_core is not None and len(products) > 0:
+            counters['published'] += monitor_core.sendToPipeline(products, { 'polled': fetchedAt, 'fetched': fetchedAt })
+
+        if time.time() - reportedAt >= reportInterval:
+            reportedAt = time.time()
+            printProgress(counters, replayStart, receivedAt, behind)
+
+    if recordedStart is None:
+        print("No recorded responses found")
+        return
+
+    printProgress(counters, replayStart, receivedAt, behind)
+    print("Finished replay")
+
+def printProgress(counters, replayStart, receivedAt, behind):
+    elapsed = max(0.001, time.time() - replayStart)
+    print('Replayed {} responses up to {}: {} products ({:.1f}/s), {} published, {} invalid, {:.1f}s behind schedule'.format(
+        counters['responses'], formatTime(receivedAt), counters['products'], counters['products'] / elapsed,
+        counters['published'], counters['invalid'], behind))
+
+# Returns seconds since the epoch of a UTC time like 2020-01-17T14:00:00, or None if it is not set
+def parseTime(value):
+    if not value:
+        return None
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+def formatTime(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+import codecs
+
+# Tokens that change nesting depth. A lone quote means a string is cut off at the end of the buffer
+structureRegex = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]]')
+
+# Key of the top level array that holds the products
+threadsKeyRegex = re.compile(r'\s*:\s*\[')
+
+# Incrementally parses the API response from a stream of byte chunks, and yields each element of the
+# top level 'threads' array as soon as it has been received, without keeping the whole body in memory.
+# Only the element that is currently being received is buffered.
+class ThreadStream:
+    def __init__(self, chunks, key = 'threads'):
+        self.chunks = iter(chunks)
+        self.key = '"' + key + '"'
+        self.textDecoder = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+
+        # Set once the start of the threads array was found, so callers can tell an empty feed from a missing one
+        self.found = False
+
+        self.buffer = ''
+        self.finished = False
+
+    # Appends next chunk to buffer. Returns False if stream has ended
+    def read(self):
+        if self.finished:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.buffer += self.textDecoder.decode(b'', final = True)
+            self.finished = True
+            return False
+
+        self.buffer += self.textDecoder.decode(chunk)
+        return True
+
+    def __iter__(self):
+        if not self.seekThreads():
+            return
+
+        while True:
+            # Skip separators until the next element or the end of the array
+            position = 0
+            while True:
+                while position < len(self.buffer) and self.buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(self.buffer) or not self.read():
+                    break
+
+            self.buffer = self.buffer[position:]
+            if len(self.buffer) == 0 or self.buffer[0] == ']':
+                return
+
+            element = self.decodeElement()
+            if element is None:
+                raise ValueError("Response ended in the middle of a thread")
+
+            value, end = element
+            self.buffer = self.buffer[end:]
+            yield value
+
+    # Consumes input up to and including the opening bracket of the threads array at the top level of the body.
+    # Returns False if the body has no such array
+    def seekThreads(self):
+        depth = 0
+        position = 0
+
+        while True:
+            match = structureRegex.search(self.buffer, position)
+
+            # Keep reading while the buffer ends in the middle of a token
+            if match is None or match.group(0) == '"':
+                if not self.read():
+                    return False
+                continue
+
+            token = match.group(0)
+            position = match.end()
+
+            if token in '{[':
+                depth += 1
+            elif token in '}]':
+                depth -= 1
+            elif depth == 1 and token == self.key:
+                # Key must be followed by a colon and an array, which may not have arrived yet
+                following = threadsKeyRegex.match(self.buffer, position)
+                while following is None and len(self.buffer) - position < 64 and self.read():
+                    following = threadsKeyRegex.match(self.buffer, position)
+
+                if following is not None:
+                    self.buffer = self.buffer[following.end():]
+                    self.found = True
+                    return True
+
+            # Drop what has been scanned, keeping buffer small while looking for the key
+            self.buffer = self.buffer[position:]
+            position = 0
+
+    # Returns element at the start of the buffer and index just past it, reading more input as needed,
+    # or None if the stream ended first
+    def decodeElement(self):
+        # Usually the whole element is already buffered, so let the decoder try first. Elements that span
+        # more than a couple of reads are scanned instead, so they are not decoded again after every read
+        attempts = 0
+        while attempts < 2 or self.buffer[0] not in '{[':
+            try:
+                value, end = self.decoder.raw_decode(self.buffer)
+
+                # Scalars can only be trusted once something follows them
+                if end < len(self.buffer) or self.buffer[0] in '{[' or self.finished:
+                    return value, end
+            except ValueError:
+                if self.finished:
+                    return None
+
+            self.read()
+            attempts += 1
+
+        end = self.findElementEnd()
+        if end is None:
+            return None
+
+        return json.loads(self.buffer[:end]), end
+
+    # Returns index just past the object or array at the start of the buffer, reading more input as needed,
+    # or None if the stream ended first. Scanning resumes where it stopped after each read
+    def findElementEnd(self):
+        depth = 0
+        position = 0
+
+        while True:
+            match = structureRegex.search(self.buffer, position)
+
+            if match is None or match.group(0) == '"':
+                # Continue from the cut off token once more input arrives
+                if match is not None:
+                    position = match.start()
+                else:
+                    position = len(self.buffer)
+
+                if not self.read():
+                    return None
+                continue
+
+            token = match.group(0)
+            position = match.end()
+
+            if token in '{[':
+                depth += 1
+            elif token in '}]':
+                depth -= 1
+                if depth == 0:
+                    return position
@@ -3,8 +3,18 @@ import os
 from enum import Enum
 import re
 import json
-import requests
+import time
+import threading
+import functools
+from collections import OrderedDict
 from datetime import datetime
+from url_verifier import UrlVerifier
+
+# Checks urls of every notification, shared so results are cached across products
+urlVerifier = UrlVerifier()
+
+# Content types accepted for product images
+imageFormats = ["image/jpg", "image/jpeg", "image/png"]
 
 # Specify which website is being parsed
 class Store(Enum):
@@ -16,9 +26,34 @@ class Gender(Enum):
     Female = 2
     Both = 3
 
+# Defaults of every notification, read once instead of for every product. Color may be written in hex, e.g. 0x00ff00
+defaultColor = int(os.getenv('NOTIFICATION_DEFAULT_COLOR', "0x00ff00"), 0)
+defaultTitle = os.getenv('NOTIFICATION_DEFAULT_TITLE', "Title Unavailable")
+defaultSizeSeparator = os.getenv('NOTIFICATION_DEFAULT_SIZE_SEPARATOR', ', ')
+defaultImage = os.getenv('NOTIFICATION_DEFAULT_IMAGE')
+
+# Formatting rules of a store, compiled once and shared by every notification.
+# Regex must create groups in the form: (Male/Female/Other) (Size) and must support sizes that have no gender,
+# which automatically categorizes them as male. The same size strings appear in almost every product of a store,
+# so each one is parsed once and the groups are remembered
+class StoreConfig:
+    def __init__(self, sizeParsingRegex, sizeCacheSize = None):
+        self.sizeParsingRegex = re.compile(sizeParsingRegex)
+        self.parseSize = functools.lru_cache(maxsize = int(sizeCacheSize) if sizeCacheSize is not None else int(os.getenv('NOTIFICATION_SIZE_CACHE_SIZE', 4096)))(self.parseSizeUncached)
+
+    # Returns tuple of (gender, size) groups of a size string
+    def parseSizeUncached(self, size):
+        return tuple(self.sizeParsingRegex.findall(size))
+
+storeConfigs = {
+    # From string 'M 7 / W 6.5' creates groups (M) (7) (W) (6.5)
+    # From string '12.5' creates groups () (12.5)
+    Store.Nike: StoreConfig(r"([MW]?)[ ]?([\d]+[\.]?[\d]*)")
+}
+
 class FormatNotification:
-    # Regex expresion used to parse each product size string
-    sizeParsingRegex = None
+    # Compiled formatting rules of the store
+    config = None
 
     color = None
     title = None
@@ -29,25 +64,23 @@ class FormatNotification:
     sellDate = None
     price = None
     sizes = None
+    changes = None
 
     def __init__(self, store):
-        # Must specify regex to parse size list. Regex must create groups in the form: (Male/Female/Other) (Size)
-        # and must support sizes that have no gender, which automatically categorizes them as male
-        if store is Store.Nike:
-            # From string 'M 7 / W 6.5' creates groups (M) (7) (W) (6.5)
-            # From string '12.5' creates groups () (12.5)
-            self.sizeParsingRegex = r"([MW]?)[ ]?([\d]+[\.]?[\d]*)"
-        else:
-            self.sizeParsingRegex = None
+        self.config = storeConfigs.get(store)
+        if self.config is None:
             print("Store not specified for formatting notification")
 
     # Accepts all product attributes. If set to None, they will not be included in final notification
     def configure(self, color = None, title = None, url = None, sku = None, imageUrl = None, publishType = None, sellDate = None, price = None):
         # Validate and set notification parameters
-        self.color = int(color) if color is not None else int(os.getenv('NOTIFICATION_DEFAULT_COLOR', "0x00ff00"))
-        self.title = str(title) if title is not None else os.getenv('NOTIFICATION_DEFAULT_TITLE', "Title Unavailable")
-        self.url = url if self.verifyUrl(url) else None
-        self.image = imageUrl if self.verifyUrl(imageUrl, ["image/jpg", "image/jpeg", "image/png"]) else os.getenv('NOTIFICATION_DEFAULT_IMAGE')
+        self.color = int(color) if color is not None else defaultColor
+        self.title = str(title) if title is not None else defaultTitle
+
+        # Both urls are checked at once, and usually answered from the cache
+        urlValid, imageValid = urlVerifier.verifyAll([(url, None), (imageUrl, imageFormats)])
+        self.url = url if urlValid else None
+        self.image = imageUrl if imageValid else defaultImage
         self.sku = sku
         self.publishType = publishType
         self.sellDate = sellDate
@@ -77,65 +110,66 @@ class FormatNotification:
 
         self.sizes = result if result else None
 
+    # Configures list of changes of a product that was already notified before, e.g. a restock or price drop.
+    # Changes map what changed to [old, new], or to the sizes that were added or removed
+    def configureChanges(self, changes, separatorString = None):
+        if not changes:
+            self.changes = None
+            return
+
+        if separatorString is None:
+            separatorString = defaultSizeSeparator
+
+        lines = []
+        if 'sizesAdded' in changes:
+            lines.append('Restocked: ' + separatorString.join(changes['sizesAdded']))
+        if 'sizesRemoved' in changes:
+            lines.append('Sold out: ' + separatorString.join(changes['sizesRemoved']))
+
+        for key, name in (('price', 'Price'), ('publishType', 'Publish Type'), ('startSellDate', 'Launch Date')):
+            if key in changes:
+                old, new = changes[key]
+                lines.append(name + ': ' + str(old) + ' -> ' + str(new))
+
+        self.changes = "\n".join(lines) if lines else None
+
     def printSizesForGender(self, sizes, genderString, separatorString):
         if sizes is None or len(sizes) == 0:
             return ''
 
-        result = genderString + "\n"
-
-        # Read default separator if none specified
+        # Use default separator if none specified
         if separatorString is None:
-            separatorString = os.getenv('NOTIFICATION_DEFAULT_SIZE_SEPARATOR', ', ')
+            separatorString = defaultSizeSeparator
 
         # Print each size in list with separator in between
-        result += sizes[0]
-        for i in range(1, len(sizes)):
-            result += separatorString
-            result += sizes[i]
-        
-        return result
+        return genderString + "\n" + separatorString.join(sizes)
 
     # Returns object containing lists of sizes for each gender, parsed using regex
     def parseSizesFromStrings(self, sizes):
         result = { "M": [], "W": [] }
 
-        if sizes is None or not isinstance(sizes, list):
+        if sizes is None or not isinstance(sizes, list) or self.config is None:
             return result
 
         currentGender = "M"
 
-        # Go through each string and parse it into groups
+        # Go through each string and parse it into groups, remembered from earlier products
         for size in sizes:
-            parsedString = re.findall(self.sizeParsingRegex, size)
-
-            for group in parsedString:
+            for group in self.config.parseSize(size):
                 if group[0]:
                     currentGender = group[0]
                 result[currentGender].append(group[1])
 
         return result
 
-    # Returns true if url is valid, and optionally matches one of the specified formats, or False otherwise
-    def verifyUrl(self, url, contentFormats = None):
-        if url is not None:
-            try:
-                # Get headers from url and return image url if valid
-                response = requests.head(url)
-
-                if response.status_code < 400:
-                    if contentFormats is None or contentFormats is not None and response.headers["content-type"] in contentFormats:
-                        return True
-            except HttpError as error:
-                print("Invalid product url with error: ")
-                print(error)
-
-        return False
-
     def getDiscordData(self):
+        return getDiscordData(self.getEmbed())
+
+    # Returns discord embed of the notification without its footer, which holds the time it is sent
+    def getEmbed(self):
         embeds = {
             'color': self.color,
-            'title': self.title,
-            'footer': { 'text': 'SNKRS by NS | ' + datetime.now().strftime("%m/%d/%Y, %H:%M:%S") }
+            'title': self.title
         }
 
         if self.url is not None:
@@ -145,6 +179,8 @@ class FormatNotification:
             embeds['thumbnail'] = { 'url': self.image, 'height': 300, 'width': 270 }
 
         fields = []
+        if self.changes is not None:
+            fields.append({ 'name': 'Changes', 'value': self.changes, 'inline': False })
         if self.sku is not None:
             fields.append({ 'name': 'SKU', 'value': self.sku, 'inline': True })
         if self.sellDate is not None:
@@ -158,7 +194,89 @@ class FormatNotification:
 
         embeds['fields'] = fields
 
-        return { 'embeds': [embeds] }
+        return embeds
 
     def getSlackData(self):
-        return None
+        return getSlackData(self.getSlackAttachment())
+
+    # Returns slack attachment of the notification without its timestamp, laid out like the discord embed
+    def getSlackAttachment(self):
+        attachment = {
+            'color': '#{:06x}'.format(self.color),
+            'title': self.title,
+            'fallback': self.title
+        }
+
+        if self.url is not None:
+            attachment['title_link'] = self.url
+
+        if self.image is not None:
+            attachment['thumb_url'] = self.image
+
+        fields = []
+        if self.changes is not None:
+            fields.append({ 'title': 'Changes', 'value': self.changes, 'short': False })
+        if self.sku is not None:
+            fields.append({ 'title': 'SKU', 'value': self.sku, 'short': True })
+        if self.sellDate is not None:
+            fields.append({ 'title': 'Launch Date', 'value': self.sellDate.strftime("%m/%d/%Y, %H:%M"), 'short': True })
+        if self.publishType is not None:
+            fields.append({ 'title': 'Publish Type', 'value': self.publishType, 'short': True })
+        if self.price is not None:
+            fields.append({ 'title': 'Price', 'value': str(self.price), 'short': True })
+        if self.sizes is not None:
+            fields.append({ 'title': 'Sizes', 'value': self.sizes, 'short': False })
+
+        attachment['fields'] = fields
+        attachment['footer'] = 'SNKRS by NS'
+
+        return attachment
+
+# Returns discord notification of an embed, stamped with the current time
+def getDiscordData(embed):
+    embed = dict(embed)
+    embed['footer'] = { 'text': 'SNKRS by NS | ' + datetime.now().strftime("%m/%d/%Y, %H:%M:%S") }
+    return { 'embeds': [embed] }
+
+# Returns slack notification of an attachment, stamped with the current time
+def getSlackData(attachment):
+    attachment = dict(attachment)
+    attachment['ts'] = int(time.time())
+    return { 'attachments': [attachment] }
+
+# Embeds of recently formatted products by fingerprint, so a product that is notified again unchanged,
+# e.g. by a retry or another replica, is not formatted again. Embeds expire after ttl seconds,
+# since they depend on url checks that may have a different answer by then. Every sink has its own cache
+class RenderCache:
+    def __init__(self, capacity = None, ttl = None):
+        self.capacity = max(1, int(capacity) if capacity is not None else int(os.getenv('NOTIFICATION_RENDER_CACHE_SIZE', 1000)))
+        self.ttl = float(ttl) if ttl is not None else float(os.getenv('NOTIFICATION_RENDER_TTL', 300))
+
+        # (expires at, embed) by fingerprint, least recently used first
+        self.embeds = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns embed formatted for fingerprint, or None if there is none or it expired
+    def get(self, fingerprint):
+        with self.lock:
+            cached = self.embeds.get(fingerprint)
+            if cached is None:
+                return None
+
+            if cached[0] <= time.time():
+                del self.embeds[fingerprint]
+                return None
+
+            self.embeds.move_to_end(fingerprint)
+            return cached[1]
+
+    def put(self, fingerprint, embed):
+        with self.lock:
+            self.embeds[fingerprint] = (time.time() + self.ttl, embed)
+            self.embeds.move_to_end(fingerprint)
+            if len(self.embeds) > self.capacity:
+                self.embeds.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.embeds.clear()
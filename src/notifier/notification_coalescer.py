@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+from concurrent.futures import Future
+
+# Products that arrive at the same time, e.g. the threads of a big restock, are collected for a short window
+# and posted to each webhook as messages of up to maxEmbeds embeds, instead of one post per product and webhook.
+# The window starts with the first product and is extended by every product after it, but never beyond
+# maxWait seconds, so no notification waits longer than that. A batch is posted at once when a webhook
+# has maxEmbeds embeds waiting.
+#
+# Pack turns a list of embeds into the message posted for them, so the same window serves every kind of webhook.
+#
+# Handlers only add their embeds to the current batch and get a future back, which completes once the batch was posted,
+# so a worker never waits out the window. A flusher thread posts every batch once it is due, on a thread of its own
+# so a slow post does not hold up the next batch. If posting fails, every message of the batch fails with the error
+class NotificationCoalescer:
+    def __init__(self, delivery, window = None, maxWait = None, maxEmbeds = None, maxCharacters = None, pack = None):
+        self.delivery = delivery
+        self.pack = pack if pack is not None else packEmbeds
+        self.window = float(window) if window is not None else float(os.getenv('NOTIFICATION_COALESCE_WINDOW', 0.5))
+        self.maxWait = float(maxWait) if maxWait is not None else float(os.getenv('NOTIFICATION_COALESCE_MAX_WAIT', 2))
+        self.maxEmbeds = max(1, int(maxEmbeds) if maxEmbeds is not None else int(os.getenv('NOTIFICATION_MAX_EMBEDS', 10)))
+        self.maxCharacters = int(maxCharacters) if maxCharacters is not None else int(os.getenv('NOTIFICATION_MAX_MESSAGE_CHARS', 6000))
+
+        self.batch = None
+        self.condition = threading.Condition()
+        self.flusher = None
+
+    # Adds embeds for every webhook to the current batch and returns at once, with a future that is completed once
+    # they were posted. Result of the future is the list of messages for the delay queues, which is returned to only
+    # one message of the batch, and an empty list to the others
+    def submit(self, webhookUrls, embeds):
+        future = Future()
+        if len(embeds) == 0 or len(webhookUrls) == 0:
+            future.set_result([])
+            return future
+
+        # Without a window, embeds of the message are still packed together
+        if self.maxWait <= 0:
+            self.complete([future], { webhookUrl: list(embeds) for webhookUrl in webhookUrls }, 1)
+            return future
+
+        if self.flusher is None:
+            self.start()
+
+        with self.condition:
+            now = time.time()
+            batch = self.batch
+            if batch is None:
+                batch = self.batch = CoalescedBatch(now + self.maxWait)
+
+            batch.add(webhookUrls, embeds, future)
+            batch.deadline = min(batch.latestDeadline, now + self.window)
+            self.condition.notify_all()
+
+        return future
+
+    def start(self):
+        with self.condition:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target = self.flush, name = 'coalescer', daemon = True)
+                self.flusher.start()
+
+    # Hands every batch over to be posted once its window closed or a webhook has maxEmbeds embeds waiting, forever
+    def flush(self):
+        while True:
+            with self.condition:
+                while self.batch is None:
+                    self.condition.wait()
+
+                batch = self.batch
+                while batch.largest < self.maxEmbeds:
+                    remaining = batch.deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                # Products added from now on start the next batch
+                self.batch = None
+
+            threading.Thread(target = self.complete, args = (batch.futures, batch.embeds, len(batch.futures)), daemon = True).start()
+
+    # Posts embeds and completes futures of the messages they came from, with the retry messages or the error of the post
+    def complete(self, futures, embedsByWebhook, submissions):
+        try:
+            retries = self.post(embedsByWebhook, submissions)
+        except Exception as error:
+            for future in futures:
+                future.set_exception(error)
+            return
+
+        # Retries are published with the first message, which is acknowledged after them
+        futures[0].set_result(retries)
+        for future in futures[1:]:
+            future.set_result([])
+
+    # Posts embeds to their webhooks, packed into as few messages as Discord allows.
+    # Webhooks that get the same embeds share the same messages, which are posted to all of them at once
+    def post(self, embedsByWebhook, submissions):
+        payloads = {}
+        chunksByEmbeds = {}
+        for webhookUrl, embeds in embedsByWebhook.items():
+            # Webhooks usually get the same embeds, which are only split once
+            embedIds = tuple(id(embed) for embed in embeds)
+            chunks = chunksByEmbeds.get(embedIds)
+            if chunks is None:
+                chunks = chunksByEmbeds[embedIds] = self.getChunks(embeds)
+
+            for chunk in chunks:
+                key = tuple(id(embed) for embed in chunk)
+                payload = payloads.get(key)
+                if payload is None:
+                    payload = payloads[key] = (json.dumps(self.pack(chunk)), [])
+                payload[1].append(webhookUrl)
+
+        print("Coalesced notifications of " + str(submissions) + " messages into " + str(len(payloads)) + " posts per webhook group")
+
+        retries = []
+        for data, webhookUrls in payloads.values():
+            results = self.delivery.deliver(webhookUrls, data)
+            retries.extend(self.delivery.getRetryMessages(results, data))
+
+        return retries
+
+    # Splits embeds into lists of up to maxEmbeds, which also stay within the characters Discord allows per message.
+    # Length of the serialized embed is used, which is a little more than the characters Discord counts
+    def getChunks(self, embeds):
+        chunks = []
+        chunk = []
+        characters = 0
+
+        for embed in embeds:
+            length = len(json.dumps(embed))
+            if chunk and (len(chunk) >= self.maxEmbeds or characters + length > self.maxCharacters):
+                chunks.append(chunk)
+                chunk = []
+                characters = 0
+
+            chunk.append(embed)
+            characters += length
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+# Returns discord message of embeds
+def packEmbeds(embeds):
+    return { 'embeds': embeds }
+
+# Embeds collected for each webhook during one window
+class CoalescedBatch:
+    def __init__(self, latestDeadline):
+        self.latestDeadline = latestDeadline
+        self.deadline = latestDeadline
+        self.embeds = {}
+        self.largest = 0
+        self.futures = []
+
+    def add(self, webhookUrls, embeds, future):
+        self.futures.append(future)
+
+        for webhookUrl in webhookUrls:
+            pending = self.embeds.get(webhookUrl)
+            if pending is None:
+                pending = self.embeds[webhookUrl] = []
+
+            pending.extend(embeds)
+            self.largest = max(self.largest, len(pending))
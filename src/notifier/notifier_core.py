@@ -1,123 +1,64 @@
 # -*- coding: utf-8 -*-
 import os
-import requests
-import psycopg2
-import json
-import pika
 import notifier_custom
+import trace_metrics
+from pipeline_client import PipelineClient
+from consumer_pool import ConsumerPool
+from database_pool import DatabasePool
+from webhook_registry import WebhookRegistry
+from sink_consumer import SinkConsumer
+
+# Connection to pipeline is opened once and reused for every message
+pipeline = PipelineClient()
+
+# Connections to database, only used to read webhooks when the management api changes them
+database = DatabasePool()
+
+# Webhooks are held in memory, and read again only when the management api changes them
+webhooks = WebhookRegistry(database)
+
+# Queue products are read from, and prefix of the queue of every sink
+incomingQueue = os.getenv('INCOMING_QUEUE')
+
+# Destinations notifications are posted to, each read from its own queue by its own workers
+sinks = notifier_custom.getSinks(os.getenv('NOTIFIER_SINKS', 'discord,slack,http'))
+sinkConsumers = []
+
+# Latency of every sink, served on METRICS_PORT
+metrics = trace_metrics.Metrics('notifier')
 
 def main():
+    metrics.serve()
+    webhooks.start()
     readFromPipeline()
 
-# Opens connection to pipeline and reads messages from incoming queue
+# Reads messages from incoming queue, reconnecting to pipeline if connection is lost
 def readFromPipeline():
-    # Read name of queue from environment variable
-    queue = os.getenv('INCOMING_QUEUE')
+    queue = incomingQueue
     if queue is None:
         print("Must specify incoming queue as environment variable INCOMING_QUEUE")
         return
 
-    # Connect to pipeline
-    pipelineConnection = pika.BlockingConnection(pika.ConnectionParameters(host = os.getenv('PIPELINE_HOST', 'localhost')))
-    channel = pipelineConnection.channel()
+    for sink in sinks:
+        consumer = SinkConsumer(sink, webhooks, queue, metrics = metrics)
+        consumer.start()
+        sinkConsumers.append(consumer)
 
-    print("Connected to pipeline and " + queue + " queue, waiting for data...")
+    ConsumerPool(pipeline, handleMessage).consume(queue)
 
-    # Create a persistent queue. If it already exists, this will not create another one
-    channel.queue_declare(queue = queue, durable = True)
-
-    # Only receive new message when finished with previous one
-    channel.basic_qos(prefetch_count = 1)
-    channel.basic_consume(queue = queue, on_message_callback = callback)
-    
-    # Enter never ending loop, waiting for messages
-    channel.start_consuming()
-
-# Callback function for when message arrives in incoming queue
-def callback(ch, method, properties, body):
-    print("Received data from pipeline")
-    databaseConnection = connectToDatabase()
-
-    webHookUrls = getWebHooksFromDatabase(databaseConnection)
-    if webHookUrls is None:
+# Hands message on to the queue of every sink that has webhooks. Messages are published before the incoming one
+# is acknowledged, so every sink receives them even if the notifier stops in between
+def handleMessage(properties, body):
+    webHookUrls = webhooks.getWebhooks()
+    if not webHookUrls:
         print("Unable to retrieve webhook urls from database, or none found")
-    
-    # Extract data from pipeline body
-    product = json.loads(body)
-    if product is None:
-        print("Empty product in pipeline")
-
-    # Get notification for discord
-    discordData = notifier_custom.getDiscordNotification(product)
-    if discordData is not None:
-        serializedData = json.dumps(discordData)
-
-        # Send formatted notification to all webhooks in database
-        for webHookUrl in webHookUrls:
-            print("Posting notification to " + webHookUrl)
-            sendToWebhook(webHookUrl, serializedData)
-
-    if databaseConnection is not None:
-        databaseConnection.close()
-        print("Disconnected from database")
-
-    # Acknowledge receipt of data
-    ch.basic_ack(delivery_tag = method.delivery_tag)
-
-# Connects to postgres database
-def connectToDatabase():
-    connection = None
-
-    try:
-        connection = psycopg2.connect(
-            host=os.getenv('DATABASE_HOST', 'localhost'), 
-            database=os.getenv('DATABASE_NAME'), 
-            user=os.getenv('DATABASE_USER', 'postgres'), 
-            password=os.getenv('DATABASE_PASSWORD', 'postgres'), 
-            port=os.getenv('DATABASE_PORT', '5432')
-        )
-
-        # Print database properties
-        if connection is not None:
-            print("Connected to database")
-
-    except (Exception, psycopg2.OperationalError) as error:
-        print("Failed to connect to database with error:")
-        print(error)
-
-    return connection
-
-# Returns list of all webhooks in database
-def getWebHooksFromDatabase(databaseConnection):
-    if databaseConnection is None:
-        return
-
-    webHookList = []
+        return []
 
-    try:
-        cursor = databaseConnection.cursor()
-        cursor.execute('SELECT * FROM "WebHooks"')
-        rows = cursor.fetchall()
-        databaseConnection.commit()
-        cursor.close()
+    sinkNames = set(notifier_custom.getSinkName(webHookUrl) for webHookUrl in webHookUrls)
+    headers = getattr(properties, 'headers', None)
+    contentType = getattr(properties, 'content_type', None)
 
-        for row in rows:
-            webHookList.append(str(row[0]))
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Failed to retrieve webhook urls from database with error:")
-        print(error)
-    
-    return webHookList
-        
-def sendToWebhook(webhookUrl, data):
-    try:
-        response = requests.post(webhookUrl, data = data, headers = {'Content-Type': 'application/json'})
-        if response.status_code == 429:
-            print("Sent too many requests to webhook")
-        elif response.status_code != 204:
-            print("Failed to post to webhook")
-    except HttpError as error:
-        print("Failed to post to webhook with error:")
-        print(error)
+    return [(consumer.queue, body, headers, contentType) for consumer in sinkConsumers if consumer.sink.name in sinkNames]
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,217 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import time
+import hashlib
 from datetime import datetime
+from urllib.parse import urlparse
 import formatNotification
+from product_record import packRecord
 
-def getDiscordNotification(product):
-    if product is None:
-        return
+# Base url of product pages
+urlBase = os.getenv('URL_BASE')
 
-    if isinstance(product, str):
-        print("clearing")
-        return
+# Starts checking urls of products in the background, so they are known by the time notifications are formatted
+def prefetchUrls(products):
+    urls = []
+    for product in products:
+        if urlBase is not None and product.url is not None:
+            urls.append(urlBase + product.url)
+        urls.append(product.image)
 
-    # Get base url for product pages
-    urlBase = os.getenv('URL_BASE')
+    formatNotification.urlVerifier.prefetch(urls)
+
+# Kind of destination notifications are posted to. Every sink renders products in its own format into its own cache,
+# and packs up to maxItems of them into a single post. The notifier gives every sink its own queue and workers,
+# so a slow destination only delays its own notifications
+class NotificationSink:
+    name = None
+
+    # Items per post and characters per post, None for the defaults of the coalescer
+    maxItems = None
+    maxCharacters = None
+
+    # Posts per webhook per period, None for the defaults of the rate limiter
+    rateLimit = None
+    ratePeriod = None
+
+    # True if products are formatted, which needs their urls to be checked first
+    formatsProducts = True
+
+    def __init__(self):
+        self.renderCache = formatNotification.RenderCache()
+
+    # Returns list of items for products, formatting only the ones that are not in the cache
+    def render(self, products):
+        if self.formatsProducts:
+            prefetchUrls(products)
+
+        items = []
+        for product in products:
+            if product is None:
+                continue
+
+            # Product that was formatted recently with the same attributes is not formatted again
+            fingerprint = getFingerprint(product)
+            item = self.renderCache.get(fingerprint)
+            if item is None:
+                item = self.format(product)
+                if item is None:
+                    continue
+                self.renderCache.put(fingerprint, item)
+
+            items.append(self.stamp(item))
+
+        return items
+
+    # Returns item of a single product, or None if it can not be notified
+    def format(self, product):
+        raise NotImplementedError
+
+    # Returns copy of a cached item with the time it is sent
+    def stamp(self, item):
+        return item
+
+    # Returns body of a post of items
+    def pack(self, items):
+        raise NotImplementedError
+
+    # Returns true if webhook belongs to this sink
+    @staticmethod
+    def matches(webhookUrl):
+        raise NotImplementedError
+
+class DiscordSink(NotificationSink):
+    name = 'discord'
+
+    def format(self, product):
+        formatter = getFormatter(product)
+        return formatter.getEmbed() if formatter is not None else None
+
+    def stamp(self, item):
+        return formatNotification.getDiscordData(item)['embeds'][0]
+
+    def pack(self, items):
+        return { 'embeds': items }
+
+    @staticmethod
+    def matches(webhookUrl):
+        host = getHost(webhookUrl)
+        return host in ('discord.com', 'discordapp.com') or host.endswith('.discord.com') or host.endswith('.discordapp.com')
+
+class SlackSink(NotificationSink):
+    name = 'slack'
+    maxItems = 20
+    maxCharacters = 40000
+
+    # Slack allows about one post per second to an incoming webhook
+    rateLimit = 1
+    ratePeriod = 1
+
+    def format(self, product):
+        formatter = getFormatter(product)
+        return formatter.getSlackAttachment() if formatter is not None else None
+
+    def stamp(self, item):
+        return formatNotification.getSlackData(item)['attachments'][0]
+
+    def pack(self, items):
+        return { 'attachments': items }
+
+    @staticmethod
+    def matches(webhookUrl):
+        return getHost(webhookUrl) == 'hooks.slack.com'
+
+# Posts products as plain JSON to any other webhook, e.g. { 'products': [{ 'id': ..., 'url': ..., 'sizes': [...] }] }
+class HttpSink(NotificationSink):
+    name = 'http'
+    maxItems = 50
+    maxCharacters = 1000000
+    formatsProducts = False
+
+    def format(self, product):
+        item = product.toDict()
+        if urlBase is not None and product.url is not None:
+            item['url'] = urlBase + product.url
+        return item
+
+    def stamp(self, item):
+        item = dict(item)
+        item['notifiedAt'] = time.time()
+        return item
+
+    def pack(self, items):
+        return { 'products': items }
+
+    @staticmethod
+    def matches(webhookUrl):
+        return True
+
+# Sinks by name, in the order webhooks are matched against them
+sinkTypes = [DiscordSink, SlackSink, HttpSink]
+
+# Returns sinks with the specified names, e.g. 'discord,slack,http'
+def getSinks(names):
+    names = [name.strip().lower() for name in names.split(',') if name.strip()]
+    sinks = [sinkType() for sinkType in sinkTypes if sinkType.name in names]
+
+    for name in names:
+        if name not in [sinkType.name for sinkType in sinkTypes]:
+            print("Ignoring unknown notification sink " + name)
+
+    return sinks
+
+# Returns name of the sink a webhook belongs to
+def getSinkName(webhookUrl):
+    for sinkType in sinkTypes:
+        if sinkType.matches(webhookUrl):
+            return sinkType.name
+
+# Returns formatter configured with every attribute of the product, or None if it can not be formatted
+def getFormatter(product):
+    # Base url for product pages must be specified
     if urlBase is None:
         print("Product url is not specified")
-        return
+        return None
 
     formatter = formatNotification.FormatNotification(formatNotification.Store.Nike)
 
+    styleCode = product.styleCode
+    print("Formatting notification for product " + str(styleCode))
+    if styleCode == '999999-999':
+        styleCode = None
+
+    # Format all attributes to be displayed
+    formatter.configure(
+        color = None,
+        title = product.title,
+        url = urlBase + product.url if product.url is not None else None,
+        sku = styleCode,
+        imageUrl = product.image,
+        publishType = product.publishType,
+        sellDate = datetime.strptime(product.startSellDate, '%Y-%m-%dT%H:%M:%S.%f') if product.startSellDate is not None else None,
+        price = product.price
+    )
+
+    # Format how size list will be displayed
+    formatter.configureSizes(
+        product.sizes,
+        formatNotification.Gender.Both,
+        " | "
+    )
+
+    # List what changed if product was already notified before
+    formatter.configureChanges(product.changes)
+
+    return formatter
+
+# Returns stable digest of every attribute of the product, including its changes
+def getFingerprint(product):
+    return hashlib.blake2b(packRecord(product), digest_size = 16).digest()
+
+# Returns lowercase host of a url, or an empty string if it has none
+def getHost(url):
     try:
-        styleCode = product['styleCode']
-        print("Formatting notification for product " + str(styleCode))
-        if styleCode == '999999-999':
-            styleCode = None
-
-        # Format all attributes to be displayed
-        formatter.configure(
-            color = None,
-            title = product['title'], 
-            url = urlBase + product['url'], 
-            sku = styleCode,
-            imageUrl = product['image'] if 'image' in product else None, 
-            publishType = product['publishType'] if 'publishType' in product else None, 
-            sellDate = datetime.strptime(product['startSellDate'], '%Y-%m-%dT%H:%M:%S.%f') if 'startSellDate' in product else None, 
-            price = product['price'] if 'price' in product else None
-        )
-
-        # Format how size list will be displayed
-        formatter.configureSizes(
-            product['sizes'] if 'sizes' in product else None,
-            formatNotification.Gender.Both,
-            " | "
-        )
-    except KeyError as missingKey:
-        print("Missing key: " + str(missingKey))
-        pass
-
-    # Get discord notification and serialize it
-    return formatter.getDiscordData()
\ No newline at end of file
+        return (urlparse(url).hostname or '').lower()
+    except ValueError:
+        return ''
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+
+# Allows capacity sends per period, refilling continuously. Taking a token that is not there yet reserves it,
+# so callers that take one after another are spaced out instead of all waiting for the same token
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = max(1, int(capacity))
+        self.period = float(period)
+        self.tokens = float(self.capacity)
+        self.updatedAt = time.time()
+
+        # Set when the server said no send will succeed before this time
+        self.blockedUntil = 0.0
+
+    def refill(self, now):
+        self.tokens = min(float(self.capacity), self.tokens + (now - self.updatedAt) * self.capacity / self.period)
+        self.updatedAt = now
+
+    # Returns seconds until the next token can be taken
+    def waitTime(self, now):
+        self.refill(now)
+
+        wait = max(0.0, self.blockedUntil - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) * self.period / self.capacity)
+
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    # Adjusts bucket to the limit the server reported, e.g. Discord's X-RateLimit-Limit, -Remaining and -Reset-After
+    def update(self, now, limit = None, remaining = None, resetAfter = None):
+        if limit is not None and limit > 0:
+            self.capacity = limit
+
+        if remaining is not None:
+            self.refill(now)
+            self.tokens = min(self.tokens, float(remaining))
+
+            if remaining <= 0 and resetAfter is not None:
+                self.blockedUntil = max(self.blockedUntil, now + resetAfter)
+
+    def block(self, now, seconds):
+        self.blockedUntil = max(self.blockedUntil, now + seconds)
+
+# Paces sends to every webhook ahead of time, with one bucket per webhook and one shared by all of them,
+# since Discord limits both single webhooks and everything sent from one address
+class RateLimiter:
+    def __init__(self, limit = None, period = None, globalLimit = None, globalPeriod = None):
+        self.limit = int(limit) if limit is not None else int(os.getenv('WEBHOOK_RATE_LIMIT', 5))
+        self.period = float(period) if period is not None else float(os.getenv('WEBHOOK_RATE_PERIOD', 2))
+
+        # Shared limit is off unless configured, but a 429 that Discord marks as global still blocks every webhook
+        globalLimit = int(globalLimit) if globalLimit is not None else int(os.getenv('WEBHOOK_GLOBAL_RATE_LIMIT', 0))
+        globalPeriod = float(globalPeriod) if globalPeriod is not None else float(os.getenv('WEBHOOK_GLOBAL_RATE_PERIOD', 1))
+        self.globalBucket = TokenBucket(globalLimit if globalLimit > 0 else 1000000, globalPeriod)
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def getBucket(self, webhookUrl):
+        bucket = self.buckets.get(webhookUrl)
+        if bucket is None:
+            bucket = self.buckets[webhookUrl] = TokenBucket(self.limit, self.period)
+        return bucket
+
+    # Reserves a send to webhook if one is possible within maxWait seconds, and returns seconds to wait before sending.
+    # If it is not possible that soon, nothing is reserved, and the returned wait is longer than maxWait
+    def reserve(self, webhookUrl, maxWait):
+        now = time.time()
+
+        with self.lock:
+            bucket = self.getBucket(webhookUrl)
+            wait = max(bucket.waitTime(now), self.globalBucket.waitTime(now))
+
+            if wait <= maxWait:
+                bucket.take()
+                self.globalBucket.take()
+
+            return wait
+
+    # Reads Discord's rate limit headers of a response to webhook
+    def update(self, webhookUrl, headers):
+        limit = parseNumber(headers.get('X-RateLimit-Limit'))
+        remaining = parseNumber(headers.get('X-RateLimit-Remaining'))
+        resetAfter = parseNumber(headers.get('X-RateLimit-Reset-After'))
+
+        if limit is None and remaining is None:
+            return
+
+        with self.lock:
+            self.getBucket(webhookUrl).update(time.time(), int(limit) if limit is not None else None, remaining, resetAfter)
+
+    # Stops sends to webhook, or to every webhook if the limit was global, for the specified number of seconds
+    def block(self, webhookUrl, seconds, isGlobal = False):
+        with self.lock:
+            bucket = self.globalBucket if isGlobal else self.getBucket(webhookUrl)
+            bucket.block(time.time(), seconds)
+
+# Returns number in a header, or None if header is missing or not a number
+def parseNumber(value):
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
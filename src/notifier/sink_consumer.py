@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import functools
+import product_record
+import trace_metrics
+import notifier_custom
+from pipeline_client import PipelineClient
+from consumer_pool import ConsumerPool
+from rate_limiter import RateLimiter
+from webhook_delivery import WebhookDelivery
+from notification_coalescer import NotificationCoalescer
+
+# Delivers notifications of a single sink. Every sink reads its own queue, and its own retry queue, on its own
+# connection to the pipeline with its own workers, and posts through its own connections and rate limits,
+# so a slow or failing destination does not hold up notifications to the others
+class SinkConsumer:
+    def __init__(self, sink, webhooks, incomingQueue, retryQueue = None, metrics = None):
+        self.sink = sink
+        self.webhooks = webhooks
+        self.metrics = metrics if metrics is not None else trace_metrics.Metrics('notifier')
+        self.labels = { 'sink': sink.name }
+        self.queue = incomingQueue + '.' + sink.name
+
+        retryQueue = retryQueue if retryQueue is not None else os.getenv('WEBHOOK_RETRY_QUEUE', 'webhookRetries')
+        self.pipeline = PipelineClient()
+        self.delivery = WebhookDelivery(retryQueue = retryQueue + '.' + sink.name, limiter = RateLimiter(sink.rateLimit, sink.ratePeriod),
+            metrics = self.metrics, metricLabels = self.labels)
+        self.coalescer = NotificationCoalescer(self.delivery, maxEmbeds = sink.maxItems, maxCharacters = sink.maxCharacters, pack = sink.pack)
+        self.consumers = ConsumerPool(self.pipeline, self.handleMessage)
+
+    # Reads queue of the sink on a thread of its own
+    def start(self):
+        threading.Thread(target = self.readFromPipeline, name = self.sink.name, daemon = True).start()
+
+    def readFromPipeline(self):
+        # Delay queues send failed posts back into the retry queue once their TTL expired
+        for delayQueue, arguments in self.delivery.getDelayQueues():
+            self.pipeline.setQueueArguments(delayQueue, arguments)
+
+        # Read the retry queue on the same channel, so retries share the prefetch window and workers
+        def consumeRetries(channel):
+            self.pipeline.declareQueue(self.delivery.retryQueue, channel)
+            channel.basic_consume(queue = self.delivery.retryQueue, on_message_callback = self.consumers.onMessage)
+
+        self.consumers.consume(self.queue, consumeRetries)
+
+    # Returns webhooks that belong to this sink
+    def getWebhooks(self):
+        return [webhookUrl for webhookUrl in self.webhooks.getWebhooks() or [] if notifier_custom.getSinkName(webhookUrl) == self.sink.name]
+
+    # Posts products of a message to every webhook of the sink on a worker thread.
+    # Returns messages for the delay queues, for posts that have to be tried again, or a future of them
+    # while the products wait to be posted together with those of other messages
+    def handleMessage(self, properties, body):
+        if self.delivery.isRetry(properties):
+            return self.delivery.retry(body)
+
+        receivedAt = trace_metrics.getTimestamp()
+        webhookUrls = self.getWebhooks()
+        if not webhookUrls:
+            print("No " + self.sink.name + " webhooks found")
+            return []
+
+        # Extract data from pipeline body, which may hold a single product or a batch of them
+        try:
+            products = product_record.decodeProducts(body, properties)
+        except ValueError as error:
+            print("Unable to decode product with error:")
+            print(error)
+            products = []
+
+        if len(products) == 0:
+            print("Empty product in pipeline")
+
+        items = self.sink.render(products)
+        renderedAt = trace_metrics.getTimestamp()
+
+        # Send notifications to every webhook of the sink, together with those of other messages arriving now
+        posted = self.coalescer.submit(webhookUrls, items)
+        posted.add_done_callback(functools.partial(self.observePosted, properties, receivedAt, renderedAt))
+        return posted
+
+    # Trace of the message ends once its products were posted to every webhook, or were queued for a retry
+    def observePosted(self, properties, receivedAt, renderedAt, posted):
+        if posted.exception() is not None:
+            return
+
+        trace = dict(trace_metrics.getTrace(properties), received = receivedAt, rendered = renderedAt, posted = trace_metrics.getTimestamp())
+        self.metrics.observeTrace('notifier_queue_seconds', trace, 'validated', 'received', self.labels)
+        self.metrics.observeTrace('notifier_render_seconds', trace, 'received', 'rendered', self.labels)
+        self.metrics.observeTrace('notifier_delivery_seconds', trace, 'rendered', 'posted', self.labels)
+        self.metrics.observeTrace('end_to_end_seconds', trace, 'fetched', 'posted', self.labels)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Checks that product and image urls can be reached, remembering the answer for a while.
+# Nike serves the same product pages and images for every notification of a product, so most checks are answered
+# from the cache. Urls are checked on a pool of threads with a timeout, so checks of a product run at once and
+# can be started as soon as its message arrives, while the rest of the notification is being prepared.
+class UrlVerifier:
+    def __init__(self, timeout = None, ttl = None, failureTtl = None, capacity = None, concurrency = None):
+        self.timeout = float(timeout) if timeout is not None else float(os.getenv('URL_VERIFY_TIMEOUT', 3))
+        self.ttl = float(ttl) if ttl is not None else float(os.getenv('URL_VERIFY_TTL', 3600))
+        self.failureTtl = float(failureTtl) if failureTtl is not None else float(os.getenv('URL_VERIFY_FAILURE_TTL', 60))
+        self.capacity = max(1, int(capacity) if capacity is not None else int(os.getenv('URL_VERIFY_CACHE_SIZE', 5000)))
+        concurrency = max(1, int(concurrency) if concurrency is not None else int(os.getenv('URL_VERIFY_CONCURRENCY', 8)))
+
+        self.executor = ThreadPoolExecutor(max_workers = concurrency, thread_name_prefix = 'verify')
+        self.sessions = threading.local()
+
+        # (expires at, status code or None, content type) by url, least recently used first
+        self.results = OrderedDict()
+
+        # Checks in flight by url, so a url requested again meanwhile waits for the same check
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    # Returns true if url can be reached and, if contentFormats are specified, has one of them as its content type
+    def verify(self, url, contentFormats = None):
+        if url is None:
+            return False
+
+        return self.matches(self.check(url).result(), contentFormats)
+
+    # Verifies (url, contentFormats) pairs at once, and returns whether each one is valid in the same order
+    def verifyAll(self, checks):
+        futures = [self.check(url) if url is not None else None for url, contentFormats in checks]
+        return [future is not None and self.matches(future.result(), contentFormats) for future, (url, contentFormats) in zip(futures, checks)]
+
+    # Starts checking urls in the background without waiting, so later calls to verify find them in the cache
+    def prefetch(self, urls):
+        for url in urls:
+            if url is not None:
+                self.check(url)
+
+    # Returns future of (status code or None, content type) of url, answered from the cache if it has not expired
+    def check(self, url):
+        with self.lock:
+            cached = self.results.get(url)
+            if cached is not None and cached[0] > time.time():
+                self.results.move_to_end(url)
+                return CompletedCheck((cached[1], cached[2]))
+
+            future = self.pending.get(url)
+            if future is None:
+                future = self.pending[url] = self.executor.submit(self.request, url)
+
+            return future
+
+    # Sends HEAD request to url on a thread of the pool, and caches its answer
+    def request(self, url):
+        status = None
+        contentType = None
+
+        try:
+            response = self.getSession().head(url, timeout = self.timeout)
+            status = response.status_code
+            contentType = response.headers.get('content-type')
+        except (requests.exceptions.RequestException, ValueError) as error:
+            print("Invalid url " + url + " with error:")
+            print(error)
+
+        valid = status is not None and status < 400
+
+        with self.lock:
+            # Failures are kept for a shorter time, since they are often temporary
+            self.results[url] = (time.time() + (self.ttl if valid else self.failureTtl), status, contentType)
+            self.results.move_to_end(url)
+            if len(self.results) > self.capacity:
+                self.results.popitem(last = False)
+
+            self.pending.pop(url, None)
+
+        return (status, contentType)
+
+    # Returns session of the current thread, creating it on first use
+    def getSession(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        return session
+
+    # Returns true if result of a check is a reachable url of one of the content formats
+    def matches(self, result, contentFormats):
+        status, contentType = result
+        if status is None or status >= 400:
+            return False
+
+        if contentFormats is None:
+            return True
+
+        # Content type may carry parameters, e.g. 'image/jpeg; charset=binary'
+        return contentType is not None and contentType.split(';')[0].strip().lower() in contentFormats
+
+# Check whose result is already known, with the same result() as a future of the pool
+class CompletedCheck:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import RateLimiter, parseNumber
+
+# Header that marks messages of the retry queue, which carry a single post instead of products
+RETRY_HEADER = 'webhook-retry'
+
+# Posts notifications to many webhooks at once over kept-alive connections.
+# Every thread of the pool has its own session, so connections to Discord are opened once and reused
+# by every later post instead of paying a new TLS handshake each time. The pool is shared by every
+# message being handled, so no more than concurrency posts are in flight at any time.
+#
+# Posts are paced ahead of time by a token bucket per webhook, which follows Discord's rate limit headers.
+# Posts that would have to wait too long for their turn, were rate limited or failed on the server side are not
+# waited for. They are returned as messages for a delay queue, whose TTL sends them back into the retry queue
+# once it expired, so the consumer is never blocked by them.
+class WebhookDelivery:
+    def __init__(self, concurrency = None, timeout = None, reportInterval = None, retryQueue = None, retryDelays = None, maxAttempts = None, maxRetryAge = None, maxPacingWait = None, limiter = None, metrics = None, metricLabels = None):
+        self.concurrency = max(1, int(concurrency) if concurrency is not None else int(os.getenv('WEBHOOK_CONCURRENCY', 32)))
+        self.timeout = float(timeout) if timeout is not None else float(os.getenv('WEBHOOK_TIMEOUT', 10))
+        self.reportInterval = float(reportInterval) if reportInterval is not None else float(os.getenv('WEBHOOK_REPORT_INTERVAL', 300))
+
+        self.retryQueue = retryQueue if retryQueue is not None else os.getenv('WEBHOOK_RETRY_QUEUE', 'webhookRetries')
+        self.retryDelays = sorted(float(delay) for delay in (retryDelays if retryDelays is not None else os.getenv('WEBHOOK_RETRY_DELAYS', '1,5,30,120').split(',')))
+        self.maxAttempts = int(maxAttempts) if maxAttempts is not None else int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+        self.maxRetryAge = float(maxRetryAge) if maxRetryAge is not None else float(os.getenv('WEBHOOK_MAX_RETRY_AGE', 900))
+        self.maxPacingWait = float(maxPacingWait) if maxPacingWait is not None else float(os.getenv('WEBHOOK_MAX_PACING_WAIT', 2))
+
+        self.executor = ThreadPoolExecutor(max_workers = self.concurrency, thread_name_prefix = 'webhook')
+        self.sessions = threading.local()
+        self.limiter = limiter if limiter is not None else RateLimiter()
+
+        # Optional trace_metrics.Metrics that every post is observed in, with the labels of this delivery
+        self.metrics = metrics
+        self.metricLabels = metricLabels or {}
+
+        # Number of posts, total and slowest time and last status code, by webhook
+        self.timings = {}
+        self.counters = { 'sent': 0, 'failed': 0, 'paced': 0, 'deferred': 0, 'retries': 0, 'drops': 0, 'retriesDelivered': 0, 'queuedTime': 0.0 }
+        self.lock = threading.Lock()
+        self.reportedAt = time.time()
+
+    # Returns session of the current thread, creating it on first use
+    def getSession(self):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({ 'Content-Type': 'application/json' })
+
+            # Posts to the same host share its connections, so the pool needs room for all of them
+            adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = self.concurrency)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+            self.sessions.session = session
+
+        return session
+
+    # Posts serialized notification to every webhook concurrently, and waits until every post finished or was deferred.
+    # Returns list of (webhook, status code or None, seconds taken, seconds until retry or None, whether it was sent)
+    # in the order of webhookUrls
+    def deliver(self, webhookUrls, data, attempt = 0):
+        start = time.time()
+        results = list(self.executor.map(lambda webhookUrl: self.post(webhookUrl, data, attempt), webhookUrls))
+        elapsed = time.time() - start
+
+        failed = sum(1 for webhookUrl, status, seconds, retryDelay, sent in results if status is None or status >= 300)
+        slowest = max((seconds for webhookUrl, status, seconds, retryDelay, sent in results), default = 0)
+        print('Posted notification to {} webhooks in {:.0f} ms, slowest {:.0f} ms, {} failed or deferred'.format(
+            len(results), elapsed * 1000, slowest * 1000, failed))
+
+        self.printTimings()
+
+        return results
+
+    # Posts serialized notification to a single webhook once its rate limit allows it.
+    # Returns (webhook, status code or None, seconds taken, seconds until retry or None, whether it was sent)
+    def post(self, webhookUrl, data, attempt = 0):
+        wait = self.limiter.reserve(webhookUrl, self.maxPacingWait)
+        if wait > self.maxPacingWait:
+            self.count('deferred')
+            return (webhookUrl, None, 0.0, wait, False)
+
+        if wait > 0:
+            self.count('paced')
+            time.sleep(wait)
+
+        start = time.time()
+        status = None
+        retryDelay = None
+
+        try:
+            response = self.getSession().post(webhookUrl, data = data, timeout = self.timeout)
+            status = response.status_code
+            self.limiter.update(webhookUrl, response.headers)
+
+            if status == 429:
+                retryDelay = getRetryAfter(response)
+                self.limiter.block(webhookUrl, retryDelay, response.headers.get('X-RateLimit-Global', '').lower() == 'true')
+                print("Sent too many requests to webhook " + webhookUrl + ", retrying in " + str(retryDelay) + " seconds")
+            elif status >= 500:
+                print("Failed to post to webhook " + webhookUrl + " with status " + str(status) + ", retrying")
+            elif status >= 300:
+                print("Failed to post to webhook " + webhookUrl + " with status " + str(status))
+        except requests.exceptions.RequestException as error:
+            print("Failed to post to webhook " + webhookUrl + " with error:")
+            print(error)
+
+        # Server side errors and lost connections are retried with exponential backoff
+        if retryDelay is None and (status is None or status >= 500):
+            retryDelay = self.retryDelays[0] * (2 ** attempt)
+
+        seconds = time.time() - start
+        self.recordTiming(webhookUrl, status, seconds)
+        self.count('sent' if status is not None and status < 300 else 'failed')
+
+        if self.metrics is not None:
+            self.metrics.observe('webhook_post_seconds', seconds, self.metricLabels)
+            self.metrics.count('webhook_posts', labels = dict(self.metricLabels, status = str(status // 100) + 'xx' if status is not None else 'error'))
+
+        return (webhookUrl, status, seconds, retryDelay, True)
+
+    # Returns messages for the delay queues, one for every post that should be tried again.
+    # Attempt is the number of failed sends before these results, and queuedAt the time the first one was queued
+    def getRetryMessages(self, results, data, attempt = 0, queuedAt = None):
+        now = time.time()
+        messages = []
+
+        for webhookUrl, status, seconds, retryDelay, sent in results:
+            if retryDelay is None:
+                if queuedAt is not None and status is not None and status < 300:
+                    self.count('retriesDelivered')
+                    self.count('queuedTime', now - queuedAt)
+                continue
+
+            # Waiting for a rate limit is not a failed attempt, but every post is given up after a while
+            nextAttempt = attempt + 1 if sent else attempt
+            firstQueuedAt = queuedAt if queuedAt is not None else now
+            if nextAttempt > self.maxAttempts or now + retryDelay - firstQueuedAt > self.maxRetryAge:
+                print("Dropped notification to webhook " + webhookUrl + " after " + str(nextAttempt) + " failed attempts")
+                self.count('drops')
+                continue
+
+            if sent:
+                self.count('retries')
+
+            body = json.dumps({ 'webhook': webhookUrl, 'data': data, 'attempt': nextAttempt, 'queuedAt': firstQueuedAt })
+            messages.append((self.getDelayQueue(retryDelay), body, { RETRY_HEADER: nextAttempt }, 'application/json'))
+
+        return messages
+
+    # Returns true if message came from the retry queue
+    def isRetry(self, properties):
+        headers = getattr(properties, 'headers', None) or {}
+        return RETRY_HEADER in headers
+
+    # Posts a message of the retry queue, and returns messages for the delay queues if it has to be tried again
+    def retry(self, body):
+        try:
+            item = json.loads(body)
+            webhookUrl = item['webhook']
+            data = item['data']
+            attempt = int(item['attempt'])
+            queuedAt = float(item['queuedAt'])
+        except (ValueError, KeyError, TypeError):
+            print("Dropped invalid message of retry queue")
+            self.count('drops')
+            return []
+
+        return self.getRetryMessages([self.post(webhookUrl, data, attempt)], data, attempt, queuedAt)
+
+    # Returns name of the delay queue with the shortest delay that is at least the specified number of seconds
+    def getDelayQueue(self, seconds):
+        for delay in self.retryDelays:
+            if delay >= seconds:
+                return self.getDelayQueueName(delay)
+
+        return self.getDelayQueueName(self.retryDelays[-1])
+
+    def getDelayQueueName(self, delay):
+        return self.retryQueue + '.' + ('%g' % delay) + 's'
+
+    # Returns (queue, arguments) of every delay queue. Messages expire after the delay of their queue
+    # and are dead-lettered into the retry queue
+    def getDelayQueues(self):
+        return [(self.getDelayQueueName(delay), {
+            'x-message-ttl': int(delay * 1000),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': self.retryQueue
+        }) for delay in self.retryDelays]
+
+    def count(self, counter, amount = 1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def recordTiming(self, webhookUrl, status, seconds):
+        with self.lock:
+            timing = self.timings.get(webhookUrl)
+            if timing is None:
+                timing = self.timings[webhookUrl] = { 'posts': 0, 'total': 0.0, 'slowest': 0.0, 'status': None }
+
+            timing['posts'] += 1
+            timing['total'] += seconds
+            timing['slowest'] = max(timing['slowest'], seconds)
+            timing['status'] = status
+
+    # Prints delivery counters and timing of the slowest webhooks every reportInterval seconds, and starts counting again
+    def printTimings(self):
+        with self.lock:
+            if time.time() - self.reportedAt < self.reportInterval:
+                return
+
+            timings = sorted(self.timings.items(), key = lambda item: item[1]['total'] / item[1]['posts'], reverse = True)
+            counters = self.counters
+            self.timings = {}
+            self.counters = dict.fromkeys(counters, 0)
+            self.counters['queuedTime'] = 0.0
+            self.reportedAt = time.time()
+
+        print('Webhook delivery over the last {:.0f}s: {} sent, {} failed, {} paced, {} deferred, {} retries, {} retries delivered after {:.1f}s queued on average, {} dropped'.format(
+            self.reportInterval, counters['sent'], counters['failed'], counters['paced'], counters['deferred'], counters['retries'],
+            counters['retriesDelivered'], counters['queuedTime'] / counters['retriesDelivered'] if counters['retriesDelivered'] > 0 else 0.0,
+            counters['drops']))
+
+        for webhookUrl, timing in timings[:10]:
+            print('  {:>6.0f} ms mean {:>6.0f} ms max {:>4} posts, last status {}  {}'.format(
+                timing['total'] / timing['posts'] * 1000, timing['slowest'] * 1000, timing['posts'], timing['status'], webhookUrl))
+
+# Returns seconds Discord asked to wait after a 429, from the Retry-After header or the retry_after field of the body
+def getRetryAfter(response):
+    retryAfter = parseNumber(response.headers.get('Retry-After'))
+
+    if retryAfter is None:
+        try:
+            retryAfter = parseNumber(str(response.json().get('retry_after')))
+        except (ValueError, AttributeError):
+            retryAfter = None
+
+    return retryAfter if retryAfter is not None else 1.0
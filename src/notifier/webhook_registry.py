@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import select
+import threading
+import psycopg2
+import psycopg2.extensions
+
+# Webhooks of the "WebHooks" table, held in memory instead of being read for every notification.
+# The management api sends a NOTIFY on channel whenever it adds or removes webhooks, and a listener thread
+# reloads the list when it hears one. Notifications sent while the listener was disconnected are lost,
+# so the list is also reloaded once it is older than ttl seconds.
+class WebhookRegistry:
+    def __init__(self, database, channel = None, ttl = None, reconnectDelay = None):
+        self.database = database
+        self.channel = channel if channel is not None else os.getenv('WEBHOOK_CHANNEL', 'webhooks_changed')
+        self.ttl = float(ttl) if ttl is not None else float(os.getenv('WEBHOOK_REGISTRY_TTL', 300))
+        self.reconnectDelay = float(reconnectDelay) if reconnectDelay is not None else float(os.getenv('WEBHOOK_LISTEN_RECONNECT_DELAY', 5))
+
+        self.webhooks = None
+        self.loadedAt = 0.0
+        self.lock = threading.Lock()
+        self.listener = None
+
+    # Starts thread that listens for changes. It loads webhooks once it is listening, so no change is missed in between
+    def start(self):
+        self.listener = threading.Thread(target = self.listen, name = 'webhook-registry', daemon = True)
+        self.listener.start()
+
+    # Returns list of every webhook, reading them from the database only if the list is missing or expired.
+    # Returns None if webhooks were never read successfully
+    def getWebhooks(self):
+        with self.lock:
+            webhooks = self.webhooks
+            expired = time.time() - self.loadedAt > self.ttl
+
+        if webhooks is None or expired:
+            loaded = self.load()
+            if loaded is not None:
+                webhooks = loaded
+
+        return webhooks
+
+    # Reads every webhook from the database and replaces the list held in memory.
+    # On failure the old list is kept, and None is returned
+    def load(self):
+        databaseConnection = self.database.getConnection()
+        webhooks = getWebHooksFromDatabase(databaseConnection)
+        self.database.putConnection(databaseConnection)
+
+        if webhooks is None:
+            return None
+
+        with self.lock:
+            changed = webhooks != self.webhooks
+            self.webhooks = webhooks
+            self.loadedAt = time.time()
+
+        if changed:
+            print("Loaded " + str(len(webhooks)) + " webhooks from database")
+
+        return webhooks
+
+    # Waits for notifications on the listener thread, reconnecting if the connection is lost.
+    # The list is reloaded after every reconnect, since changes may have been missed meanwhile
+    def listen(self):
+        while True:
+            connection = self.database.connect()
+            if connection is None:
+                time.sleep(self.reconnectDelay)
+                continue
+
+            try:
+                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = connection.cursor()
+                cursor.execute('LISTEN ' + self.channel)
+                cursor.close()
+                print("Listening for webhook changes on channel " + self.channel)
+
+                self.load()
+
+                while True:
+                    # Wake up at least once per ttl, so an expired list is reloaded even without readers
+                    readable, writable, failed = select.select([connection], [], [], self.ttl)
+                    if not readable:
+                        self.load()
+                        continue
+
+                    connection.poll()
+                    if connection.notifies:
+                        del connection.notifies[:]
+                        self.load()
+            except (Exception, psycopg2.Error) as error:
+                print("Lost connection listening for webhook changes with error:")
+                print(error)
+            finally:
+                connection.close()
+
+            time.sleep(self.reconnectDelay)
+
+# Returns list of all webhooks in database, or None if they could not be read
+def getWebHooksFromDatabase(databaseConnection):
+    if databaseConnection is None:
+        return None
+
+    try:
+        cursor = databaseConnection.cursor()
+        cursor.execute('SELECT "Discord" FROM "WebHooks"')
+        rows = cursor.fetchall()
+        databaseConnection.commit()
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Failed to retrieve webhook urls from database with error:")
+        print(error)
+        return None
+
+    return [str(row[0]) for row in rows]
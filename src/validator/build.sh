@@ -3,4 +3,4 @@ NAME=validator:latest
 
 # build local docker image
 docker rmi $NAME
-docker build -t $NAME .
+docker build -t $NAME -f Dockerfile ..
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Attributes of a product that are tracked for changes, e.g. restocks, price drops or a changed launch date.
+# The digest covers all of them, so comparing two states is a single comparison of 16 bytes
+class ProductState:
+    __slots__ = ('price', 'publishType', 'startSellDate', 'sizes', 'digest')
+
+    def __init__(self, price = None, publishType = None, startSellDate = None, sizes = None, digest = None):
+        self.price = float(price) if price is not None else None
+        self.publishType = publishType
+        self.startSellDate = startSellDate
+        self.sizes = sorted(sizes) if sizes is not None else []
+        self.digest = digest if digest is not None else self.computeDigest()
+
+    @classmethod
+    def fromProduct(cls, product):
+        return cls(product.price, product.publishType, product.startSellDate, product.sizes)
+
+    # Creates state from a row of the "ProductState" table, without its id
+    @classmethod
+    def fromRow(cls, row):
+        return cls(row[1], row[2], row[3], row[4], bytes(row[0]))
+
+    # Returns row for the "ProductState" table
+    def toRow(self, id):
+        return (id, self.digest, self.price, self.publishType, self.startSellDate, self.sizes)
+
+    def computeDigest(self):
+        text = '\x1f'.join([repr(self.price), self.publishType or '', self.startSellDate or ''] + self.sizes)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size = 16).digest()
+
+# Returns changes from old to new state, e.g. { 'sizesAdded': ['M 10'], 'price': [170.0, 150.0] }
+def diffStates(old, new):
+    changes = {}
+
+    for field in ('price', 'publishType', 'startSellDate'):
+        if getattr(old, field) != getattr(new, field):
+            changes[field] = [getattr(old, field), getattr(new, field)]
+
+    oldSizes = set(old.sizes)
+    newSizes = set(new.sizes)
+    if newSizes - oldSizes:
+        changes['sizesAdded'] = sorted(newSizes - oldSizes)
+    if oldSizes - newSizes:
+        changes['sizesRemoved'] = sorted(oldSizes - newSizes)
+
+    return changes
+
+# Digests of the last known state of recently seen products, in front of the "ProductState" table.
+# A product whose digest matches has not changed, and needs no database query. Only mismatches,
+# or products that are not in the cache, are compared with the full state in the database
+class ProductStateCache:
+    def __init__(self, capacity = 10000):
+        self.capacity = max(1, int(capacity))
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.counters = { 'checks': 0, 'unchanged': 0, 'databaseQueries': 0, 'changes': 0 }
+
+    # Returns true if product may have changed since it was last seen
+    def mayHaveChanged(self, id, state):
+        with self.lock:
+            self.counters['checks'] += 1
+
+            if self.digests.get(id) == state.digest:
+                self.digests.move_to_end(id)
+                self.counters['unchanged'] += 1
+                return False
+
+        return True
+
+    # Remembers digest as the last known state of a product
+    def remember(self, id, digest):
+        with self.lock:
+            self.digests[id] = digest
+            self.digests.move_to_end(id)
+            if len(self.digests) > self.capacity:
+                self.digests.popitem(last = False)
+
+    # Loads digests of every product in the database, keeping the last ones read.
+    # Reads through a server side cursor, so the whole table is never held in memory
+    def warm(self, databaseConnection):
+        if databaseConnection is None:
+            return 0
+
+        count = 0
+
+        try:
+            cursor = databaseConnection.cursor(name = 'warm_product_states')
+            cursor.itersize = 10000
+            cursor.execute('SELECT "ID", "Digest" FROM "ProductState"')
+
+            for row in cursor:
+                self.remember(row[0], bytes(row[1]))
+                count += 1
+
+            cursor.close()
+            databaseConnection.commit()
+        except Exception as error:
+            print("Failed to warm product state cache with error:")
+            print(error)
+            databaseConnection.rollback()
+            return None
+
+        print("Warmed product state cache with " + str(count) + " products")
+
+        return count
+
+    def count(self, counter, amount = 1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def printCounters(self):
+        checks = self.counters['checks']
+        print('Product state cache: {} checks, {:.1%} unchanged without query, {} database queries, {} changes'.format(
+            checks, self.counters['unchanged'] / checks if checks > 0 else 0.0, self.counters['databaseQueries'], self.counters['changes']))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Set membership with no false negatives and a configurable rate of false positives.
+# Used to tell ids that were definitely never seen apart from ids that might have been
+class BloomFilter:
+    def __init__(self, capacity, errorRate = 0.001):
+        capacity = max(1, int(capacity))
+
+        self.size = max(8, int(-capacity * math.log(errorRate) / (math.log(2) ** 2)))
+        self.hashCount = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # Returns bit positions for an id, derived from two halves of a single digest
+    def positions(self, id):
+        digest = hashlib.blake2b(str(id).encode('utf-8'), digest_size = 16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(first + index * second) % self.size for index in range(self.hashCount)]
+
+    def add(self, id):
+        for position in self.positions(id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, id):
+        for position in self.positions(id):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+# Two tier cache of product ids that are known to be in the database, in front of the "ID" table.
+# Ids in the LRU are confirmed seen and need no query. Ids missing from the Bloom filter were never seen
+# by this validator. Everything that is not confirmed goes to the database.
+# Shared by every worker of the validator, so changes to the LRU and counters are made under a lock.
+#
+# When this validator is the only one that sees a shard of the ids, the cache is authoritative: ids missing
+# from the Bloom filter are claimed as new right away, and the database is only written to so they survive a restart.
+# Ids whose write failed are kept and written with the next ones
+class SeenCache:
+    def __init__(self, capacity = 10000, bloomCapacity = 1000000, errorRate = 0.001):
+        self.capacity = max(1, int(capacity))
+        self.confirmed = OrderedDict()
+        self.bloom = BloomFilter(bloomCapacity, float(errorRate))
+
+        self.counters = { 'lookups': 0, 'lruHits': 0, 'bloomMisses': 0, 'databaseQueries': 0, 'localClaims': 0, 'staleClaims': 0 }
+        self.lock = threading.Lock()
+
+        self.authoritative = False
+        self.unpersisted = set()
+
+    # Returns true if id is confirmed to be in the database, without counting it as a lookup
+    def __contains__(self, id):
+        return id in self.confirmed
+
+    # Returns true if id is confirmed to be in the database
+    def isConfirmed(self, id):
+        with self.lock:
+            self.counters['lookups'] += 1
+
+            if id in self.confirmed:
+                self.confirmed.move_to_end(id)
+                self.counters['lruHits'] += 1
+                return True
+
+        return False
+
+    # Returns true if id was definitely never added. Only valid for ids that missed the LRU
+    def isDefinitelyNew(self, id):
+        if id not in self.bloom:
+            with self.lock:
+                self.counters['bloomMisses'] += 1
+            return True
+
+        return False
+
+    # Returns true if id was definitely never seen, and remembers it, in one step so two workers
+    # can never both claim the same id. Only valid while cache is authoritative, for ids isDefinitelyNew was true for
+    def claim(self, id):
+        with self.lock:
+            if id in self.confirmed or id in self.bloom:
+                return False
+
+            self.counters['localClaims'] += 1
+            self.unpersisted.add(id)
+            self.addUnlocked(id)
+            return True
+
+    # Returns ids that were claimed but not written to the database yet
+    def getUnpersisted(self):
+        with self.lock:
+            return list(self.unpersisted)
+
+    # Forgets ids that are now in the database. Ids that were already there before they were claimed
+    # mean the local state was stale, e.g. right after a rebalance
+    def markPersisted(self, ids, staleIds = ()):
+        with self.lock:
+            self.unpersisted.difference_update(ids)
+            self.counters['staleClaims'] += len(staleIds)
+
+    def setAuthoritative(self, authoritative):
+        self.authoritative = authoritative
+
+    # Remembers id as being in the database
+    def add(self, id):
+        with self.lock:
+            self.addUnlocked(id)
+
+    def addUnlocked(self, id):
+        self.bloom.add(id)
+
+        self.confirmed[id] = True
+        self.confirmed.move_to_end(id)
+        if len(self.confirmed) > self.capacity:
+            self.confirmed.popitem(last = False)
+
+    def countQuery(self):
+        with self.lock:
+            self.counters['databaseQueries'] += 1
+
+    # Loads every id in the database into the Bloom filter, and the last ones read into the LRU.
+    # Reads through a server side cursor, so the whole table is never held in memory.
+    # Returns number of ids read, or None if they could not be read
+    def warm(self, databaseConnection):
+        if databaseConnection is None:
+            return 0
+
+        count = 0
+
+        try:
+            cursor = databaseConnection.cursor(name = 'warm_seen_cache')
+            cursor.itersize = 10000
+            cursor.execute('SELECT "ID" FROM "ID"')
+
+            for row in cursor:
+                self.add(row[0])
+                count += 1
+
+            cursor.close()
+            databaseConnection.commit()
+        except Exception as error:
+            print("Failed to warm seen id cache with error:")
+            print(error)
+            databaseConnection.rollback()
+            return None
+
+        print("Warmed seen id cache with " + str(count) + " ids")
+
+        return count
+
+    # Returns fraction of lookups answered by the LRU without a database query
+    def hitRate(self):
+        if self.counters['lookups'] == 0:
+            return 0.0
+
+        return self.counters['lruHits'] / self.counters['lookups']
+
+    def printCounters(self):
+        print('Seen id cache: {} lookups, {:.1%} LRU hits, {} database queries, {} claimed locally ({} stale), {} not yet in database{}'.format(
+            self.counters['lookups'], self.hitRate(), self.counters['databaseQueries'], self.counters['localClaims'],
+            self.counters['staleClaims'], len(self.unpersisted), '' if self.authoritative else ', not authoritative'))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import threading
+from pika.exceptions import AMQPError
+from pipeline_client import HASH_EXCHANGE_TYPE
+
+# Membership of this validator in the ring of validators behind the shard exchange.
+# Every validator binds its own queue to the consistent-hash exchange, so it receives the products whose id hashes
+# into its part of the ring, and announces on a fanout exchange when it joins or leaves.
+# Whenever the ring changes, ids move between validators, so the seen id cache stops being authoritative
+# until it has read the ids that other validators wrote to the database in the meantime.
+class ShardMembership:
+    def __init__(self, database, seenIds, exchange, incomingQueue, shard, weight = None, membershipExchange = None, rebalanceDelay = None):
+        self.database = database
+        self.seenIds = seenIds
+        self.exchange = exchange
+        self.shard = shard
+        self.weight = str(int(weight if weight is not None else os.getenv('VALIDATOR_SHARD_WEIGHT', 1)))
+        self.membershipExchange = membershipExchange if membershipExchange is not None else os.getenv('MEMBERSHIP_EXCHANGE', 'validatorMembership')
+        self.rebalanceDelay = float(rebalanceDelay) if rebalanceDelay is not None else float(os.getenv('REBALANCE_DELAY', 10))
+
+        # Queue of this shard, kept when the validator restarts so no product is lost in between
+        self.queue = incomingQueue + '.' + self.shard
+
+        # Other validators in the ring, as far as announcements tell
+        self.members = set()
+
+        # Incremented on every change to the ring, so an outdated rewarm does not make the cache authoritative
+        self.generation = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    # Binds shard queue into the ring and listens to announcements of other validators.
+    # Called with every new consuming channel, before products are read from it
+    def setup(self, channel):
+        channel.exchange_declare(exchange = self.exchange, exchange_type = HASH_EXCHANGE_TYPE, durable = True)
+        channel.queue_bind(queue = self.queue, exchange = self.exchange, routing_key = self.weight)
+
+        channel.exchange_declare(exchange = self.membershipExchange, exchange_type = 'fanout', durable = True)
+        announcements = channel.queue_declare(queue = '', exclusive = True).method.queue
+        channel.queue_bind(queue = announcements, exchange = self.membershipExchange)
+        channel.basic_consume(queue = announcements, on_message_callback = self.onAnnouncement, auto_ack = True)
+
+        self.announce(channel, 'join')
+        print("Joined ring of validators as shard " + self.shard + " with weight " + self.weight)
+
+    # Publishes an event about this validator to every validator, including this one
+    def announce(self, channel, event):
+        channel.basic_publish(exchange = self.membershipExchange, routing_key = '', body = json.dumps({ 'shard': self.shard, 'event': event }))
+
+    # Called on the consuming thread for every announcement. Validators answer a join with 'present',
+    # so the new one learns about them without the ring changing again
+    def onAnnouncement(self, channel, method, properties, body):
+        try:
+            announcement = json.loads(body)
+            shard = announcement['shard']
+            event = announcement['event']
+        except (ValueError, KeyError, TypeError):
+            print("Ignoring invalid membership announcement")
+            return
+
+        if shard != self.shard:
+            if event == 'leave':
+                self.members.discard(shard)
+            else:
+                self.members.add(shard)
+
+        if event == 'present':
+            return
+
+        print("Validator " + shard + (" joined" if event == 'join' else " left") + " the ring, rebalancing")
+
+        if event == 'join' and shard != self.shard:
+            try:
+                self.announce(channel, 'present')
+            except AMQPError as error:
+                print("Failed to answer membership announcement with error:")
+                print(repr(error))
+
+        self.startRebalance()
+
+    # Stops trusting the seen id cache, and reads the database again once products routed by the old ring have settled
+    def startRebalance(self):
+        with self.lock:
+            self.generation += 1
+            self.seenIds.setAuthoritative(False)
+
+            if self.timer is not None:
+                self.timer.cancel()
+
+            self.timer = threading.Timer(self.rebalanceDelay, self.rewarm, [self.generation])
+            self.timer.daemon = True
+            self.timer.start()
+
+    # Loads ids written by every validator, and makes cache authoritative again unless the ring changed meanwhile
+    def rewarm(self, generation):
+        databaseConnection = self.database.getConnection()
+        count = self.seenIds.warm(databaseConnection) if databaseConnection is not None else None
+        self.database.putConnection(databaseConnection)
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            if count is None:
+                print("Failed to read ids after rebalancing, trying again in " + str(self.rebalanceDelay) + " seconds")
+                self.timer = threading.Timer(self.rebalanceDelay, self.rewarm, [generation])
+                self.timer.daemon = True
+                self.timer.start()
+                return
+
+            self.seenIds.setAuthoritative(True)
+            print("Seen id cache is authoritative for shard " + self.shard + " again")
+
+    # Takes shard out of the ring and hands products still waiting in its queue to the validators that own them now.
+    # If no other validator is known, the queue stays bound so products wait for this validator to come back
+    def leave(self, connection):
+        if len(self.members) == 0:
+            print("No other validator in the ring, keeping queue " + self.queue + " until this shard returns")
+            return
+
+        try:
+            channel = connection.channel()
+            channel.queue_unbind(queue = self.queue, exchange = self.exchange, routing_key = self.weight)
+            self.announce(channel, 'leave')
+
+            # Every product is moved in its own transaction, so it is never lost or left in both queues
+            channel.tx_select()
+            handedOver = 0
+
+            while True:
+                method, properties, body = channel.basic_get(queue = self.queue)
+                if method is None:
+                    break
+
+                channel.basic_publish(exchange = self.exchange, routing_key = method.routing_key, body = body, properties = properties)
+                channel.basic_ack(delivery_tag = method.delivery_tag)
+                channel.tx_commit()
+                handedOver += 1
+
+            channel.queue_delete(queue = self.queue, if_empty = True)
+            print("Left ring of validators, handed " + str(handedOver) + " products over to " + str(len(self.members)) + " other validators")
+        except AMQPError as error:
+            print("Failed to leave ring of validators with error:")
+            print(repr(error))
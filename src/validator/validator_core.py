@@ -1,109 +1,206 @@
 # -*- coding: utf-8 -*-
 import os
+import signal
+import threading
 import psycopg2
-import pika
-import json
 import validator_custom
+import product_record
+import trace_metrics
+from pipeline_client import PipelineClient
+from consumer_pool import ConsumerPool
+from database_pool import DatabasePool
+from seen_cache import SeenCache
+from product_state import ProductStateCache
+from shard_membership import ShardMembership
+
+# Connection to pipeline is opened once and shared by consumer and publisher
+pipeline = PipelineClient()
+
+# Connections to database are opened once and reused for every message
+database = DatabasePool()
+
+# Ids known to be in the database, so repeated products need no database query
+seenIds = SeenCache(
+    capacity = os.getenv('SEEN_CACHE_SIZE', 10000),
+    bloomCapacity = os.getenv('SEEN_BLOOM_CAPACITY', 1000000),
+    errorRate = os.getenv('SEEN_BLOOM_ERROR_RATE', 0.001)
+)
+
+# If true, products that were already seen are forwarded again when they change in one of the ways in CHANGE_TYPES,
+# e.g. a restock adds sizes or the price drops
+trackingChanges = os.getenv('TRACK_CHANGES', 'true').lower() == 'true'
+changeTypes = set(os.getenv('CHANGE_TYPES', 'sizesAdded,price,publishType,startSellDate').split(','))
+
+# Digests of the last known state of every product, so unchanged products need no database query
+productStates = ProductStateCache(os.getenv('PRODUCT_STATE_CACHE_SIZE', 10000))
+
+# Queues products are read from and forwarded to
+incomingQueue = os.getenv('INCOMING_QUEUE')
+outgoingQueue = os.getenv('OUTGOING_QUEUE')
+
+# If set, products arrive through this consistent-hash exchange, and this validator owns a shard of the ids
+shardExchange = os.getenv('SHARD_EXCHANGE') or None
+
+# Name of the shard queue of this validator. Must stay the same across restarts, since a durable queue
+# bound under any other name keeps receiving its part of the ids with nobody reading them
+shardName = os.getenv('VALIDATOR_SHARD') or None
+
+# Latency of products between publishing and validation, served on METRICS_PORT
+metrics = trace_metrics.Metrics('validator')
+
+# Number of messages handled, used to print cache counters periodically
+messageCount = 0
+messageCountLock = threading.Lock()
 
 def main():
+    metrics.serve()
+
+    # Load ids that are already in the database before reading any message
+    databaseConnection = database.getConnection()
+    if databaseConnection is not None:
+        validator_custom.ensureUniqueProductIds(databaseConnection)
+        seenIds.warm(databaseConnection)
+
+        if trackingChanges:
+            validator_custom.ensureProductStateTable(databaseConnection)
+            productStates.warm(databaseConnection)
+
+        database.putConnection(databaseConnection)
+
     readFromPipeline()
     
-# Opens connection to pipeline and reads messages from incoming queue
+# Reads messages from incoming queue, reconnecting to pipeline if connection is lost
 def readFromPipeline():
-    # Read name of queue from environment variable
-    queue = os.getenv('INCOMING_QUEUE')
+    queue = incomingQueue
     if queue is None:
         print("Must specify incoming queue as environment variable INCOMING_QUEUE")
         return
 
-    # Connect to pipeline
-    pipelineConnection = pika.BlockingConnection(pika.ConnectionParameters(host = os.getenv('PIPELINE_HOST', 'localhost')))
-    channel = pipelineConnection.channel()
+    # Products are handled again for as long as the database cannot tell whether they are new
+    consumers = ConsumerPool(pipeline, handleMessage, retryErrors = (psycopg2.OperationalError,))
 
-    print("Connected to pipeline and " + queue + " queue, waiting for data...")
+    if shardExchange is None:
+        consumers.consume(queue)
+        return
 
-    # Create a persistent queue. If it already exists, this will not create another one
-    channel.queue_declare(queue = queue, durable = True)
+    if shardName is None:
+        print("Must specify stable shard name as environment variable VALIDATOR_SHARD when reading from SHARD_EXCHANGE")
+        return
 
-    # Only receive new message when finished with previous one
-    channel.basic_qos(prefetch_count = 1)
-    channel.basic_consume(queue = queue, on_message_callback = callback)
-    
-    # Enter never ending loop, waiting for messages
-    channel.start_consuming()
+    # Leave the ring cleanly when the container is stopped
+    signal.signal(signal.SIGTERM, stop)
 
-# Callback function for when message arrives in incoming queue
-def callback(ch, method, properties, body):
-    print("Read product from pipeline")
-    databaseConnection = connectToDatabase()
+    membership = ShardMembership(database, seenIds, shardExchange, queue, shardName)
+    try:
+        consumers.consume(membership.queue, membership.setup)
+    finally:
+        # Finish products that are being handled, and put the rest back into the shard queue to be handed over
+        consumers.cancel()
 
-    # Extract data from pipeline body
-    product = json.loads(body)
-    
-    if validator_custom.shouldNotify(product, databaseConnection):
-        sendToPipeline(product)
+        # Write ids that were only claimed locally, so the validators taking over the shard know them
+        databaseConnection = database.getConnection()
+        validator_custom.persistClaimedIds(databaseConnection, seenIds)
+        database.putConnection(databaseConnection)
 
-    if databaseConnection is not None:
-        databaseConnection.close()
-        print("Disconnected from database")
+        if pipeline.connection is not None and pipeline.connection.is_open:
+            membership.leave(pipeline.connection)
 
-    # Acknowledge receipt of data
-    ch.basic_ack(delivery_tag = method.delivery_tag)
+# Stops consuming when the container is stopped
+def stop(signum, frame):
+    raise SystemExit(0)
 
-# Connects to postgres database
-def connectToDatabase():
-    connection = None
+# Checks products of a message against the database on a worker thread, and returns messages to forward
+def handleMessage(properties, body):
+    print("Read products from pipeline")
+    receivedAt = trace_metrics.getTimestamp()
 
+    # Extract data from pipeline body
     try:
-        connection = psycopg2.connect(
-            host=os.getenv('DATABASE_HOST', 'localhost'), 
-            database=os.getenv('DATABASE_NAME'), 
-            user=os.getenv('DATABASE_USER', 'postgres'), 
-            password=os.getenv('DATABASE_PASSWORD', 'postgres'), 
-            port=os.getenv('DATABASE_PORT', '5432')
-        )
-
-        # Print database properties
-        if connection is not None:
-            print("Connected to database")
-
-    except (Exception, psycopg2.OperationalError) as error:
-        print("Failed to connect to database with error:")
+        products = product_record.decodeProducts(body, properties)
+    except ValueError as error:
+        print("Unable to decode product with error:")
         print(error)
+        products = []
 
-    return connection
+    # Products whose state differs from the cached digest, which are the only ones compared in the database
+    candidates = validator_custom.findChangeCandidates(products, productStates) if trackingChanges else []
 
-# Connects to pipeline, serializes product data, and sends to outgoing queue
-def sendToPipeline(product):
-    if product is None:
-        return
+    # Only connect to database if some product is not already known to be in it, or may have changed
+    databaseConnection = None
+    if len(candidates) > 0 or any(product.id not in seenIds for product in products if product.id is not None):
+        databaseConnection = database.getConnection()
 
-    queue = os.getenv('OUTGOING_QUEUE')
+    outgoing = []
+    try:
+        if product_record.isBatch(properties):
+            # Check whole batch against database at once, and forward new and changed products as a single message.
+            # If the database fails, the whole batch is handled again rather than forwarded without its products
+            newProducts, changedProducts = validator_custom.checkProducts(products, candidates, databaseConnection, seenIds, productStates, changeTypes)
+            print(str(len(newProducts)) + " of " + str(len(products)) + " products in batch are new, " + str(len(changedProducts)) + " changed")
+
+            if len(newProducts) + len(changedProducts) > 0:
+                outgoing = getBatchMessage(newProducts + changedProducts, properties.content_type)
+        elif len(products) > 0:
+            newProducts, changedProducts = validator_custom.checkProducts(products[:1], candidates, databaseConnection, seenIds, productStates, changeTypes)
+
+            if len(newProducts) > 0:
+                # Forward message exactly as it arrived, so it is not serialized again
+                outgoing = getMessage(body, properties)
+            elif len(changedProducts) > 0:
+                print("Product " + str(products[0].id) + " changed: " + str(changedProducts[0].changes))
+                outgoing = getProductMessage(changedProducts[0], properties.content_type)
+    finally:
+        database.putConnection(databaseConnection)
+
+    # Forwarded messages keep the trace of the incoming one, stamped with the time it was received and validated
+    trace = dict(trace_metrics.getTrace(properties), received = receivedAt, validated = trace_metrics.getTimestamp())
+    outgoing = [(queue, body, dict(headers or {}, **{ trace_metrics.TRACE_HEADER: trace }), contentType) for queue, body, headers, contentType in outgoing]
+
+    metrics.observeTrace('validator_queue_seconds', trace, 'published', 'received')
+    metrics.observeTrace('validator_decision_seconds', trace, 'received', 'validated')
+    metrics.count('validator_messages', labels = { 'outcome': 'forwarded' if outgoing else 'dropped' })
+
+    global messageCount
+    with messageCountLock:
+        messageCount += 1
+        if messageCount % 100 == 0:
+            seenIds.printCounters()
+            if trackingChanges:
+                productStates.printCounters()
+
+    return outgoing
+
+# Returns serialized product as message for outgoing queue, keeping its encoding
+def getMessage(body, properties):
+    if body is None:
+        return []
+
+    queue = outgoingQueue
     if queue is None:
         print("Must specify outgoing queue as environment variable OUTGOING_QUEUE")
-        return
+        return []
 
-    # Connect to pipeline
-    pipelineConnection = pika.BlockingConnection(pika.ConnectionParameters(host = os.getenv('PIPELINE_HOST', 'localhost')))
-    channel = pipelineConnection.channel()
+    return [(queue, body, properties.headers, properties.content_type)]
 
-    # Create a persistent queue. If it already exists, this will not create another one
-    channel.queue_declare(queue = queue, durable = True)
-
-    print("Connected to pipeline and " + queue + " queue, publishing data...")
+# Returns product serialized in the specified content type as message for outgoing queue, e.g. after changes were attached
+def getProductMessage(product, contentType):
+    queue = outgoingQueue
+    if queue is None:
+        print("Must specify outgoing queue as environment variable OUTGOING_QUEUE")
+        return []
 
-    # Send formatted product data into pipeline
-    channel.basic_publish(
-        exchange = '',
-        routing_key = queue,
-        body = json.dumps(product),
-        properties = pika.BasicProperties(
-            delivery_mode = 2,  # make message persistent
-        )
-    )
+    contentType = contentType or product_record.JSON_CONTENT_TYPE
+    return [(queue, product_record.encodeProduct(product, contentType), product_record.getHeaders(records = [product]), contentType)]
 
-    print("Published product to message queue. Closing connection...")
+# Returns batch of products serialized in the specified content type as a single message for outgoing queue
+def getBatchMessage(products, contentType):
+    queue = outgoingQueue
+    if queue is None:
+        print("Must specify outgoing queue as environment variable OUTGOING_QUEUE")
+        return []
 
-    pipelineConnection.close()
+    body = product_record.encodeProducts(products, contentType or product_record.JSON_CONTENT_TYPE)
+    return [(queue, body, product_record.getHeaders(len(products), products), contentType)]
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
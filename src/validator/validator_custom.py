@@ -1,47 +1,225 @@
 # -*- coding: utf-8 -*-
 import os
 import psycopg2
+import psycopg2.extras
+from product_state import ProductState, diffStates
 
-# Returns true if product should be send to notification module
-def shouldNotify(product, databaseConnection):
-    if product is None or 'id' not in product:
+# Returns true if product should be send to notification module.
+# Checks and stores the id in a single atomic statement, so two validators can never both notify the same product.
+# If a cache of seen ids is given, ids it has confirmed are not sent to the database.
+# Raises if the database could not tell whether the product is new, so the message is handled again
+def shouldNotify(product, databaseConnection, seenIds = None):
+    if product is None or product.id is None:
         print("No valid product")
         return
 
-    id = product['id']
+    return len(filterNewProducts([product], databaseConnection, seenIds)) > 0
 
-    # For each product not in database, add it to the list of notifications
-    if not productExistsInDatabase(id, databaseConnection):
-        addProductIdToDatabase(id, databaseConnection)
-        return True
+# Returns products of the batch whose id is not in the database yet, and adds those ids to the database.
+# Checks and inserts the whole batch in a single round trip. Products repeated within the batch are returned once.
+# If a cache of seen ids is given, ids it has confirmed are not sent to the database, and while the cache is
+# authoritative for this validator's shard, ids it has never seen are new without asking the database.
+# Raises if the database could not be asked, before any id of the batch was claimed, so the message is handled again
+def filterNewProducts(products, databaseConnection, seenIds = None):
+    products = [product for product in products if product is not None and product.id is not None]
+    if seenIds is not None:
+        products = [product for product in products if not seenIds.isConfirmed(product.id)]
 
-    return False
+    # Ids the cache has definitely never seen are only claimed once the database answered for the others
+    claimable = []
+    if seenIds is not None and seenIds.authoritative:
+        claimable = [product for product in products if seenIds.isDefinitelyNew(product.id)]
+        claimableIds = set(product.id for product in claimable)
+        products = [product for product in products if product.id not in claimableIds]
 
-# Returns true if product id already exists in database
-def productExistsInDatabase(id, databaseConnection):
-    idExists = False
+    result = []
+    if len(products) > 0:
+        if databaseConnection is None:
+            raise psycopg2.OperationalError("No database connection to check product ids against")
+
+        newIds = insertNewProductIds([product.id for product in products], databaseConnection)
+        if newIds is None:
+            raise psycopg2.OperationalError("Failed to store product ids")
+
+        # Every id of the batch is in the database now, whether it was new or not
+        if seenIds is not None:
+            seenIds.countQuery()
+            for product in products:
+                seenIds.add(product.id)
+
+        for product in products:
+            if product.id in newIds:
+                result.append(product)
+                newIds.discard(product.id)
+
+    claimed = []
+    if seenIds is not None and seenIds.authoritative:
+        # Another worker may have claimed an id since, in which case it notifies the product
+        claimed = [product for product in claimable if seenIds.claim(product.id)]
+        persistClaimedIds(databaseConnection, seenIds)
+
+    return claimed + result
+
+# Writes ids that were claimed locally to the database, so they are known after a restart or rebalance.
+# Ids stay in the cache's list of unpersisted ids until a write succeeds
+def persistClaimedIds(databaseConnection, seenIds):
+    ids = seenIds.getUnpersisted()
+    if len(ids) == 0 or databaseConnection is None:
+        return
+
+    insertedIds = insertNewProductIds(ids, databaseConnection)
+    if insertedIds is None:
+        return
+
+    seenIds.countQuery()
+    seenIds.markPersisted(ids, [id for id in ids if id not in insertedIds])
+
+# Inserts every id that is not in the database yet and returns the set of ids that were inserted.
+# Ids that already exist, including ones inserted concurrently by another validator, are skipped by the
+# unique constraint rather than a separate check. Returns None if the statement failed
+def insertNewProductIds(ids, databaseConnection):
+    try:
+        cursor = databaseConnection.cursor()
+        cursor.execute(
+            'INSERT INTO "ID" SELECT DISTINCT unnest(%(ids)s) '
+            'ON CONFLICT DO NOTHING '
+            'RETURNING "ID"',
+            { 'ids': list(ids) })
+
+        newIds = set(row[0] for row in cursor.fetchall())
+
+        databaseConnection.commit()
+        cursor.close()
+
+        return newIds
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Failed to store product ids with error:")
+        print(error)
+        databaseConnection.rollback()
+
+    return None
+
+# Creates unique index that ON CONFLICT relies on, if the "ID" table does not have one yet
+def ensureUniqueProductIds(databaseConnection):
+    if databaseConnection is None:
+        return
 
     try:
         cursor = databaseConnection.cursor()
-        cursor.execute('SELECT EXISTS (SELECT "ID" FROM "ID" WHERE "ID"=%(id)s)', { 'id': id })
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS "ID_unique" ON "ID" ("ID")')
+        databaseConnection.commit()
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Failed to create unique index on product ids, remove duplicate ids from the table. Error:")
+        print(error)
+        databaseConnection.rollback()
+
+# Returns (product, state) of every product whose tracked attributes may have changed since it was last seen,
+# using only the cache. Products repeated within the batch are returned once
+def findChangeCandidates(products, productStates):
+    candidates = {}
+
+    for product in products:
+        if product is None or product.id is None:
+            continue
+
+        state = ProductState.fromProduct(product)
+        if productStates.mayHaveChanged(product.id, state):
+            candidates[product.id] = (product, state)
+
+    return list(candidates.values())
+
+# Returns new products of a message and products that changed in one of the ways in changeTypes, checked against
+# the database in a single transaction. Caches only learn about the products once it was committed, so a message
+# that fails part way has changed nothing and is handled again from the start, without losing a new or changed product.
+# Raises if the database could not be asked
+def checkProducts(products, candidates, databaseConnection, seenIds, productStates, changeTypes):
+    if len(candidates) == 0:
+        return filterNewProducts(products, databaseConnection, seenIds), []
+
+    if databaseConnection is None:
+        raise psycopg2.OperationalError("No database connection to compare product states with")
 
-        idExists = cursor.fetchone()[0]
+    # States are written first and committed together with the new ids, or rolled back with them
+    changedProducts = compareStates(candidates, databaseConnection, changeTypes)
+    newProducts = filterNewProducts(products, databaseConnection, seenIds)
 
+    try:
         databaseConnection.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Failed to store product states with error:")
+        print(error)
+        databaseConnection.rollback()
+        raise psycopg2.OperationalError("Failed to store product states")
+
+    productStates.count('databaseQueries')
+    productStates.count('changes', len(changedProducts))
+    for product, state in candidates:
+        productStates.remember(product.id, state.digest)
+
+    return newProducts, changedProducts
+
+# Compares candidates with their state in the database and stores their new state, without committing it.
+# Returns products that changed in one of the ways in changeTypes, with the changes attached.
+# Rows are locked while they are compared, so two validators never both report the same change.
+# Products seen for the first time only have their state stored
+def compareStates(candidates, databaseConnection, changeTypes):
+    changedProducts = []
+
+    try:
+        cursor = databaseConnection.cursor()
+        cursor.execute(
+            'SELECT "ID", "Digest", "Price", "PublishType", "StartSellDate", "Sizes" FROM "ProductState" '
+            'WHERE "ID" = ANY(%(ids)s) FOR UPDATE',
+            { 'ids': [product.id for product, state in candidates] })
+
+        storedStates = { row[0]: ProductState.fromRow(row[1:]) for row in cursor.fetchall() }
+
+        rows = []
+        for product, state in candidates:
+            storedState = storedStates.get(product.id)
+            if storedState is not None and storedState.digest == state.digest:
+                continue
+
+            rows.append(state.toRow(product.id))
+            if storedState is None:
+                continue
+
+            changes = diffStates(storedState, state)
+            if any(change in changeTypes for change in changes):
+                product.changes = changes
+                changedProducts.append(product)
+
+        if len(rows) > 0:
+            psycopg2.extras.execute_values(cursor,
+                'INSERT INTO "ProductState" ("ID", "Digest", "Price", "PublishType", "StartSellDate", "Sizes") VALUES %s '
+                'ON CONFLICT ("ID") DO UPDATE SET "Digest" = EXCLUDED."Digest", "Price" = EXCLUDED."Price", '
+                '"PublishType" = EXCLUDED."PublishType", "StartSellDate" = EXCLUDED."StartSellDate", "Sizes" = EXCLUDED."Sizes"',
+                rows)
+
         cursor.close()
     except (Exception, psycopg2.DatabaseError) as error:
-        print("Failed to check if product id exists with error:")
+        print("Failed to compare product states with error:")
         print(error)
-    
-    return idExists
+        databaseConnection.rollback()
+        raise psycopg2.OperationalError("Failed to compare product states")
+
+    return changedProducts
+
+# Creates table holding the last known state of every product, if it does not exist yet
+def ensureProductStateTable(databaseConnection):
+    if databaseConnection is None:
+        return
 
-# Adds product id to database
-def addProductIdToDatabase(id, databaseConnection):
     try:
         cursor = databaseConnection.cursor()
-        cursor.execute('INSERT INTO "ID" VALUES (%(id)s)', {'id': id})
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS "ProductState" ('
+            '"ID" text PRIMARY KEY, "Digest" bytea NOT NULL, "Price" double precision, '
+            '"PublishType" text, "StartSellDate" text, "Sizes" text[])')
         databaseConnection.commit()
         cursor.close()
     except (Exception, psycopg2.DatabaseError) as error:
-        print("Failed to store product id with error:")
-        print(error)
\ No newline at end of file
+        print("Failed to create product state table with error:")
+        print(error)
+        databaseConnection.rollback()
\ No newline at end of file